@@ -85,6 +85,7 @@ setup(
     description='SmartRPyC is a ZeroMQ-based RPC library for Python',
     long_description='SmartRPyC is a ZeroMQ-based RPC library for Python',
     install_requires=install_requires,
+    extras_require={'numpy': ['numpy']},
     tests_require=['pytest'],
     test_suite='smartrpyc.tests',
     classifiers=[
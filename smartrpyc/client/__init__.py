@@ -1 +1,8 @@
+import sys
+
 from .base import *
+from .cache import *
+from .pool import *
+
+if sys.version_info >= (3, 5):
+    from .aio import *
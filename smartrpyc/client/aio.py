@@ -0,0 +1,249 @@
+"""
+asyncio-based client, supporting many concurrent calls on one socket
+
+.. note::
+    This module requires Python 3.5+ and pyzmq with ``zmq.asyncio``
+    support; it is not imported on older Python versions.
+"""
+
+import asyncio
+import logging
+
+import zmq
+import zmq.asyncio
+
+from smartrpyc.utils import lazy_property
+from smartrpyc.utils.frames import split_envelope
+from smartrpyc.utils.protocol import ProtocolMismatch
+from .base import Batch, Client, Stream, find_upload, upload_messages
+
+__all__ = ['AsyncClient', 'AsyncBatch', 'AsyncStream']
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncStream(Stream):
+    """
+    :py:class:`~smartrpyc.client.Stream` for asyncio clients,
+    to be consumed with ``async for``::
+
+        async for row in client.query_rows(u'SELECT ...'):
+            process(row)
+
+    Use :py:meth:`aclose` (or ``async with``) to close it early.
+    """
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._items:
+            try:
+                self._check_done()
+            except StopIteration:
+                raise StopAsyncIteration
+            self._feed(await self._client._pull_stream(
+                self.id, self._client.stream_credit))
+        return self._items.popleft()
+
+    def next(self):
+        raise TypeError("Use 'async for' with asyncio clients")
+
+    def close(self):
+        raise TypeError("Use 'aclose()' with asyncio clients")
+
+    async def aclose(self):
+        """Stop receiving items, closing the stream on the server side"""
+        if not self._done:
+            self._done = True
+            self._items.clear()
+            await self._client._pull_stream(self.id, 0)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
+
+
+class AsyncClient(Client):
+    """
+    Client for use in asyncio applications.
+
+    Calling a remote method returns a coroutine, to be awaited for
+    the result. Requests are sent over a DEALER socket without waiting
+    for the previous replies, which are matched to the calls waiting
+    for them by request id; so, many calls can be in flight at the same
+    time::
+
+        client = AsyncClient('tcp://127.0.0.1:12345')
+        users = await asyncio.gather(*[
+            client.get_user(user_id) for user_id in user_ids])
+
+    Works with all the servers: those using a REP socket will still
+    process requests one at a time, but without the round-trip latency
+    between them.
+    """
+
+    _stream_class = AsyncStream
+
+    def __init__(self, address=None):
+        super(AsyncClient, self).__init__(address)
+        self._pending = {}  # request id -> future
+        self._reader = None
+
+    @lazy_property
+    def _socket(self):
+        ## The process-wide context, as for the synchronous clients
+        context = zmq.asyncio.Context.instance()
+        socket = context.socket(zmq.DEALER)
+        socket.connect(self._address)
+        return socket
+
+    async def _call(self, method, args, kwargs):
+        upload = find_upload(args, kwargs)
+        if upload is not None:
+            return await self._call_upload(method, args, kwargs, *upload)
+        if self.result_cache is not None:
+            return await self._call_cached(method, args, kwargs)
+        request = self._build_request(method, args, kwargs)
+        return self._handle_response(request, await self._exchange(request))
+
+    async def _call_cached(self, method, args, kwargs):
+        request = self._build_request(method, args, kwargs)
+        key, entry = self._cache_lookup(request)
+        if entry is not None and entry.fresh:
+            return entry.value
+        if entry is not None and entry.etag is not None:
+            request['v'] = entry.etag
+        response = self._exec_post_middleware(
+            request, await self._exchange(request))
+        return self._cache_response(key, entry, response)
+
+    async def _call_upload(self, method, args, kwargs, position, source):
+        ## Only synchronous iterators and file objects are supported
+        request, upload_id = self._build_upload_request(
+            method, args, kwargs, position)
+        response = await self._exchange(request)
+        if 'u' in response:
+            for message in upload_messages(
+                    upload_id, source, self.upload_chunk_size):
+                response = await self._exchange(self._new_request(message))
+                if 'u' not in response:
+                    break
+        return self._handle_response(request, response)
+
+    async def _call_batch(self, calls):
+        request = self._build_batch_request(calls)
+        return self._handle_response(request, await self._exchange(request))
+
+    async def _exchange(self, request):
+        if self._protocol is None:
+            return await self._negotiating_roundtrip(request)
+        response = await self._roundtrip(request)
+        if response.get('e') == ProtocolMismatch.__name__:
+            response = await self._negotiating_roundtrip(request)
+        return response
+
+    async def _negotiating_roundtrip(self, request):
+        ## Calls made in the meantime just use protocol version 1
+        options = self._protocol_options()
+        self._protocol = False
+        if options is None:
+            return await self._roundtrip(request)
+        try:
+            response = await self._roundtrip(dict(request, p=options))
+        except BaseException:
+            self._protocol = None
+            raise
+        self._set_protocol(response.get('p'))
+        return response
+
+    async def _roundtrip(self, request):
+        future = asyncio.get_event_loop().create_future()
+        self._pending[request['i']] = future
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.ensure_future(self._read_replies())
+        try:
+            ## The empty delimiter frame makes us look like a REQ socket
+            await self._socket.send_multipart(
+                [b''] + self._pack_request(request), copy=False)
+            return await future
+        finally:
+            self._pending.pop(request['i'], None)
+
+    async def _pull_stream(self, stream_id, credit):
+        return await self._exchange(
+            self._new_request({'s': stream_id, 'n': credit}))
+
+    def batch(self):
+        """
+        Get an :py:class:`AsyncBatch` object, to send many calls
+        in a single request.
+        """
+        return AsyncBatch(self)
+
+    async def _read_replies(self):
+        """
+        Receive replies, passing them to the calls waiting for them.
+        If receiving fails, so do the calls: the next one starts
+        reading again.
+        """
+        while True:
+            try:
+                frames = await self._socket.recv_multipart(copy=False)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception('Unable to receive replies')
+                self._reader = None
+                for future in list(self._pending.values()):
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            try:
+                response = self._unpack_response(split_envelope(frames)[1])
+                future = self._pending.get(response.get('i'))
+            except Exception:
+                logger.exception('Unable to decode reply')
+                continue
+            if future is None:
+                ## Most likely the caller went away (eg. timeout)
+                logger.debug('Dropping reply to unknown request')
+            elif not future.done():
+                future.set_result(response)
+
+    def close(self):
+        """Stop reading replies and close the socket"""
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+        for future in self._pending.values():
+            future.cancel()
+        self._socket.close(linger=0)
+        del self._socket
+
+
+class AsyncBatch(Batch):
+    """
+    :py:class:`~smartrpyc.client.Batch` for asyncio clients;
+    :py:meth:`execute` is a coroutine, and ``async with`` is to be
+    used instead of ``with``.
+    """
+
+    async def execute(self):
+        calls, results = self._take_calls()
+        if calls:
+            self._set_responses(
+                results, await self._client._call_batch(calls))
+        return self._get_values(results)
+
+    def __enter__(self):
+        raise TypeError("Use 'async with' with asyncio clients")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            await self.execute()
@@ -2,14 +2,32 @@
 SmartRPC client
 """
 
+import collections
+import itertools
+import random
+import time
 import uuid
+
 import zmq
 
+try:
+    from collections.abc import Iterator
+except ImportError:  # Python 2
+    from collections import Iterator
+
 from smartrpyc.utils import lazy_property
-from smartrpyc.utils.serialization import MsgPackSerializer
+from smartrpyc.utils.compression import compress_frame, \
+    decompress_frames, get_codec
+from smartrpyc.utils.frames import pack_frames, unpack_frames
+from smartrpyc.utils.middleware import MiddlewareChain
+from smartrpyc.utils.protocol import MethodsTable, ProtocolMismatch, \
+    decode_reply, encode_request, is_v2
+from smartrpyc.utils.serialization import MsgPackSerializer, \
+    UnsupportedSerializer, get_serializer, tag_frames, untag_frames
+from .exceptions import DeadlineExceeded
 
 __all__ = ['Client', 'IntrospectableClient', 'RemoteException',
-           'ClientMiddlewareBase']
+           'ClientMiddlewareBase', 'Batch', 'BatchResult', 'Stream']
 
 
 class RemoteException(Exception):
@@ -38,43 +56,455 @@ class RemoteException(Exception):
         return "<RemoteException: {0!r}>".format(str(self))
 
 
+def unwrap_response(response):
+    """
+    Get the result out of a response message, raising
+    :py:exc:`RemoteException` for exception messages.
+    """
+    if 'e' in response:
+        raise RemoteException(response['e'], response.get('e_msg'))
+    return response['r']
+
+
+def find_upload(args, kwargs):
+    """
+    Find the argument to be uploaded in chunks: a file object
+    or an iterator (at most one per call).
+
+    :return: ``(position, value)``, or ``None``
+    """
+    found = [(idx, value) for idx, value in enumerate(args)
+             if _is_upload(value)]
+    found.extend((name, value) for name, value in kwargs.iteritems()
+                 if _is_upload(value))
+    if len(found) > 1:
+        raise ValueError("At most one argument per call can be uploaded")
+    return found[0] if found else None
+
+
+def _is_upload(value):
+    return hasattr(value, 'read') or isinstance(value, Iterator)
+
+
+def _read_chunks(source, chunk_size):
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def upload_messages(upload_id, source, chunk_size):
+    """
+    Split the content of a file object (or the items of an iterator)
+    in messages to be sent to the server, marking the last one.
+    """
+    if hasattr(source, 'read'):
+        source = _read_chunks(source, chunk_size)
+    message = None
+    for chunk in source:
+        if message is not None:
+            yield message
+        message = {'u': upload_id, 'c': [chunk]}
+    if message is None:
+        message = {'u': upload_id, 'c': []}
+    message['end'] = True
+    yield message
+
+
+class Stream(object):
+    """
+    Iterator over the items yielded by a remote generator.
+
+    Calling a method returning a generator gives a stream, receiving
+    the items a chunk at a time: when the received items run out,
+    up to ``client.stream_credit`` more are asked for. The server never
+    runs the generator ahead of what was asked, so a slow consumer
+    is never flooded::
+
+        for row in client.query_rows(u'SELECT ...'):
+            process(row)
+
+    If the remote generator raises, :py:exc:`RemoteException` is raised
+    once the items yielded before the exception have been consumed.
+
+    Streams not consumed until the end should be closed, to free
+    the generator on the server (that would otherwise be dropped
+    after a while); they are also context managers.
+    """
+
+    def __init__(self, client, response):
+        self._client = client
+        self.id = response['s']
+        self._items = collections.deque()
+        self._done = False
+        self._error = None
+        self._feed(response)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while not self._items:
+            self._check_done()
+            self._feed(self._client._pull_stream(
+                self.id, self._client.stream_credit))
+        return self._items.popleft()
+
+    def close(self):
+        """Stop receiving items, closing the stream on the server side"""
+        if not self._done:
+            self._done = True
+            self._items.clear()
+            self._client._pull_stream(self.id, 0)
+
+    def _feed(self, response):
+        self._items.extend(response.get('c') or ())
+        if 'e' in response:
+            self._error = RemoteException(
+                response['e'], response.get('e_msg'))
+            self._done = True
+        elif response.get('end') or 's' not in response:
+            self._done = True
+
+    def _check_done(self):
+        """Raise the stream error, or stop iteration, at the end"""
+        if self._done:
+            error, self._error = self._error, None
+            if error is not None:
+                raise error
+            raise StopIteration
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 class Client(object):
+    #: Serializer for the messages; unless it's the default one, messages
+    #: are tagged with its id, for servers accepting several of them
+    #: (see :py:mod:`smartrpyc.utils.serialization`)
     packer = MsgPackSerializer
+    _stream_class = Stream
+
+    #: Arguments (bytes, bytearray or memoryview) larger than this are
+    #: sent in their own frame, without copying them; large results are
+    #: received as memoryviews. ``None`` disables both.
+    zero_copy_threshold = 1 << 20
+
+    #: Number of items to be requested each time a :py:class:`Stream`
+    #: runs out of them
+    stream_credit = 64
+
+    #: Size of the chunks read from file objects passed as arguments
+    upload_chunk_size = 256 * 1024
+
+    #: :py:class:`~smartrpyc.client.ResultCache` for the results of
+    #: the methods sending cache hints; ``None`` disables caching.
+    result_cache = None
+
+    #: Highest protocol version to be negotiated with the server
+    #: (see :py:mod:`smartrpyc.utils.protocol`); ``1`` disables
+    #: the compact protocol.
+    protocol_version = 2
+
+    #: Name of the codec compressing the large messages (see
+    #: :py:mod:`smartrpyc.utils.compression`), if supported by
+    #: the server too; ``None`` disables compression.
+    compression = None
+
+    #: Requests are compressed only when larger than this (in bytes)
+    compression_threshold = 16 << 10
+
+    #: Whether to ask the server for the timings of the phases of each
+    #: call (see :py:meth:`smartrpyc.server.Request.mark`); the timings
+    #: of the last reply are kept in ``last_timings``
+    request_timings = False
+
+    #: Seconds the server is given to reply to each call: requests still
+    #: waiting to be processed after that are skipped by the server.
+    #: ``None`` for no limit.
+    call_timeout = None
 
     def __init__(self, address=None):
         self._address = address
-        self.middleware = []  # Middleware chain
+        self.middleware = []
+        ## Request ids: increasing integers, from a random starting point
+        ## (servers deduplicating requests need them to be unique)
+        self._ids = itertools.count(random.getrandbits(62))
+        ## Methods table of the compact protocol; ``None`` until
+        ## negotiated, ``False`` if not supported by the server
+        self._protocol = None
+        ## Compression codec agreed with the server, if any
+        self._codec = None
+        #: ``(phase, seconds)`` pairs sent by the server along with
+        #: the last reply (see ``request_timings``)
+        self.last_timings = None
+        #: Time (as returned by ``time.time()``) after which calls are
+        #: of no use, eg. the ``deadline`` of the request being served
+        #: by the method making the calls; ``None`` for no limit
+        self.deadline = None
+
+    @property
+    def middleware(self):
+        """
+        The middleware chain, as a :py:class:`.MiddlewareChain`
+        (assigned lists are converted)
+        """
+        return self._middleware
+
+    @middleware.setter
+    def middleware(self, value):
+        self._middleware = MiddlewareChain(value, ClientMiddlewareBase)
 
     @lazy_property
     def _socket(self):
-        context = zmq.Context()
+        ## The process-wide context is never garbage-collected: a private
+        ## one could be terminated before the socket is closed, when
+        ## a client ends up in a reference cycle, hanging forever.
+        context = zmq.Context.instance()
         socket = context.socket(zmq.REQ)
         # if self._address is not None:
         socket.connect(self._address)
         return socket
 
-    def _do_request(self, method, args, kwargs):
-        request = self._prepare_request({
-            'i': str(uuid.uuid4()),
+    def _call(self, method, args, kwargs):
+        """Call a remote method, returning its result"""
+        upload = find_upload(args, kwargs)
+        if upload is not None:
+            return self._call_upload(method, args, kwargs, *upload)
+        if self.result_cache is not None:
+            return self._call_cached(method, args, kwargs)
+        request = self._build_request(method, args, kwargs)
+        return self._handle_response(request, self._exchange(request))
+
+    def _call_cached(self, method, args, kwargs):
+        """
+        Call a remote method through the result cache: fresh results
+        are returned right away, stale ones are revalidated.
+        """
+        request = self._build_request(method, args, kwargs)
+        key, entry = self._cache_lookup(request)
+        if entry is not None and entry.fresh:
+            return entry.value
+        if entry is not None and entry.etag is not None:
+            request['v'] = entry.etag
+        response = self._exec_post_middleware(request, self._exchange(request))
+        return self._cache_response(key, entry, response)
+
+    def _cache_lookup(self, request):
+        key = self.result_cache.make_key(request)
+        if key is None:
+            return None, None
+        return key, self.result_cache.get(key)
+
+    def _cache_response(self, key, entry, response):
+        if key is not None:
+            response = self.result_cache.update(key, entry, response)
+        return self._unwrap(response)
+
+    def _call_upload(self, method, args, kwargs, position, source):
+        """
+        Call a remote method, sending one of its arguments in chunks.
+        Each chunk waits for the server acknowledgement; the reply
+        to the last one is the result of the call.
+        """
+        request, upload_id = self._build_upload_request(
+            method, args, kwargs, position)
+        response = self._exchange(request)
+        if 'u' in response:
+            for message in upload_messages(
+                    upload_id, source, self.upload_chunk_size):
+                response = self._exchange(self._new_request(message))
+                if 'u' not in response:
+                    break  # The call is over already (eg. it failed)
+        return self._handle_response(request, response)
+
+    def _call_batch(self, calls):
+        """
+        Send a batch of calls (a list of ``(method, args, kwargs)``)
+        in a single request; return the list of the response messages
+        for each call, to be passed to :py:func:`unwrap_response`.
+        """
+        request = self._build_batch_request(calls)
+        return self._handle_response(request, self._exchange(request))
+
+    def _new_request(self, request):
+        request['i'] = next(self._ids)
+        if self.zero_copy_threshold is not None:
+            request['f'] = 1  # We can handle multipart replies
+        if self.request_timings:
+            request['T'] = 1
+        budget = self._request_budget()
+        if budget is not None:
+            if budget <= 0:
+                raise DeadlineExceeded("Deadline exceeded before sending")
+            request['d'] = budget
+            request['D'] = time.time() + budget
+        request = self._prepare_request(request)
+        return self._exec_pre_middleware(request)
+
+    def _request_budget(self):
+        """
+        Seconds left to the server to reply to a request sent now
+        (``None`` if unlimited); sent along with the request, as well as
+        the deadline itself, which is used only by servers trusting
+        the clients' clocks (not to depend on synchronized clocks)
+        """
+        budget = self.call_timeout
+        if self.deadline is not None:
+            remaining = self.deadline - time.time()
+            if budget is None or remaining < budget:
+                budget = remaining
+        return budget
+
+    def _build_request(self, method, args, kwargs):
+        return self._new_request({
             'm': method,
             'a': args,
             'k': kwargs,
         })
 
-        request = self._exec_pre_middleware(request)
+    def _build_upload_request(self, method, args, kwargs, position):
+        upload_id = uuid.uuid4().hex
+        args, kwargs = list(args), dict(kwargs)
+        if isinstance(position, basestring):
+            kwargs[position] = None
+        else:
+            args[position] = None
+        request = self._new_request({
+            'm': method,
+            'a': args,
+            'k': kwargs,
+            'ua': [position, upload_id],
+        })
+        return request, upload_id
+
+    def _build_batch_request(self, calls):
+        return self._new_request({
+            'b': [{'m': m, 'a': a, 'k': k} for m, a, k in calls],
+        })
+
+    def _exchange(self, request):
+        """Send a request, and wait for the (unpacked) response"""
+        if self._protocol is None:
+            return self._negotiating_roundtrip(request)
+        response = self._roundtrip(request)
+        if response.get('e') == ProtocolMismatch.__name__:
+            ## The server forgot our methods table: negotiate again
+            response = self._negotiating_roundtrip(request)
+        return response
+
+    def _roundtrip(self, request):
+        self._send_request(request)
+        return self._recv_response()
+
+    def _negotiating_roundtrip(self, request):
+        """
+        Send a request with protocol version 1, negotiating the protocol
+        along with it: no extra round trip is needed. Servers not knowing
+        about it ignore the ``'p'`` key, and version 1 is used.
+        """
+        options = self._protocol_options()
+        self._protocol = False
+        if options is None:
+            return self._roundtrip(request)  # Nothing to negotiate
+        try:
+            response = self._roundtrip(dict(request, p=options))
+        except:
+            self._protocol = None  # To be tried again
+            raise
+        self._set_protocol(response.get('p'))
+        return response
 
-        packed = self.packer.packb(request)
-        self._socket.send(packed)
+    def _protocol_options(self):
+        """
+        The ``[versions, options]`` to be negotiated with the server
+        (``None`` if there is nothing to negotiate)
+        """
+        if self.protocol_version < 2 and self.compression is None:
+            return None
+        options = {}
+        if self.compression is not None:
+            options['z'] = [self.compression]
+        return [range(1, self.protocol_version + 1), options]
+
+    def _set_protocol(self, result):
+        """Apply the result of the negotiation sent by the server"""
+        self._protocol = False
+        self._codec = None
+        if not isinstance(result, dict):
+            return
+        if result.get('v') == 2:
+            self._protocol = MethodsTable(result['m'])
+            self._protocol.id = result['t']
+        if self.compression in result.get('z', ()):
+            self._codec = get_codec(self.compression)
+
+    def _send_request(self, request):
+        self._socket.send_multipart(self._pack_request(request), copy=False)
+
+    def _recv_response(self):
+        return self._unpack_response(self._socket.recv_multipart(copy=False))
+
+    def _pack_request(self, request):
+        """Pack a request into a list of frames"""
+        codec = self._codec
+        if codec is not None:
+            request = dict(request, z=codec.id)
+        frames = None
+        if self._protocol:
+            frames = encode_request(self.packer, request, self._protocol,
+                                    self.zero_copy_threshold)
+        if frames is None:
+            frames = pack_frames(
+                self.packer, request, self.zero_copy_threshold)
+        if codec is not None:
+            frames[0] = compress_frame(
+                frames[0], codec, self.compression_threshold)
+        return tag_frames(frames, self.packer)
+
+    def _unpack_response(self, frames):
+        """Unpack a response from a list of frames"""
+        serializer_id, frames = untag_frames(frames)
+        if serializer_id is not None and \
+                get_serializer(serializer_id) is not self.packer:
+            raise UnsupportedSerializer(
+                "Reply packed with another serializer: {0}".format(
+                    serializer_id), serializer_id)
+        frames = decompress_frames(frames)
+        if is_v2(frames):
+            return decode_reply(self.packer, frames)
+        return unpack_frames(self.packer, frames)
+
+    def _do_request(self, method, args, kwargs):
+        request = self._build_request(method, args, kwargs)
+        self._send_request(request)
         return request
 
     def _get_response(self, request):
-        response = self.packer.unpackb(self._socket.recv())
+        return self._handle_response(request, self._recv_response())
 
+    def _handle_response(self, request, response):
+        if 'T' in response:
+            self.last_timings = response['T']
         response = self._exec_post_middleware(request, response)
+        return self._unwrap(response)
 
-        if 'e' in response:
-            raise RemoteException(response['e'], response.get('e_msg'))
-        return response['r']
+    def _unwrap(self, response):
+        """Like :py:func:`unwrap_response`, but supporting streams"""
+        if 's' in response:
+            return self._stream_class(self, response)
+        return unwrap_response(response)
+
+    def _pull_stream(self, stream_id, credit):
+        """
+        Ask for the next ``credit`` items of a stream; no credit
+        closes the stream on the server side.
+        """
+        return self._exchange(self._new_request({'s': stream_id, 'n': credit}))
 
     def _prepare_request(self, request):
         return request
@@ -82,42 +512,145 @@ class Client(object):
     def __getattr__(self, item):
         if item.startswith('_'):
             raise AttributeError(item)
+        return MethodProxy(self, item)
 
-        server = self
-
-        class method_proxy(object):
-            def __call__(self, *a, **kw):
-                request = server._do_request(item, a, kw)
-                return server._get_response(request)
-
-            @lazy_property
-            def __doc__(self):
-                request = server._do_request('doc', (item,), {})
-                return server._get_response(request)
-
-        # def method_proxy(*a, **kw):
-        #     request = self._do_request(item, a, kw)
-        #     return self._get_response(request)
-
-        return method_proxy()
+    def batch(self):
+        """
+        Get a :py:class:`Batch` object, to send many calls in a single
+        request. See :py:class:`Batch` for more details.
+        """
+        return Batch(self)
 
     def _exec_pre_middleware(self, request):
-        for mw in self.middleware:
-            if hasattr(mw, 'pre'):
-                retval = mw.pre(request)
-                if retval is not None:
-                    request = retval
+        for pre in self.middleware.pre_hooks():
+            retval = pre(request)
+            if retval is not None:
+                request = retval
         return request
 
     def _exec_post_middleware(self, request, response):
-        for mw in reversed(self.middleware):
-            if hasattr(mw, 'post'):
-                retval = mw.post(request, response)
-                if retval is not None:
-                    response = retval
+        for post in self.middleware.post_hooks():
+            retval = post(request, response)
+            if retval is not None:
+                response = retval
         return response
 
 
+## Proxy for a remote method, as returned by attribute access on clients.
+## This is a module-level class, instead of one built on the fly for each
+## call, that was both slow and putting the client in a reference cycle.
+## (No docstring here, as ``__doc__`` is used to fetch the remote one)
+class MethodProxy(object):
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+
+    def __call__(self, *a, **kw):
+        return self._client._call(self._name, a, kw)
+
+    @lazy_property
+    def __doc__(self):
+        return self._client._call('doc', (self._name,), {})
+
+
+class BatchResult(object):
+    """Placeholder for the result of a call in a :py:class:`Batch`"""
+
+    def __init__(self, client=None):
+        self.done = False
+        self._client = client
+        self._response = None
+
+    def result(self):
+        """
+        Return the result of the call, or raise :py:exc:`RemoteException`
+        if the call failed.
+        """
+        if not self.done:
+            raise RuntimeError("The batch was not executed yet")
+        if self._client is not None:
+            return self._client._unwrap(self._response)
+        return unwrap_response(self._response)
+
+    def _set_response(self, response):
+        self._response = response
+        self.done = True
+
+
+class Batch(object):
+    """
+    Collect calls, to be sent to the server in a single request.
+
+    Calling methods on the batch object will return
+    :py:class:`BatchResult` placeholders, that will be filled once
+    the batch has been executed; this happens when calling
+    :py:meth:`execute` or when exiting the ``with`` block::
+
+        with client.batch() as batch:
+            user1 = batch.get_user(1)
+            user2 = batch.get_user(2)
+        print user1.result(), user2.result()
+
+    The server runs each call separately (including the middleware),
+    so a failing call will not affect the others.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._calls = []
+        self._results = []
+
+    def __getattr__(self, item):
+        if item.startswith('_'):
+            raise AttributeError(item)
+        return MethodProxy(self, item)
+
+    def _call(self, method, args, kwargs):
+        result = BatchResult(self._client)
+        self._calls.append((method, args, kwargs))
+        self._results.append(result)
+        return result
+
+    def execute(self):
+        """
+        Send all the collected calls and wait for their results.
+
+        :return:
+            the list of results, in the same order as the calls.
+            Failed calls will have a :py:exc:`RemoteException`
+            instance (returned, not raised) in their place.
+        """
+        calls, results = self._take_calls()
+        if calls:
+            self._set_responses(results, self._client._call_batch(calls))
+        return self._get_values(results)
+
+    def _take_calls(self):
+        calls, results = self._calls, self._results
+        self._calls, self._results = [], []
+        return calls, results
+
+    def _set_responses(self, results, responses):
+        for result, response in zip(results, responses):
+            result._set_response(response)
+
+    def _get_values(self, results):
+        values = []
+        for result in results:
+            try:
+                values.append(result.result())
+            except RemoteException, e:
+                values.append(e)
+        return values
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.execute()
+
+
 class IntrospectableClient(Client):
     def __dir__(self):
         methods = dir(super(IntrospectableClient, self))
@@ -0,0 +1,119 @@
+"""
+Client-side cache of call results, driven by server hints
+"""
+
+import collections
+import threading
+import time
+
+from smartrpyc.utils import canonical
+
+__all__ = ['ResultCache']
+
+## Keys changing at each call, which do not affect its result
+_VOLATILE_KEYS = frozenset(['i', 'f', 'T', 'd', 'D', 'p', 'v'])
+
+
+class CacheEntry(object):
+    __slots__ = ('value', 'expires', 'etag')
+
+    def __init__(self, value, expires, etag):
+        self.value = value
+        self.expires = expires
+        self.etag = etag
+
+    @property
+    def fresh(self):
+        return self.expires > time.time()
+
+
+class ResultCache(object):
+    """
+    LRU cache of the results of calls, for the methods whose replies
+    carry cache hints (see :py:meth:`.Request.set_cache_hints`).
+
+    Fresh results are returned without contacting the server; for
+    stale ones with an etag, the server is asked whether they are
+    still valid, getting back a short "not modified" reply if so.
+
+    To be enabled on a client with::
+
+        client.result_cache = ResultCache(max_entries=1000)
+
+    .. warning::
+        Cached results are returned as they are, not copied: do not
+        modify them.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._entries = collections.OrderedDict()  # key -> CacheEntry
+        self._lock = threading.Lock()  # Pooled clients share caches
+
+    def __len__(self):
+        return len(self._entries)
+
+    def make_key(self, request):
+        """
+        Cache key for the request of a call (``None`` if arguments are
+        unhashable): everything in it counts, not only the arguments
+        (eg. the token of authenticated clients), but for the keys
+        changing at each call.
+        """
+        try:
+            return (request['m'], canonical(dict(
+                (key, value) for key, value in request.iteritems()
+                if key not in _VOLATILE_KEYS)))
+        except TypeError:
+            return None
+
+    def get(self, key):
+        """Get the cache entry for a call, counting hits and misses"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry  # Most recently used
+            if entry.fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return entry
+
+    def update(self, key, entry, response):
+        """
+        Update the cache from the response to a call,
+        returning the response to be used.
+
+        :param entry: the stale entry for the call, if any
+        """
+        hints = response.get('h')
+        if response.get('nm') and entry is not None:
+            self.revalidated += 1
+            entry.expires = time.time() + (hints or {}).get('max_age', 0)
+            return {'r': entry.value}
+        if hints and 'r' in response:
+            self._store(key, CacheEntry(
+                response['r'], time.time() + hints.get('max_age', 0),
+                hints.get('etag')))
+        return response
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, method=None):
+        """Drop all the cached results, or those of a method"""
+        with self._lock:
+            if method is None:
+                self._entries.clear()
+                return
+            for key in [k for k in self._entries if k[0] == method]:
+                del self._entries[key]
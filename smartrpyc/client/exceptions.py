@@ -3,3 +3,17 @@ class ServerUnavailable(Exception):
     Raised when server is not available
     for consuming a request
     """
+
+
+class PoolExhausted(Exception):
+    """
+    Raised when no socket could be checked out
+    from a pool in the given time
+    """
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when the deadline of a call passed before
+    the request could be sent
+    """
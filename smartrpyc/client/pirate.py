@@ -1,31 +1,183 @@
+"""
+Reliable client, retrying requests on other sockets and servers
+("Lazy Pirate" pattern, from the ZeroMQ guide)
+"""
+
+import logging
+import time
+
 import zmq
 
 from smartrpyc import utils
 from smartrpyc.client import base, exceptions
 
+logger = logging.getLogger(__name__)
+
+
+class Endpoint(object):
+    """Health of a server address, as seen by a :py:class:`Lazy` client"""
+
+    def __init__(self, address):
+        self.address = address
+        #: Consecutive failed attempts
+        self.failures = 0
+        #: Time before which the endpoint should not be tried again
+        self.retry_at = 0
+        #: Moving average of the reply times, in seconds
+        #: (``None`` until the first reply)
+        self.latency = None
+
+    def available(self, now):
+        return self.retry_at <= now
+
+    def succeeded(self, latency, alpha):
+        self.failures = 0
+        self.retry_at = 0
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += alpha * (latency - self.latency)
+
+    def failed(self, now, base_backoff, max_backoff):
+        """Back off, for twice as long as the previous time"""
+        self.failures += 1
+        self.retry_at = now + min(
+            max_backoff, base_backoff * 2 ** (self.failures - 1))
+
+    def __repr__(self):
+        return '<Endpoint {0} failures={1} latency={2}>'.format(
+            self.address, self.failures, self.latency)
+
 
 class Lazy(base.Client):
-    def __init__(self, retries=3, timeout=1000, **kwargs):
+    """
+    Client retrying requests that got no reply in time.
+
+    On timeout, the socket is closed and the request is sent again on
+    a new one, connected to the healthiest of the addresses: those that
+    failed recently are avoided for a while (twice as long after each
+    consecutive failure), and among the others the one with the lowest
+    reply time is preferred. The client keeps using an address until
+    it fails.
+
+    Retried requests keep their id, so servers can tell them apart
+    from new ones and avoid running them twice; their deadline is
+    renewed at each attempt.
+
+    Usage::
+
+        client = Lazy(address=['tcp://server1:12345',
+                               'tcp://server2:12345'])
+
+    :raise ServerUnavailable:
+        when none of the attempts got a reply; the client can still
+        be used for further calls.
+    """
+
+    #: Seconds an address is avoided after its first failure
+    base_backoff = 0.5
+
+    #: Maximum seconds an address is avoided after failing
+    max_backoff = 30.0
+
+    #: Weight of the last reply time in the latency moving average
+    latency_alpha = 0.2
+
+    def __init__(self, retries=3, timeout=1000, address=None):
+        """
+        :param retries: attempts to be made before giving up
+        :param timeout: milliseconds to wait for each attempt
+        :param address: a (list of) address(es) of the servers
+        """
         self._retries = retries
         self._timeout = timeout
-        super(Lazy, self).__init__(**kwargs)
+        if not isinstance(address, (list, tuple)):
+            address = [address]
+        self.endpoints = [Endpoint(addr) for addr in address]
+        self._endpoint = None  # Endpoint the socket is connected to
+        self._request = None  # Request awaiting a reply
+        self._pending = None  # ..and its frames
+        super(Lazy, self).__init__(address[0])
 
     @utils.lazy_property
-    def _poller(self):
-        poller = zmq.Poller()
-        poller.register(self._socket, zmq.POLLIN)
-        return poller
-
-    def _get_response(self, request, retries=None):
-        if not retries is None and retries <= 0:
-            self._socket.setsockopt(zmq.LINGER, 0)
-            self._socket.close()
-            self._poller.unregister(self._socket)
-            raise exceptions.ServerUnavailable("")
-
-        socks = dict(self._poller.poll(self._timeout))
-        if socks.get(self._socket) == zmq.POLLIN:
-            return super(Lazy, self)._get_response(request)
-
-        retries = (retries or self._retries) - 1
-        return self._get_response(request, retries=retries)
+    def _socket(self):
+        self._endpoint = self._choose_endpoint()
+        socket = zmq.Context.instance().socket(zmq.REQ)
+        socket.connect(self._endpoint.address)
+        return socket
+
+    def _choose_endpoint(self):
+        now = time.time()
+        available = [e for e in self.endpoints if e.available(now)]
+        if not available:
+            ## Everything failed lately: try the first to come back
+            return min(self.endpoints, key=lambda e: e.retry_at)
+        ## Addresses never tried yet come first
+        return min(available, key=lambda e: e.latency or 0)
+
+    def _reset_socket(self):
+        """Drop the socket, with any message still queued"""
+        self._socket.setsockopt(zmq.LINGER, 0)
+        self._socket.close()
+        del self._socket
+
+    def _request_budget(self):
+        ## Replies coming after the attempt timeout are of no use
+        budget = super(Lazy, self)._request_budget()
+        if not self._timeout or self._timeout < 0:
+            return budget  # No (or no useful) timeout
+        timeout = self._timeout / 1000.0
+        if budget is None or timeout < budget:
+            budget = timeout
+        return budget
+
+    def _send_request(self, request):
+        self._request = request
+        self._pending = self._pack_request(request)
+        self._send_pending()
+
+    def _resend_request(self):
+        """
+        Send the pending request again, with a fresh deadline: that of
+        the first attempt is over, or about to be
+        """
+        request = self._request
+        if 'd' in request:
+            budget = self._request_budget()
+            if budget <= 0:
+                raise exceptions.DeadlineExceeded(
+                    "Deadline exceeded before retrying")
+            request['d'] = budget
+            request['D'] = time.time() + budget
+            self._pending = self._pack_request(request)
+        self._send_pending()
+
+    def _send_pending(self):
+        socket = self._socket
+        self._sent_at = time.time()
+        socket.send_multipart(self._pending, copy=False)
+
+    def _recv_response(self):
+        attempts = self._retries
+        while True:
+            if self._socket.poll(self._timeout, zmq.POLLIN):
+                frames = self._socket.recv_multipart(copy=False)
+                self._request = self._pending = None
+                self._endpoint.succeeded(
+                    time.time() - self._sent_at, self.latency_alpha)
+                return self._unpack_response(frames)
+
+            logger.warning("No reply from {0}".format(self._endpoint.address))
+            self._endpoint.failed(
+                time.time(), self.base_backoff, self.max_backoff)
+            self._reset_socket()
+            attempts -= 1
+            if attempts <= 0:
+                self._request = self._pending = None
+                raise exceptions.ServerUnavailable(
+                    "No reply after {0} attempts".format(self._retries))
+            try:
+                self._resend_request()
+            except exceptions.DeadlineExceeded:
+                self._request = self._pending = None
+                raise
@@ -0,0 +1,196 @@
+"""
+Pool of client sockets, to be shared between threads
+"""
+
+import collections
+import contextlib
+import os
+import threading
+import time
+
+import zmq
+
+from .base import Client
+from .exceptions import PoolExhausted, ServerUnavailable
+
+__all__ = ['ClientPool', 'PooledClient']
+
+
+class ClientPool(object):
+    """
+    Thread-safe pool of connected REQ sockets.
+
+    A ZeroMQ socket must not be used by more than one thread, so clients
+    cannot be shared; creating a new one each time (eg. in each request
+    of a web application) means paying for the connection every time.
+    The pool keeps instead a number of "warm" sockets for each address,
+    lending them to one thread at a time.
+
+    All the sockets are created from a single, process-wide, context.
+
+    Usage::
+
+        pool = ClientPool(max_sockets=8)  # Usually, at module level
+        client = pool.client('tcp://127.0.0.1:12345')
+
+        ## Then, from any thread:
+        client.hello()
+
+    .. note::
+        Pools are aware of forking: the child process will just
+        discard the sockets inherited from the parent, and start
+        creating new ones.
+    """
+
+    def __init__(self, max_sockets=16, max_idle=60.0, context=None):
+        """
+        :param max_sockets:
+            maximum number of sockets to be created for each address.
+            When all of them are in use, threads will wait for one
+            to be checked in.
+        :param max_idle:
+            seconds after which an unused socket will be closed.
+        :param context:
+            ZeroMQ context to be used to create sockets.
+            Defaults to the process-wide instance.
+        """
+        self.max_sockets = max_sockets
+        self.max_idle = max_idle
+        self._context = context
+        self._lock = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = collections.defaultdict(collections.deque)
+        self._count = collections.defaultdict(int)
+
+    @property
+    def context(self):
+        if self._context is None:
+            return zmq.Context.instance()
+        return self._context
+
+    def checkout(self, address, timeout=None):
+        """
+        Get a socket connected to ``address`` from the pool;
+        a new one will be created if no idle socket is available.
+
+        :param timeout:
+            seconds to wait for a socket, if ``max_sockets``
+            are already in use. Wait forever if ``None``.
+        :raise PoolExhausted: if the timeout expired
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            while True:
+                idle = self._idle[address]
+                if idle:
+                    ## Last-in, first-out: keep the warmest sockets busy,
+                    ## letting the others expire
+                    return idle.pop()[0]
+                if self._count[address] < self.max_sockets:
+                    self._count[address] += 1
+                    break
+                remaining = None if deadline is None else \
+                    deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise PoolExhausted(
+                        "No socket available for {0}".format(address))
+                self._lock.wait(remaining)
+
+        try:
+            socket = self.context.socket(zmq.REQ)
+            socket.connect(address)
+        except:
+            self._forget(address)
+            raise
+        return socket
+
+    def checkin(self, address, socket):
+        """Return a socket to the pool, once done using it"""
+        now = time.time()
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self._idle[address].append((socket, now))
+            self._evict(now)
+            self._lock.notify()
+
+    def discard(self, address, socket):
+        """
+        Close a socket checked out from the pool, that cannot be reused
+        (eg. a REQ socket that sent a request but got no reply).
+        """
+        socket.close(linger=0)
+        self._forget(address)
+
+    def _forget(self, address):
+        with self._lock:
+            self._count[address] -= 1
+            self._lock.notify()
+
+    def _evict(self, now):
+        """Close the sockets that stayed idle for too long"""
+        for address, idle in self._idle.iteritems():
+            while idle and now - idle[0][1] > self.max_idle:
+                idle.popleft()[0].close(linger=0)
+                self._count[address] -= 1
+
+    @contextlib.contextmanager
+    def socket(self, address, timeout=None):
+        """
+        Context manager to check out a socket and give it back when done.
+        The socket will be discarded if an exception is raised.
+        """
+        socket = self.checkout(address, timeout=timeout)
+        try:
+            yield socket
+        except:
+            self.discard(address, socket)
+            raise
+        else:
+            self.checkin(address, socket)
+
+    def client(self, address, **kwargs):
+        """Get a :py:class:`PooledClient` using this pool"""
+        return PooledClient(address, pool=self, **kwargs)
+
+    def close(self):
+        """Close all the idle sockets"""
+        with self._lock:
+            for address, idle in self._idle.iteritems():
+                while idle:
+                    idle.pop()[0].close(linger=0)
+                    self._count[address] -= 1
+
+
+class PooledClient(Client):
+    """
+    Client borrowing a socket from a :py:class:`ClientPool` for each call.
+    Unlike normal clients, it can be shared between threads.
+    """
+
+    def __init__(self, address=None, pool=None, timeout=None):
+        """
+        :param address: address of the server
+        :param pool: the :py:class:`ClientPool` to use
+        :param timeout:
+            milliseconds to wait for a reply, before giving up
+            and raising :py:exc:`ServerUnavailable`.
+            Wait forever if ``None``.
+        """
+        super(PooledClient, self).__init__(address)
+        self._pool = pool if pool is not None else ClientPool()
+        self._timeout = timeout
+
+    def _roundtrip(self, request):
+        with self._pool.socket(self._address) as socket:
+            socket.send_multipart(self._pack_request(request), copy=False)
+            if self._timeout is not None and \
+                    not socket.poll(self._timeout, zmq.POLLIN):
+                raise ServerUnavailable(
+                    "No reply from {0}".format(self._address))
+            return self._unpack_response(socket.recv_multipart(copy=False))
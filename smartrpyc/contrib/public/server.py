@@ -17,9 +17,12 @@ class PublicRequest(Request):
     Request class from the Public RPC (supports authentication)
     """
 
+    ## Storage for the lazy properties
+    __slots__ = ('_lazy_token', '_lazy_token_info', '_lazy_user')
+
     @lazy_property
     def token(self):
-        return self.raw.get('t')
+        return self.get('t')
 
     @lazy_property
     def token_info(self):
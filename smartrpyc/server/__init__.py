@@ -1,6 +1,19 @@
 from __future__ import absolute_import
 
+import sys
+
 from .base import *
 from .exceptions import *
 from .middleware import *
+from .cache import *
 from .register import *
+from .streams import *
+from .dedup import *
+from .metrics import *
+from .profiler import *
+from .timings import *
+from .threaded import *
+from .prefork import *
+
+if sys.version_info >= (3, 5):
+    from .aio import *
@@ -0,0 +1,273 @@
+"""
+asyncio-based server, supporting coroutine methods and middleware
+
+.. note::
+    This module requires Python 3.5+ and pyzmq with ``zmq.asyncio``
+    support; it is not imported on older Python versions.
+"""
+
+import asyncio
+import inspect
+import logging
+import time
+
+import zmq
+import zmq.asyncio
+
+from smartrpyc.utils import lazy_property
+from smartrpyc.utils.compression import CompressionError
+from smartrpyc.utils.frames import split_envelope
+from smartrpyc.utils.protocol import ProtocolMismatch
+from smartrpyc.utils.serialization import UnsupportedSerializer
+from .base import Server, _IDLE_TIMEOUT, _hook_phase
+
+__all__ = ['AsyncServer']
+
+logger = logging.getLogger(__name__)
+
+
+async def maybe_await(value):
+    """Await ``value`` if it is awaitable, else just return it"""
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+class AsyncServer(Server):
+    """
+    Server running on an asyncio event loop.
+
+    Registered methods, as well as middleware ``pre()`` and ``post()``
+    hooks, may be either plain functions or coroutine functions.
+    Each received request is processed in its own task, so many
+    requests can be in flight while waiting for I/O.
+
+    Usage::
+
+        server = AsyncServer(methods)
+        server.bind('tcp://*:12345')
+        asyncio.get_event_loop().run_until_complete(server.run())
+
+    .. warning::
+        Plain (non-coroutine) methods run directly in the event loop,
+        blocking everything else while running.
+    """
+
+    socket_type = zmq.ROUTER
+
+    def __init__(self, methods=None):
+        super(AsyncServer, self).__init__(methods)
+        self._tasks = set()
+
+    @lazy_property
+    def socket(self):
+        context = zmq.asyncio.Context()
+        return context.socket(self.socket_type)
+
+    async def run(self):
+        """Start the server listening loop"""
+        expiring = asyncio.ensure_future(self._expire_streams_loop())
+        try:
+            while True:
+                await self.run_once()
+        finally:
+            expiring.cancel()
+
+    async def _expire_streams_loop(self):
+        """Close the abandoned streams, even while idle"""
+        while True:
+            await asyncio.sleep(_IDLE_TIMEOUT / 1000.0)
+            self._expire_streams()
+
+    async def run_once(self):
+        """Receive a request and schedule its processing in a new task"""
+        try:
+            envelope, frames = split_envelope(
+                await self.socket.recv_multipart(copy=False))
+        except ValueError:
+            ## Any peer can connect: don't let it stop the server
+            logger.warning("Dropping a malformed message")
+            return
+        task = asyncio.ensure_future(
+            self._reply(envelope, frames, time.time()))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _reply(self, envelope, frames, received_at=None):
+        reply = await self._handle_frames(frames, received_at)
+        started = time.time()
+        await self.socket.send_multipart(envelope + reply, copy=False)
+        if self.record_timings:
+            self.phase_timings.add([('send', time.time() - started)])
+
+    async def _handle_frames(self, frames, received_at=None):
+        """Unpack a (multipart) message, process it and return the reply"""
+        try:
+            request = self._unpack_request(frames, received_at)
+            if self._expired(request):
+                return self._expired_reply(request)
+            if not self.dedup_max_entries or request._raw.get('i') is None:
+                return await self._handle_request(request)
+            return await self._handle_once(request, self._dedup_key(request))
+        except (ProtocolMismatch, UnsupportedSerializer,
+                CompressionError) as e:
+            return self._error_reply(frames, e)
+        except Exception as e:
+            logger.exception('Exception while handling a message')
+            return self._error_reply(frames, e)
+
+    async def _handle_once(self, request, key):
+        """Process a request, unless it is a retry of a previous one"""
+        future = asyncio.get_event_loop().create_future()
+        previous = self.dedup.begin(key, future)
+        if previous is not None:
+            logger.debug("Retried request, sending the previous reply")
+            try:
+                reply = await asyncio.wait_for(
+                    asyncio.shield(previous), self.dedup_ttl)
+            except asyncio.TimeoutError:
+                reply = None
+            if reply is None:
+                return self._failed_reply(request)
+            return reply
+        try:
+            reply = await self._handle_request(request)
+        except Exception:
+            self.dedup.discard(key)
+            future.set_result(None)
+            raise
+        future.set_result(reply)
+        self.dedup.finish(key, sum(len(frame) for frame in reply))
+        return reply
+
+    async def _handle_request(self, request):
+        response = await self._process_request(request)
+        return self._pack_response(request, response)
+
+    async def _process_request(self, request):
+        """Process a received request, awaiting coroutines as needed"""
+
+        logger.debug("Processing request")
+
+        handler = self._request_handler(request)
+        if handler is not None:
+            return await maybe_await(handler(request))
+
+        method, message = await self._prepare_call(request)
+        if message is not None:
+            return message
+        return await self._run_call(request, method)
+
+    async def _process_batch(self, request):
+        ## Calls in a batch are independent: let them run concurrently
+        return self._response_message(list(await asyncio.gather(*[
+            self._process_request(call) for call in request.split_batch()])))
+
+    async def _prepare_call(self, request):
+        method, exception = self._lookup_method(request)
+        try:
+            await self._exec_pre_middleware(request, method)
+        except Exception as e:
+            method, message = self._pre_middleware_failed(e)
+            if message is not None:
+                return None, message
+            exception = None
+        return self._checked_method(method, exception)
+
+    async def _run_call(self, request, method):
+        try:
+            response = await maybe_await(self._wrapped_method(
+                request, method)(request, *request.args, **request.kwargs))
+        except Exception as e:
+            logger.exception('Exception during execution of request')
+            response, exception = None, e
+        else:
+            exception = None
+        if request.timings is not None:
+            request.mark('method')
+
+        try:
+            response = await self._exec_post_middleware(
+                request, method, response, exception)
+        except Exception as e:
+            return self._post_middleware_failed(e)
+
+        ## (Async) generators are streamed, a chunk at a time
+        if exception is None and (inspect.isgenerator(response) or
+                                  inspect.isasyncgen(response)):
+            return await self._open_stream(request, response)
+        return self._call_message(response, exception)
+
+    async def _start_upload(self, request):
+        position, upload_id = request.upload_argument
+        pending = self._upload_call(request, position)
+        method, message = await self._prepare_call(pending.request)
+        if message is not None:
+            pending.close()
+            return message
+        return self._open_upload(pending, upload_id, method)
+
+    async def _receive_chunks(self, request):
+        ## Uploads are spooled: the method runs once they are complete
+        response = self._store_chunks(request)
+        if response is None:
+            pending = self.uploads.pop(request.upload)
+            try:
+                response = await self._run_call(
+                    pending.request, pending.method)
+            finally:
+                pending.upload.close()
+        return response
+
+    async def _open_stream(self, request, generator):
+        stream_id = self.streams.open(generator)
+        return await self._stream_message(
+            stream_id, generator, request.credit or self.stream_credit)
+
+    async def _pull_stream(self, request):
+        try:
+            generator = self.streams.get(request.stream)
+        except KeyError as e:
+            return self._exception_message(e)
+        if not request.credit:
+            if inspect.isasyncgen(generator):
+                await generator.aclose()
+            self.streams.close(request.stream)
+            return {'s': request.stream, 'c': [], 'end': True}
+        return await self._stream_message(
+            request.stream, generator, request.credit)
+
+    async def _stream_message(self, stream_id, generator, credit):
+        if not inspect.isasyncgen(generator):
+            return super(AsyncServer, self)._stream_message(
+                stream_id, generator, credit)
+        items = []
+        message = {'s': stream_id, 'c': items}
+        try:
+            while len(items) < credit:
+                items.append(await generator.__anext__())
+        except StopAsyncIteration:
+            message['end'] = True
+        except Exception as e:
+            logger.exception('Exception while streaming a response')
+            message.update(self._exception_message(e))
+        if 'end' in message or 'e' in message:
+            self.streams.close(stream_id)
+        return message
+
+    async def _exec_pre_middleware(self, request, method):
+        for pre in self._middleware.pre_hooks(request._raw.get('m')):
+            await maybe_await(pre(request, method))
+            if request.timings is not None:
+                request.mark(_hook_phase('pre', pre))
+
+    async def _exec_post_middleware(self, request, method, response,
+                                    exception):
+        for post in self._middleware.post_hooks(request._raw.get('m')):
+            retval = await maybe_await(
+                post(request, method, response, exception))
+            if retval is not None:
+                response = retval
+            if request.timings is not None:
+                request.mark(_hook_phase('post', post))
+        return response
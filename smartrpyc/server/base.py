@@ -3,54 +3,363 @@ Base objects for the RPC
 """
 
 import logging
+import time
+import types
 
 import zmq
 
 from smartrpyc.utils import lazy_property
-from smartrpyc.utils.serialization import MsgPackSerializer
+from smartrpyc.utils.compression import COMPRESSED_MARKER, \
+    CompressionError, compress_frame, decompress_frames, get_codec
+from smartrpyc.utils.frames import _frame_bytes, pack_frames, unpack_frames
+from smartrpyc.utils.middleware import MiddlewareChain
+from smartrpyc.utils.protocol import PROTOCOL_METHOD, V2_MARKER, \
+    MethodsTable, ProtocolMismatch, decode_request_header, encode_reply, \
+    is_v2
+from smartrpyc.utils.serialization import SERIALIZER_MARKER, \
+    MsgPackSerializer, UnsupportedSerializer, get_serializer, tag_frames, \
+    untag_frames
 from .register import MethodsRegister
-from .exceptions import DirectResponse, SetMethod
+from .exceptions import DeadlineExceeded, DirectResponse, SetMethod
+from .middleware import ServerMiddlewareBase
+from .dedup import DedupTable, PendingReply, request_fingerprint
+from .streams import SpooledUpload, StreamsTable, UploadCall
+from .timings import PhaseTimings
 
 __all__ = ['Server', 'Request']
 
 logger = logging.getLogger(__name__)
 
+## Leading bytes of the messages to be untagged, decompressed or decoded
+## with the compact protocol: any other one is a plain request
+_MARKERS = frozenset([SERIALIZER_MARKER, COMPRESSED_MARKER, V2_MARKER])
+
+## Milliseconds idle servers wait for requests, before checking for
+## abandoned streams
+_IDLE_TIMEOUT = 1000
+
+
+def _hook_phase(kind, hook):
+    """Name of the phase of a middleware hook, for the timings"""
+    owner = getattr(hook, '__self__', None)
+    if owner is None:
+        return '{0}:{1}'.format(kind, getattr(hook, '__name__', '?'))
+    return '{0}:{1}'.format(kind, type(owner).__name__)
+
 
 class Request(object):
-    """Wrapper for requests from the RPC"""
+    """
+    Wrapper for requests from the RPC
+
+    The arguments of calls received with the compact protocol are
+    decoded only when first needed (eg. by the method): middleware
+    rejecting calls before that never pays for it.
+
+    .. py:attribute:: server
+
+        The server that received the request
+
+    .. py:attribute:: protocol
+
+        Version of the protocol the request was received with
+        (replies use the same one)
+
+    .. py:attribute:: packer
+
+        The serializer the request was packed with (replies use
+        the same one)
+
+    .. py:attribute:: received_at
+
+        Time (as returned by ``time.time()``) at which the request
+        was received
+
+    .. py:attribute:: size
 
-    server = None
+        Size of the request, in bytes (``None`` if unknown)
 
-    def __init__(self, raw):
+    .. py:attribute:: timings
+
+        List of the ``(phase, seconds)`` pairs of the phases of the
+        request processing (see :py:meth:`mark`); ``None`` unless
+        timings are recorded by the server, or asked by the client
+
+    .. py:attribute:: reply_meta
+
+        Metadata to be sent to the client along with the reply
+        (eg. cache hints); ``None`` when there is none
+
+    .. py:attribute:: context
+
+        Dictionary for middleware to keep per-request state in
+        (eg. from ``pre()`` to ``post()``), as requests have no
+        ``__dict__``
+    """
+
+    __slots__ = ('_raw', '_arguments', 'server', 'protocol', 'packer',
+                 'received_at', 'size', 'timings', '_marked_at', 'reply_meta',
+                 'context')
+
+    def __init__(self, raw, arguments=None):
         """
         :param raw: The (unpacked) content of the request
+        :param arguments:
+            function returning the (still undecoded) ``'a'``
+            and ``'k'`` keys of the request, if missing from ``raw``
+        """
+        self._raw = raw
+        self._arguments = arguments
+        self.server = None
+        self.protocol = 1
+        self.packer = None
+        self.received_at = None
+        self.size = None
+        self.timings = None
+        self._marked_at = None
+        self.reply_meta = None
+        self.context = {}
+
+    def mark(self, phase):
+        """
+        Record the end of a phase of the request processing, that
+        started at the end of the previous one (if timings are enabled)
+        """
+        timings = self.timings
+        if timings is not None:
+            now = time.time()
+            timings.append((phase, now - self._marked_at))
+            self._marked_at = now
+
+    def start_timings(self, started=None):
+        """Start recording the timings of the phases"""
+        self.timings = []
+        self._marked_at = started or time.time()
+
+    @property
+    def raw(self):
+        """The (unpacked) content of the request, arguments included"""
+        if self._arguments is not None:
+            arguments, self._arguments = self._arguments, None
+            self._raw.update(arguments())
+        return self._raw
+
+    def get(self, key, default=None):
         """
-        self.raw = raw
+        Get a key of the (unpacked) request; unlike :py:attr:`raw`,
+        the arguments are decoded only if asked for.
+        """
+        if key in ('a', 'k'):
+            return self.raw.get(key, default)
+        return self._raw.get(key, default)
 
     @property
     def id(self):
         """Id of the request"""
-        return self.raw["i"]
+        return self._raw["i"]
 
     @property
     def method(self):
         """Name of the method to be called"""
-        return self.raw['m']
+        return self._raw['m']
 
     @property
     def args(self):
         """Positional arguments for the called method"""
-        return self.raw.get('a') or ()
+        raw = self._raw if self._arguments is None else self.raw
+        return raw.get('a') or ()
 
     @property
     def kwargs(self):
         """Keyword arguments for the called method"""
-        return self.raw.get('k') or {}
+        raw = self._raw if self._arguments is None else self.raw
+        return raw.get('k') or {}
+
+    @property
+    def stream(self):
+        """Id of the stream to pull items from (``None`` for calls)"""
+        return self._raw.get('s')
+
+    @property
+    def credit(self):
+        """Number of stream items the client is willing to receive"""
+        return self._raw.get('n')
+
+    @property
+    def upload(self):
+        """Id of the upload the chunks belong to (``None`` for calls)"""
+        return self._raw.get('u')
+
+    @property
+    def chunks(self):
+        """Chunks of the upload carried by the request"""
+        return self._raw.get('c') or ()
+
+    @property
+    def upload_argument(self):
+        """
+        ``(position, upload id)`` of the argument to be uploaded;
+        position is an index for positional arguments, or a name
+        for keyword arguments.
+        """
+        return self._raw.get('ua')
+
+    @property
+    def deadline(self):
+        """
+        Time (as returned by ``time.time()``) by which the client expects
+        the reply, if it set one; methods making calls to other servers
+        can pass it on to their clients (see ``Client.deadline``).
+
+        It is counted from :py:attr:`received_at`: unless the server
+        trusts the clocks of clients (see ``Server.max_clock_skew``),
+        the time the request spent before being received (in the network,
+        in socket buffers, or waiting for a broker to read it) is not
+        accounted for, and the deadline is later than the client's.
+        """
+        raw = self._raw
+        budget = raw.get('d')
+        if budget is None or self.received_at is None:
+            return None
+        deadline = self.received_at + budget
+        skew = self.server.max_clock_skew if self.server is not None \
+            else None
+        if skew is not None and raw.get('D') is not None:
+            ## The deadline of the client, as far as the clocks agree
+            deadline = min(deadline, raw['D'] + skew)
+        return deadline
+
+    @property
+    def remaining(self):
+        """
+        Seconds left before the deadline (``None`` if there is none);
+        see :py:attr:`deadline` for its limits
+        """
+        deadline = self.deadline
+        if deadline is None:
+            return None
+        return deadline - time.time()
+
+    @property
+    def cached_etag(self):
+        """
+        Validator of the result the client has in its cache, if any:
+        when it matches the ``etag`` set with :py:meth:`set_cache_hints`,
+        the client is told to keep using it, instead of receiving
+        the result again.
+        """
+        return self._raw.get('v')
+
+    def set_cache_hints(self, max_age=None, etag=None):
+        """
+        Allow the client to cache the result of the call.
+
+        :param max_age:
+            seconds for which the client may reuse the result,
+            without asking the server again.
+        :param etag:
+            validator of the result (eg. a version number); once
+            ``max_age`` expired, the client asks whether its copy
+            is still valid, and gets a (short) "not modified" reply
+            if the etag did not change.
+        """
+        if self.reply_meta is None:
+            self.reply_meta = {}
+        if max_age is not None:
+            self.reply_meta['max_age'] = max_age
+        if etag is not None:
+            self.reply_meta['etag'] = etag
+
+    @property
+    def batch(self):
+        """List of the calls in a batch request (``None`` otherwise)"""
+        return self._raw.get('b')
+
+    def split_batch(self):
+        """
+        Split a batch request in a request for each call.
+        Each of them inherits everything but the method and
+        its arguments (eg. authentication token) from the batch.
+        """
+        for call in self.batch:
+            raw = dict(self.raw)
+            del raw['b']
+            raw.update(call)
+            request = type(self)(raw)
+            request.server = self.server
+            request.packer = self.packer
+            request.received_at = self.received_at
+            request.timings = self.timings
+            request._marked_at = self._marked_at
+            yield request
 
 
 class Server(object):
     request_class = Request
+    #: Default serializer, for untagged messages (see ``serializers``)
     packer = MsgPackSerializer
+    socket_type = zmq.REP
+
+    #: Results (bytes, bytearray or memoryview) larger than this are
+    #: sent in their own frame, without copying them. ``None`` disables it.
+    zero_copy_threshold = 1 << 20
+
+    #: Number of items sent along with the reply opening a stream,
+    #: unless the client asked for a different amount
+    stream_credit = 16
+
+    #: Seconds after which streams not pulled by clients are closed
+    #: (as well as uploads left unfinished)
+    stream_timeout = 60.0
+
+    #: Bytes of uploaded data to be kept in memory, before spooling
+    #: them to a temporary file
+    upload_spool_size = 8 << 20
+
+    #: Number of recent replies kept to answer retried requests (with
+    #: the same id, and the same contents) without running them again;
+    #: ``0`` (the default) disables it
+    dedup_max_entries = 0
+
+    #: Seconds for which replies are kept for retried requests
+    dedup_ttl = 30.0
+
+    #: Bytes of replies kept for retried requests: the oldest ones are
+    #: dropped past that, and larger replies are not kept at all
+    dedup_max_bytes = 64 << 20
+
+    #: Highest protocol version supported (see
+    #: :py:mod:`smartrpyc.utils.protocol`); ``1`` disables the compact one
+    protocol_version = 2
+
+    #: Other serializers accepted from clients, besides ``packer``:
+    #: those tagging their messages with one of them (see
+    #: :py:mod:`smartrpyc.utils.serialization`) get their replies
+    #: packed with the same one
+    serializers = ()
+
+    #: Names of the compression codecs accepted from clients (see
+    #: :py:mod:`smartrpyc.utils.compression`); ``None`` for all of
+    #: the registered ones, an empty list disables compression
+    compression_codecs = None
+
+    #: Replies are compressed only when larger than this (in bytes)
+    compression_threshold = 16 << 10
+
+    #: Compressed requests larger than this (in bytes) once decompressed
+    #: are refused, without decompressing them any further
+    max_decompressed_size = 64 << 20
+
+    #: Maximum difference (in seconds) between the clocks of the clients
+    #: and the one of the server, if known to be synchronized (eg. with
+    #: NTP): the deadlines of requests are then capped to the absolute
+    #: ones set by the clients, plus this leeway, covering the time spent
+    #: before being received. ``None`` to rely on the time budgets alone.
+    max_clock_skew = None
+
+    #: Whether to record the timings of the phases of all the requests,
+    #: aggregated in ``phase_timings`` (otherwise, only those of the
+    #: requests of clients asking for them are recorded, and sent back)
+    record_timings = False
 
     def __init__(self, methods=None):
         """
@@ -67,12 +376,53 @@ class Server(object):
         if self.methods is None:
             self.methods = MethodsRegister()
 
-        self.middleware = []  # Middleware chain
+        self.middleware = []
+
+    @property
+    def middleware(self):
+        """
+        The middleware chain, as a :py:class:`.MiddlewareChain`
+        (assigned lists are converted)
+        """
+        return self._middleware
+
+    @middleware.setter
+    def middleware(self, value):
+        self._middleware = MiddlewareChain(value, ServerMiddlewareBase)
 
     @lazy_property
     def socket(self):
         context = zmq.Context()
-        return context.socket(zmq.REP)
+        return context.socket(self.socket_type)
+
+    @lazy_property
+    def streams(self):
+        """The :py:class:`.StreamsTable` of the streams being sent"""
+        return StreamsTable(timeout=self.stream_timeout)
+
+    @lazy_property
+    def uploads(self):
+        """The :py:class:`.StreamsTable` of the uploads being received"""
+        return StreamsTable(timeout=self.stream_timeout)
+
+    @lazy_property
+    def methods_tables(self):
+        """
+        The :py:class:`.MethodsTable` objects sent to clients
+        negotiating the compact protocol, by id
+        """
+        return {}
+
+    @lazy_property
+    def phase_timings(self):
+        """The :py:class:`.PhaseTimings` of the requests"""
+        return PhaseTimings()
+
+    @lazy_property
+    def dedup(self):
+        """The :py:class:`.DedupTable` of the recent replies"""
+        return DedupTable(
+            self.dedup_max_entries, self.dedup_ttl, self.dedup_max_bytes)
 
     def bind(self, addresses):
         """
@@ -107,84 +457,549 @@ class Server(object):
     def run(self):
         """Start the server listening loop"""
         while True:
-            self.run_once()
+            ## Wake up now and then, to close abandoned streams
+            if self.socket.poll(_IDLE_TIMEOUT):
+                self.run_once()
+            self._expire_streams()
 
     def run_once(self):
         """Run once: process a request and send a response"""
-        message_raw = self.socket.recv()
-        request = self.request_class(self.packer.unpackb(message_raw))
-        request.server = self
+        frames = self.socket.recv_multipart(copy=False)
+        reply = self._handle_frames(frames, time.time())
+        self._send_reply(self.socket, reply)
+
+    def _expire_streams(self):
+        """Close the streams and uploads abandoned by clients"""
+        self.streams.expire()
+        self.uploads.expire()
+
+    def _send_reply(self, socket, reply):
+        if not self.record_timings:
+            socket.send_multipart(reply, copy=False)
+            return
+        started = time.time()
+        socket.send_multipart(reply, copy=False)
+        self.phase_timings.add([('send', time.time() - started)])
+
+    def _handle_frames(self, frames, received_at=None, envelope=None):
+        """
+        Unpack a (multipart) message, process it and return the reply
+
+        :param received_at:
+            time at which the message was received, if known
+        :param envelope:
+            routing envelope of the message (for ROUTER sockets):
+            retries of requests still running are then attached to them,
+            to be sent their reply (see :py:meth:`_reply_waiters`),
+            and ``None`` is returned (as for the requests the server
+            replies to later, on its own)
+        """
+        try:
+            request = self._unpack_request(frames, received_at)
+        except (ProtocolMismatch, UnsupportedSerializer,
+                CompressionError), e:
+            return self._error_reply(frames, e)
+        if self._expired(request):
+            return self._expired_reply(request)
+        if not self.dedup_max_entries or request._raw.get('i') is None:
+            return self._handle_request(request)
+
+        key = self._dedup_key(request)
+        pending = PendingReply()
+        previous = self.dedup.begin(key, pending)
+        if previous is not None:
+            logger.debug("Retried request, sending the previous reply")
+            return self._replay(request, previous, envelope)
+        try:
+            reply = self._handle_request(request)
+        except:
+            self.dedup.discard(key)
+            self._reply_waiters(pending.set(None), None)
+            raise
+        if reply is None:
+            ## Replied later, by the server itself: retries run again
+            self.dedup.discard(key)
+            self._reply_waiters(pending.set(None), None)
+            return None
+        waiters = pending.set(reply)
+        self.dedup.finish(key, sum(len(frame) for frame in reply))
+        if waiters:
+            self._reply_waiters(waiters, reply)
+        return reply
+
+    def _dedup_key(self, request):
+        """
+        Key of a request in the :py:attr:`dedup` table: retries must
+        not only reuse the id, but ask for the very same thing (a reply
+        is never sent to a request calling another method, or made
+        with another token)
+        """
+        return request._raw['i'], request_fingerprint(request.raw)
+
+    def _handle_request(self, request):
+        """Process an (unpacked) request, returning the packed reply"""
         response = self._process_request(request)
-        self.socket.send(self.packer.packb(response))
+        return self._pack_response(request, response)
+
+    def _replay(self, request, previous, envelope=None):
+        """
+        Reply to a retried request, with the reply to the first attempt.
+        If still running, the retry is attached to it when its routing
+        ``envelope`` is known (returning ``None``), else waits for it.
+        """
+        if envelope is not None and previous.add_waiter((envelope, request)):
+            return None
+        reply = previous.wait(self.dedup_ttl)
+        if reply is None:
+            return self._failed_reply(request)
+        return reply
+
+    def _failed_reply(self, request):
+        """Reply to a retried request whose first attempt failed"""
+        return self._pack_response(request, self._exception_message(
+            RuntimeError("The first attempt of the request failed, "
+                         "or is still running")))
+
+    def _reply_waiters(self, waiters, reply):
+        """
+        Send a reply (``None`` if the request failed) to the retries
+        attached to the request, as ``(envelope, request)`` pairs.
+        Only servers passing envelopes to :py:meth:`_handle_frames`
+        get any, so there is nothing to do here.
+        """
+
+    def _expired(self, request):
+        if 'd' not in request._raw:
+            return False
+        remaining = request.remaining
+        return remaining is not None and remaining <= 0
+
+    def _expired_reply(self, request):
+        """
+        Reply to a request whose client gave up already (checked before
+        deduplication: retries, as the Lazy client ones, come with
+        a new deadline)
+        """
+        logger.debug("Skipping request past its deadline")
+        return self._pack_response(request, self._exception_message(
+            DeadlineExceeded("Deadline exceeded before processing")))
+
+    def _unpack_request(self, frames, received_at=None):
+        started = time.time()
+        size = sum(map(len, frames))
+        if _frame_bytes(frames[0])[:1] not in _MARKERS:
+            packer = self.packer
+            request = self.request_class(unpack_frames(packer, frames))
+        else:
+            serializer_id, frames = untag_frames(frames)
+            packer = self._get_packer(serializer_id)
+            frames = decompress_frames(
+                frames, self._accepts_codec, self.max_decompressed_size)
+            if is_v2(frames):
+                ## Arguments are decoded only when needed
+                request = self.request_class(*decode_request_header(
+                    packer, frames, self._get_methods_table))
+                request.protocol = 2
+            else:
+                request = self.request_class(unpack_frames(packer, frames))
+        request.server = self
+        request.packer = packer
+        request.received_at = received_at or started
+        request.size = size
+        if self.record_timings or 'T' in request._raw:
+            request.start_timings(started)
+            if received_at is not None:
+                ## Time spent waiting (eg. queued for a worker thread)
+                request.timings.append(('queue', started - received_at))
+            request.mark('unpack')
+        return request
+
+    def _get_packer(self, serializer_id):
+        """The serializer for messages tagged with ``serializer_id``"""
+        if serializer_id is None:
+            return self.packer
+        packer = get_serializer(serializer_id)
+        if packer is None or (packer is not self.packer and
+                              packer not in self.serializers):
+            raise UnsupportedSerializer(
+                "Unsupported serializer: {0}".format(serializer_id),
+                serializer_id)
+        return packer
+
+    def _error_reply(self, frames, exception):
+        """
+        Reply with an exception to a message that could not be handled
+        (eg. one referring to an unknown methods table), packed with
+        the serializer of the message if possible
+        """
+        response = self._exception_message(exception)
+        request_id = getattr(exception, 'request_id', None)
+        if request_id is not None:
+            response['i'] = request_id
+        serializer_id, _ = untag_frames(frames)
+        packer = get_serializer(serializer_id) or self.packer
+        return tag_frames(pack_frames(packer, response), packer)
+
+    def _pack_response(self, request, response):
+        raw = request._raw
+        if raw.get('i') is not None:
+            ## Echo the id, allowing clients to match replies to requests
+            response['i'] = raw['i']
+        if request.reply_meta:
+            response['h'] = request.reply_meta
+            etag = request.reply_meta.get('etag')
+            if 'r' in response and etag is not None and \
+                    etag == request.cached_etag:
+                ## The client copy is still good: skip the payload
+                del response['r']
+                response['nm'] = True
+        if raw.get('p') is not None:
+            ## Negotiation sent along with a call
+            response['p'] = self._negotiation(raw['p'])
+        if raw.get('T'):
+            response['T'] = request.timings
+        ## Only clients asking for it can handle multipart replies
+        threshold = self.zero_copy_threshold if raw.get('f') else None
+        packer = request.packer or self.packer
+        frames = None
+        if request.protocol == 2:
+            frames = encode_reply(packer, response, threshold)
+        if frames is None:
+            frames = pack_frames(packer, response, threshold)
+        codec = self._reply_codec(request) if 'z' in raw else None
+        if codec is not None:
+            frames[0] = compress_frame(
+                frames[0], codec, self.compression_threshold)
+        if packer is not MsgPackSerializer:
+            frames = tag_frames(frames, packer)
+        if request.timings is not None:
+            request.mark('pack')
+            if self.record_timings:
+                self.phase_timings.add(request.timings)
+        return frames
+
+    def _reply_codec(self, request):
+        """The codec to compress the reply with, if any"""
+        codec_id = request._raw.get('z')
+        if not codec_id:
+            return None
+        codec = get_codec(codec_id)
+        if codec is None or not self._accepts_codec(codec.name):
+            return None
+        return codec
+
+    def _accepts_codec(self, name):
+        if self.compression_codecs is None:
+            return get_codec(name) is not None
+        return name in self.compression_codecs
 
     def _process_request(self, request):
         """Process a received request"""
 
         logger.debug("Processing request")
 
-        exception = None
-        method = None
+        handler = self._request_handler(request)
+        if handler is not None:
+            return handler(request)
+
+        method, message = self._prepare_call(request)
+        if message is not None:
+            return message
+        return self._run_call(request, method)
+
+    def _request_handler(self, request):
+        """
+        The method handling requests other than plain calls (eg. pulling
+        the items of a stream), or ``None`` for plain calls
+        """
+        raw = request._raw
+        if 'm' in raw:
+            ## Calls: only a few need special handling
+            if 'ua' in raw:
+                return self._start_upload
+            if raw['m'] == PROTOCOL_METHOD:
+                return self._negotiate
+            return None
+        if raw.get('s') is not None:
+            return self._pull_stream
+        if raw.get('u') is not None:
+            return self._receive_chunks
+        if raw.get('b') is not None:
+            return self._process_batch
+        return None
+
+    def _prepare_call(self, request):
+        """
+        Look up the method to be called and run the PRE middleware.
+
+        :return:
+            ``(method, message)``: the message is the one to reply with
+            right away, if any (eg. the middleware rejected the call)
+        """
+        method, exception = self._lookup_method(request)
+        try:
+            self._exec_pre_middleware(request, method)
+        except Exception, e:
+            method, message = self._pre_middleware_failed(e)
+            if message is not None:
+                return None, message
+            exception = None  # Clear exceptions happened before..
+        return self._checked_method(method, exception)
+
+    def _run_call(self, request, method):
+        """Call the method, run the POST middleware and build the reply"""
+        try:
+            response = self._wrapped_method(request, method)(
+                request, *request.args, **request.kwargs)
+        except Exception, e:
+            logger.exception('Exception during execution of request')
+            response, exception = None, e
+        else:
+            exception = None
+        if request.timings is not None:
+            request.mark('method')
 
-        ## Lookup the requested method
         try:
-            method = self.methods.lookup(request.method)
+            response = self._exec_post_middleware(
+                request, method, response, exception)
+        except Exception, e:
+            return self._post_middleware_failed(e)
+
+        ## Generators are streamed, a chunk at a time
+        if exception is None and isinstance(response, types.GeneratorType):
+            return self._open_stream(request, response)
+        return self._call_message(response, exception)
+
+    ## Steps of the calls shared with servers running them differently
+    ## (eg. awaiting coroutines)
+
+    def _lookup_method(self, request):
+        """Look up the requested method: ``(method, exception)``"""
+        try:
+            method, exception = self.methods.lookup(request.method), None
         except KeyError:
             msg = 'No such method: {0}'.format(request.method)
             logger.error(msg)
-            exception = KeyError(msg)
+            method, exception = None, KeyError(msg)
+        if request.timings is not None:
+            request.mark('lookup')
+        return method, exception
 
-        ## Execute all the PRE middleware on the request
-        try:
-            self._exec_pre_middleware(request, method)
+    def _wrapped_method(self, request, method):
+        """The method, as wrapped by the ``wrap()`` middleware hooks"""
+        for wrap in self._middleware.wrap_hooks(request._raw.get('m')):
+            method = wrap(request, method) or method
+        return method
 
-        except DirectResponse, e:
+    def _pre_middleware_failed(self, exception):
+        """
+        Handle an exception raised by the PRE middleware:
+        ``(method, message)``, as for :py:meth:`_prepare_call`
+        """
+        if isinstance(exception, DirectResponse):
             logger.debug("A PRE middleware requested to send a response now")
-            return self._response_message(e.response)
-
-        except SetMethod, e:
+            return None, self._response_message(exception.response)
+        if isinstance(exception, SetMethod):
             logger.debug("A PRE middleware changed the method to be called")
-            method = e.method
-            exception = None  # Clear exceptions happened before..
-
-        except Exception, e:
-            logger.exception('Exception during execution of PRE middleware')
-            return self._exception_message(e)
+            return exception.method, None
+        logger.exception('Exception during execution of PRE middleware')
+        return None, self._exception_message(exception)
 
-        ## If the method is still None, return the current exception
+    def _checked_method(self, method, exception):
+        """``(method, message)``, the message being an error if no method"""
         if method is None:
             if exception is None:
                 exception = KeyError("No such method")
+            return None, self._exception_message(exception)
+        return method, None
+
+    def _post_middleware_failed(self, exception):
+        """The message replying to an exception of the POST middleware"""
+        if isinstance(exception, DirectResponse):
+            logger.info(
+                "A POST middleware requested immediate returning "
+                "of a response")
+            return self._response_message(exception.response)
+        logger.exception('Exception during execution of POST middleware')
+        return self._exception_message(exception)
+
+    def _call_message(self, response, exception):
+        """The message replying to a call (but streams)"""
+        if exception is not None:
             return self._exception_message(exception)
+        return self._response_message(response)
 
-        ## Execute the method
+    def _open_stream(self, request, generator):
+        """Register a stream, replying with its first chunk"""
+        stream_id = self.streams.open(generator)
+        return self._stream_message(
+            stream_id, generator, request.credit or self.stream_credit)
+
+    def _pull_stream(self, request):
+        """
+        Reply to a pull request with the next chunk of a stream.
+        Pulling with no credit closes the stream.
+        """
         try:
-            response = method(request, *request.args, **request.kwargs)
+            generator = self.streams.get(request.stream)
+        except KeyError, e:
+            return self._exception_message(e)
+        if not request.credit:
+            self.streams.close(request.stream)
+            return {'s': request.stream, 'c': [], 'end': True}
+        return self._stream_message(request.stream, generator, request.credit)
+
+    def _stream_message(self, stream_id, generator, credit):
+        """
+        Build a message with the next ``credit`` items of a stream,
+        marking the end of the stream, or the exception it raised.
+        """
+        items = []
+        message = {'s': stream_id, 'c': items}
+        try:
+            for item in generator:
+                items.append(item)
+                if len(items) >= credit:
+                    break
+            else:
+                message['end'] = True
         except Exception, e:
-            logger.exception('Exception during execution of request')
-            response = None
-            exception = e
+            logger.exception('Exception while streaming a response')
+            message.update(self._exception_message(e))
+        if 'end' in message or 'e' in message:
+            self.streams.close(stream_id)
+        return message
+
+    def _start_upload(self, request):
+        """
+        Prepare a call with an uploaded argument, replacing it with an
+        iterator over the chunks, and tell the client to send them.
+        The PRE middleware runs first: calls it rejects never get
+        to receive any chunk.
+        """
+        position, upload_id = request.upload_argument
+        pending = self._upload_call(request, position)
+        method, message = self._prepare_call(pending.request)
+        if message is not None:
+            pending.close()
+            return message
+        return self._open_upload(pending, upload_id, method)
+
+    def _upload_call(self, request, position):
+        """The :py:class:`.UploadCall` for a call with an uploaded argument"""
+        raw = dict(request.raw)
+        del raw['ua']
+        upload = self._new_upload()
+        if isinstance(position, basestring):
+            raw['k'] = dict(raw.get('k') or {})
+            raw['k'][position] = upload
         else:
-            exception = None
+            raw['a'] = list(raw.get('a') or ())
+            raw['a'][position] = upload
+        call = type(request)(raw)
+        call.server = self
+        call.packer = request.packer
+        call.received_at = request.received_at
+        call.size = request.size
+        return UploadCall(call, upload)
+
+    def _open_upload(self, pending, upload_id, method):
+        pending.method = method
+        self.uploads.open(pending, upload_id)
+        self._begin_upload_call(pending)
+        return {'u': upload_id}
+
+    def _new_upload(self):
+        return SpooledUpload(self.packer, self.upload_spool_size)
 
-        ## Execute all the POST middleware on request + response
+    def _begin_upload_call(self, pending):
+        """Nothing to do: the call will run once the upload is complete"""
+
+    def _receive_chunks(self, request):
+        """
+        Add the received chunks to an upload; the reply to the last
+        of them is the result of the call.
+        """
+        response = self._store_chunks(request)
+        if response is None:
+            response = self._finish_upload_call(
+                self.uploads.pop(request.upload))
+        return response
+
+    def _store_chunks(self, request):
+        """
+        Add the received chunks to an upload, returning the message
+        to be sent back (or ``None`` once the upload is complete).
+        """
         try:
-            response = self._exec_post_middleware(
-                request, method, response, exception)
-        except DirectResponse, e:
-            logger.info(
-                "A POST middleware requested immediate returning "
-                "of a response")
-            return self._response_message(e.response)
-        except Exception, e:
-            logger.exception('Exception during execution of POST middleware')
+            pending = self.uploads.get(request.upload)
+        except KeyError, e:
             return self._exception_message(e)
+        if pending.done:
+            ## The method returned without waiting for the whole upload
+            self.uploads.pop(request.upload)
+            return pending.response
+        for chunk in request.chunks:
+            pending.upload.put(chunk)
+        if not request.get('end'):
+            return {'u': request.upload}
+        pending.upload.end()
 
-        ## If there was an exception, return it as a special message
-        if exception is not None:
-            return self._exception_message(exception)
+    def _finish_upload_call(self, pending):
+        try:
+            return self._run_call(pending.request, pending.method)
+        finally:
+            pending.upload.close()
 
-        ## Return the response message
-        return self._response_message(response)
+    def _process_batch(self, request):
+        """Process each call in a batch request, as a separate request"""
+        return self._response_message([
+            self._process_request(call) for call in request.split_batch()])
+
+    def _negotiate(self, request):
+        """Reply to a client negotiating the protocol with a call"""
+        return self._response_message(self._negotiation(request.args))
+
+    def _negotiation(self, args):
+        """
+        Negotiate the protocol with a client, sending ``[versions,
+        options]``: version 2 comes with the table of the methods
+        (by index); the compression codecs supported by both sides
+        are sent back too.
+        """
+        versions = args[0] if args else [1]
+        options = args[1] if len(args) > 1 else {}
+        result = {'v': 1}
+        if 2 in versions and self.protocol_version >= 2:
+            table = self._current_methods_table()
+            if table is not None:
+                result = {'v': 2, 't': table.id, 'm': table.names}
+        codecs = [name for name in options.get('z', ())
+                  if self._accepts_codec(name)]
+        if codecs:
+            result['z'] = codecs
+        return result
+
+    def _current_methods_table(self):
+        try:
+            names = sorted(self.methods.list_methods())
+        except (AttributeError, NotImplementedError):
+            return None  # Method names unknown: no compact calls
+        table = MethodsTable(names)
+        return self.methods_tables.setdefault(table.id, table)
+
+    def _get_methods_table(self, table_id):
+        """
+        Get a methods table by id; those sent by other servers with
+        the same methods (eg. the other workers of a prefork server)
+        are rebuilt on the fly.
+        """
+        table = self.methods_tables.get(table_id)
+        if table is None:
+            table = self._current_methods_table()
+            if table is None or table.id != table_id:
+                return None
+        return table
 
     def _exception_message(self, exception):
         return {
@@ -196,14 +1011,16 @@ class Server(object):
         return {'r': response}
 
     def _exec_pre_middleware(self, request, method):
-        for mw in self.middleware:
-            if hasattr(mw, 'pre'):
-                mw.pre(request, method)
+        for pre in self._middleware.pre_hooks(request._raw.get('m')):
+            pre(request, method)
+            if request.timings is not None:
+                request.mark(_hook_phase('pre', pre))
 
     def _exec_post_middleware(self, request, method, response, exception):
-        for mw in reversed(self.middleware):
-            if hasattr(mw, 'post'):
-                retval = mw.post(request, method, response, exception)
-                if retval is not None:
-                    response = retval
+        for post in self._middleware.post_hooks(request._raw.get('m')):
+            retval = post(request, method, response, exception)
+            if retval is not None:
+                response = retval
+            if request.timings is not None:
+                request.mark(_hook_phase('post', post))
         return response
@@ -0,0 +1,167 @@
+"""
+Server-side cache of the responses of pure methods
+"""
+
+import collections
+import logging
+import threading
+import time
+import types
+
+from smartrpyc.utils import canonical
+from .exceptions import DirectResponse
+from .middleware import ServerMiddlewareBase
+
+__all__ = ['ResponseCacheMiddleware', 'cached']
+
+logger = logging.getLogger(__name__)
+
+
+def cached(fun=None, ttl=None, per_token=False):
+    """
+    Decorator for RPC methods -- cache the responses
+    (requires :py:class:`ResponseCacheMiddleware`)::
+
+        @methods.register
+        @cached(ttl=30)
+        def get_user(request, user_id):
+            ...
+
+    :param ttl:
+        seconds after which a cached response expires.
+        Defaults to the middleware ``default_ttl``.
+    :param per_token:
+        whether responses depend on the caller, and must be cached
+        separately for each authentication token (``request.token``).
+    """
+    def decorator(fun):
+        fun.cache_ttl = ttl
+        fun.cache_per_token = per_token
+        return fun
+    if fun is not None:
+        return decorator(fun)
+    return decorator
+
+
+class ResponseCacheMiddleware(ServerMiddlewareBase):
+    """
+    Cache the responses of the methods decorated with :py:func:`cached`,
+    returning them without calling the method again while fresh.
+
+    Responses are cached by method name and arguments (and token,
+    for methods cached ``per_token``); the least recently used ones
+    are evicted once the cache grows over ``max_entries`` or
+    ``max_bytes`` (as measured by the size of the packed responses).
+
+    Exceptions and streams are never cached; the cache hints set
+    by the method (see :py:meth:`.Request.set_cache_hints`) are cached
+    along with the response.
+
+    .. note::
+        Cache hits skip the ``post()`` hooks of all the middleware;
+        make sure this one comes after those that must run anyway
+        (eg. authentication checks).
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=64 << 20,
+                 default_ttl=60.0, packer=None):
+        """
+        :param packer:
+            serializer used to measure the size of the responses.
+            Defaults to the one of the server.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.packer = packer
+        self.hits = collections.Counter()  # by method name
+        self.misses = collections.Counter()
+        self._entries = collections.OrderedDict()  # key -> entry
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def pre(self, request, method):
+        if method is None or not hasattr(method, 'cache_ttl'):
+            return
+        key = self._make_key(request, method)
+        if key is None:
+            return
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                response, expires, size, reply_meta = entry
+                if expires > time.time():
+                    self._entries[key] = entry  # Most recently used
+                    self.hits[request.method] += 1
+                    if reply_meta is not None:
+                        request.reply_meta = dict(reply_meta)
+                    raise DirectResponse(response)
+                self._bytes -= size
+            self.misses[request.method] += 1
+        request.context['cache_key'] = key
+
+    def post(self, request, method, response, exception):
+        key = request.context.get('cache_key')
+        if key is None or exception is not None or \
+                isinstance(response, types.GeneratorType):
+            return
+        packer = self.packer or request.packer or request.server.packer
+        try:
+            size = len(packer.packb(response))
+        except Exception:
+            logger.warning("Unable to measure response size, not caching")
+            return
+        ttl = method.cache_ttl
+        if ttl is None:
+            ttl = self.default_ttl
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (
+                response, time.time() + ttl, size, request.reply_meta)
+            self._bytes += size
+            while self._entries and (
+                    len(self._entries) > self.max_entries or
+                    self._bytes > self.max_bytes):
+                self._bytes -= self._entries.popitem(last=False)[1][2]
+
+    def _make_key(self, request, method):
+        token = None
+        if getattr(method, 'cache_per_token', False):
+            token = getattr(request, 'token', None)
+        try:
+            key = (request.method, token, canonical(request.args),
+                   canonical(request.kwargs))
+        except TypeError:
+            return None  # Unhashable (or unsortable) arguments
+        return key
+
+    def invalidate(self, method=None, *args):
+        """
+        Drop cached responses: all of them, those of a method, or those
+        of a method whose positional arguments start with ``args``::
+
+            cache.invalidate('get_user', 42)
+
+        :return: the number of dropped entries
+        """
+        prefix = canonical(args)
+        with self._lock:
+            keys = [key for key in self._entries
+                    if method is None or (
+                        key[0] == method and
+                        key[2][:len(prefix)] == prefix)]
+            for key in keys:
+                self._bytes -= self._entries.pop(key)[2]
+        return len(keys)
+
+    def stats(self):
+        """Return the cache size, and the hit/miss counters"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': sum(self.hits.itervalues()),
+                'misses': sum(self.misses.itervalues()),
+            }
@@ -0,0 +1,228 @@
+"""
+Deduplication of retried requests
+"""
+
+import collections
+import hashlib
+import threading
+import time
+
+__all__ = ['DedupTable', 'request_fingerprint']
+
+## Keys that may change between the attempts of a request
+_VOLATILE_KEYS = frozenset(['i', 'd', 'D', 'T', 'p'])
+
+
+def request_fingerprint(raw):
+    """
+    Digest of what a request asks for: method, arguments, and anything
+    else the client added (eg. its authentication token), but not its
+    id and deadline, which may change between attempts.
+
+    :param raw: the (unpacked) request, arguments included
+    """
+    digest = hashlib.sha1()
+    _feed(digest, dict((key, value) for key, value in raw.iteritems()
+                       if key not in _VOLATILE_KEYS))
+    return digest.digest()
+
+
+def _feed(digest, value):
+    """Add a value to a digest, along with its type and length"""
+    if isinstance(value, dict):
+        items = sorted(value.iteritems(), key=lambda item: repr(item[0]))
+        digest.update('d{0}:'.format(len(items)).encode('ascii'))
+        for key, item in items:
+            _feed(digest, key)
+            _feed(digest, item)
+        return
+    if isinstance(value, (list, tuple)):
+        digest.update('l{0}:'.format(len(value)).encode('ascii'))
+        for item in value:
+            _feed(digest, item)
+        return
+    if isinstance(value, bytes):
+        kind, data = 'b', value
+    elif isinstance(value, unicode):
+        kind, data = 'u', value.encode('utf-8')
+    elif hasattr(value, 'tobytes'):
+        ## Buffers (eg. arguments sent in frames of their own), arrays
+        kind = repr((type(value), getattr(value, 'dtype', None),
+                     getattr(value, 'shape', None)))
+        data = value.tobytes()
+    else:
+        kind, data = 'r', repr((type(value), value)).encode('utf-8')
+    digest.update('{0}{1}:'.format(kind, len(data)).encode('utf-8'))
+    digest.update(data)
+
+
+class PendingReply(object):
+    """
+    Reply to a request, to be shared with its retries: they can either
+    wait for it, or be attached to it, to be sent the reply once set
+    (without tying up a thread meanwhile).
+    """
+
+    def __init__(self):
+        self.frames = None
+        self.done = False
+        self._waiters = []
+        self._event = None  # Only created if someone waits
+        self._lock = threading.Lock()
+
+    def add_waiter(self, waiter):
+        """
+        Attach a retry (eg. its routing envelope) to the request,
+        unless the reply was set already.
+
+        :return: whether the waiter was attached
+        """
+        with self._lock:
+            if self.done:
+                return False
+            self._waiters.append(waiter)
+            return True
+
+    def set(self, frames):
+        """
+        Set the (packed) reply; ``None`` if the request failed.
+
+        :return: the list of the attached waiters
+        """
+        with self._lock:
+            self.frames = frames
+            self.done = True
+            waiters, self._waiters = self._waiters, []
+            event = self._event
+        if event is not None:
+            event.set()
+        return waiters
+
+    def wait(self, timeout=None):
+        """Wait for the reply (``None`` on timeout, or failure)"""
+        with self._lock:
+            if self.done:
+                return self.frames
+            if self._event is None:
+                self._event = threading.Event()
+            event = self._event
+        event.wait(timeout)
+        return self.frames
+
+
+class DedupTable(object):
+    """
+    Replies to the recent requests, by key (the request id along
+    with the :py:func:`request_fingerprint`): a request retried
+    by the client (with the same id) gets the reply of the first
+    attempt, instead of running the method again.
+
+    Entries are kept for ``ttl`` seconds after the request completes;
+    the oldest ones are dropped once there are more than
+    ``max_entries``, or once the replies add up to more than
+    ``max_bytes`` (replies larger than that are not kept at all).
+    The table does not care what the entries are (the server stores
+    there something it can wait on).
+    """
+
+    def __init__(self, max_entries=1024, ttl=30.0, max_bytes=64 << 20):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries = {}  # key -> [pending, expires, size]
+        ## (key, entry) pairs, in order of arrival; those of entries
+        ## removed since (eg. discarded) are skipped when met
+        self._order = collections.deque()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def begin(self, key, pending):
+        """
+        Register a request about to be processed.
+
+        :return:
+            the ``pending`` entry of a previous attempt, if any
+            (leaving the table unchanged), else ``None``.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] is None or entry[1] > now:
+                    return entry[0]
+                self._pop(key)
+            entry = self._entries[key] = [pending, None, 0]  # Running
+            self._order.append((key, entry))
+            self._expire(now)
+        return None
+
+    def finish(self, key, size=0):
+        """
+        Mark a request as completed, starting its ttl
+
+        :param size: size of the reply, in bytes
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            if self.max_bytes is not None and size > self.max_bytes:
+                self._pop(key)
+                return
+            entry[1] = time.time() + self.ttl
+            entry[2] = size
+            self._bytes += size
+            while self.max_bytes is not None and self._bytes > self.max_bytes:
+                self._pop_oldest()
+
+    def discard(self, key):
+        """Forget a request (eg. because it failed)"""
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+
+    def _pop(self, key):
+        self._bytes -= self._entries.pop(key)[2]
+
+    def _oldest(self):
+        """The ``(key, entry)`` of the oldest entry (skipping removed ones)"""
+        order = self._order
+        while order:
+            key, entry = order[0]
+            if self._entries.get(key) is entry:
+                return key, entry
+            order.popleft()
+        return None, None
+
+    def _pop_oldest(self):
+        key, entry = self._oldest()
+        if entry is not None:
+            self._order.popleft()
+            self._pop(key)
+
+    def _expire(self, now):
+        while len(self._entries) > self.max_entries:
+            self._pop_oldest()
+        if len(self._order) > 2 * len(self._entries) + 64:
+            ## Many removed entries are stuck behind a running one
+            self._order = collections.deque(
+                item for item in self._order
+                if self._entries.get(item[0]) is item[1])
+        ## Entries are in order of arrival: stop at the first live one
+        while True:
+            key, entry = self._oldest()
+            if entry is None or entry[1] is None or entry[1] > now:
+                break
+            self._order.popleft()
+            self._pop(key)
+
+    @property
+    def size(self):
+        """Total size of the replies kept, in bytes"""
+        return self._bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
@@ -2,7 +2,7 @@
 Exceptions used by the Server.
 """
 
-__all__ = ['DirectResponse', 'SetMethod']
+__all__ = ['DirectResponse', 'SetMethod', 'DeadlineExceeded']
 
 
 class DirectResponse(Exception):
@@ -25,3 +25,11 @@ class SetMethod(Exception):
     """
     def __init__(self, method):
         self.method = method
+
+
+class DeadlineExceeded(Exception):
+    """
+    Sent back to clients whose request was still to be processed
+    when its deadline passed: neither the middleware nor the method
+    are run for it.
+    """
@@ -0,0 +1,243 @@
+"""
+Per-method metrics of the calls to the server
+"""
+
+import collections
+import logging
+import math
+import threading
+import time
+
+from .exceptions import DirectResponse
+from .middleware import ServerMiddlewareBase
+
+__all__ = ['MetricsMiddleware', 'Histogram']
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    """
+    Histogram with fixed, log-scale buckets: the upper bound of each one
+    is twice the previous one, from ``base`` on; larger values are
+    counted in a last, unbounded, bucket.
+    """
+
+    def __init__(self, base, buckets):
+        self.base = base
+        self.bounds = [base * 2 ** i for i in xrange(buckets)]
+        self.counts = [0] * (buckets + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        if value <= self.base:
+            index = 0
+        else:
+            mantissa, index = math.frexp(float(value) / self.base)
+            if mantissa == 0.5:  # Exactly on a bound
+                index -= 1
+            index = min(index, len(self.bounds))
+        self.counts[index] += 1
+
+    def snapshot(self):
+        """
+        The histogram as a dict: ``buckets`` is the list of
+        ``[upper bound, count]`` pairs, the last bound being ``None``
+        """
+        return {
+            'buckets': [list(item) for item in
+                        zip(self.bounds + [None], self.counts)],
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class _MethodMetrics(object):
+    __slots__ = ('calls', 'errors', 'latency', 'request_size',
+                 'response_size')
+
+    def __init__(self, middleware):
+        self.calls = 0
+        self.errors = collections.Counter()  # by exception type
+        self.latency = Histogram(*middleware.latency_buckets)
+        self.request_size = Histogram(*middleware.size_buckets)
+        self.response_size = Histogram(*middleware.size_buckets) \
+            if middleware.measure_responses else None
+
+    def snapshot(self):
+        snapshot = {
+            'calls': self.calls,
+            'errors': dict(self.errors),
+            'latency': self.latency.snapshot(),
+            'request_size': self.request_size.snapshot(),
+        }
+        if self.response_size is not None:
+            snapshot['response_size'] = self.response_size.snapshot()
+        return snapshot
+
+
+class MetricsMiddleware(ServerMiddlewareBase):
+    """
+    Record, for each method: the number of calls, the number of errors
+    by exception type, the size of the requests (and of the responses,
+    if ``measure_responses``), and the latency, from the moment the
+    request was received until the method returned.
+
+    Everything is kept in fixed-size histograms (see :py:class:`Histogram`),
+    and served to clients by two reserved methods: ``metrics()``, returning
+    a dict by method name, and ``metrics_text()``, returning the same data
+    in the Prometheus text format.
+
+    .. note::
+        Calls answered by the ``pre()`` hooks of other middleware
+        (eg. cache hits) skip the ``post()`` hooks, so they are not
+        recorded: put this middleware first to have them counted.
+    """
+
+    #: ``(base, buckets)`` of the latency histograms, in seconds
+    #: (from 10us to about 2.8 minutes)
+    latency_buckets = (1e-5, 25)
+
+    #: ``(base, buckets)`` of the size histograms, in bytes
+    #: (from 64 bytes to 1 GiB)
+    size_buckets = (64, 25)
+
+    #: Calls to methods beyond this number are recorded together,
+    #: under the ``'<other>'`` name, to keep memory use bounded
+    max_methods = 1000
+
+    def __init__(self, measure_responses=False, packer=None,
+                 method_name='metrics', text_method_name='metrics_text'):
+        """
+        :param measure_responses:
+            whether to record the size of the responses too: they are
+            packed once more for that, which is not cheap.
+        :param packer:
+            serializer used to measure the size of the responses.
+            Defaults to the one of the request.
+        :param method_name:
+            name of the method returning the metrics
+        :param text_method_name:
+            name of the method returning the metrics in the Prometheus
+            text format
+        """
+        self.measure_responses = measure_responses
+        self.packer = packer
+        self.method_name = method_name
+        self.text_method_name = text_method_name
+        self._methods = {}  # name -> _MethodMetrics
+        self._lock = threading.Lock()
+
+    def pre(self, request, method):
+        if request.method == self.method_name:
+            raise DirectResponse(self.snapshot())
+        if request.method == self.text_method_name:
+            raise DirectResponse(self.prometheus_text())
+
+    def post(self, request, method, response, exception):
+        latency = None
+        if request.received_at is not None:
+            latency = time.time() - request.received_at
+        response_size = None
+        if self.measure_responses and exception is None:
+            packer = self.packer or request.packer or request.server.packer
+            try:
+                response_size = len(packer.packb(response))
+            except Exception:
+                logger.debug("Unable to measure the response size")
+
+        with self._lock:
+            metrics = self._get_metrics(request.method)
+            metrics.calls += 1
+            if exception is not None:
+                metrics.errors[type(exception).__name__] += 1
+            if latency is not None:
+                metrics.latency.observe(latency)
+            if request.size is not None:
+                metrics.request_size.observe(request.size)
+            if response_size is not None:
+                metrics.response_size.observe(response_size)
+
+    def _get_metrics(self, name):
+        metrics = self._methods.get(name)
+        if metrics is None:
+            if len(self._methods) >= self.max_methods:
+                name = '<other>'
+                metrics = self._methods.get(name)
+            if metrics is None:
+                metrics = self._methods[name] = _MethodMetrics(self)
+        return metrics
+
+    def snapshot(self):
+        """The metrics, as a dict by method name"""
+        with self._lock:
+            return dict((name, metrics.snapshot())
+                        for name, metrics in self._methods.iteritems())
+
+    def reset(self):
+        """Forget all the recorded metrics"""
+        with self._lock:
+            self._methods.clear()
+
+    def prometheus_text(self):
+        """The metrics, in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+
+        def header(name, kind, text):
+            lines.append(u'# HELP {0} {1}'.format(name, text))
+            lines.append(u'# TYPE {0} {1}'.format(name, kind))
+
+        header('smartrpyc_calls_total', 'counter', 'RPC calls')
+        for method, metrics in sorted(snapshot.iteritems()):
+            lines.append(u'smartrpyc_calls_total{0} {1}'.format(
+                _labels(method=method), metrics['calls']))
+
+        header('smartrpyc_errors_total', 'counter',
+               'RPC calls raising an exception')
+        for method, metrics in sorted(snapshot.iteritems()):
+            for exception, count in sorted(metrics['errors'].iteritems()):
+                lines.append(u'smartrpyc_errors_total{0} {1}'.format(
+                    _labels(method=method, exception=exception), count))
+
+        for key, name, text in [
+                ('latency', 'smartrpyc_latency_seconds',
+                 'Time from the reception of requests to the end of calls'),
+                ('request_size', 'smartrpyc_request_bytes',
+                 'Size of the requests'),
+                ('response_size', 'smartrpyc_response_bytes',
+                 'Size of the responses')]:
+            histograms = [(method, metrics[key]) for method, metrics
+                          in sorted(snapshot.iteritems()) if key in metrics]
+            if not histograms:
+                continue
+            header(name, 'histogram', text)
+            for method, histogram in histograms:
+                total = 0
+                for bound, count in histogram['buckets']:
+                    total += count
+                    le = u'+Inf' if bound is None else repr(bound)
+                    lines.append(u'{0}_bucket{1} {2}'.format(
+                        name, _labels(method=method, le=le), total))
+                lines.append(u'{0}_sum{1} {2!r}'.format(
+                    name, _labels(method=method), histogram['sum']))
+                lines.append(u'{0}_count{1} {2}'.format(
+                    name, _labels(method=method), histogram['count']))
+
+        return u'\n'.join(lines) + u'\n'
+
+
+def _labels(**labels):
+    return u'{{{0}}}'.format(u','.join(
+        u'{0}="{1}"'.format(key, _escape(value))
+        for key, value in sorted(labels.iteritems())))
+
+
+def _escape(value):
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    return value.replace(u'\\', u'\\\\').replace(u'"', u'\\"') \
+        .replace(u'\n', u'\\n')
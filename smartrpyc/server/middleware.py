@@ -2,7 +2,7 @@
 Server middleware
 """
 import logging
-from smartrpyc.server import DirectResponse
+from .exceptions import DirectResponse
 
 __all__ = ['ServerMiddlewareBase', 'IntrospectionMiddleware']
 
@@ -15,9 +15,15 @@ class ServerMiddlewareBase(object):
 
     This is mostly a reminder for methods signatures, but subclassing
     from this object is not mandatory for middleware classes, as long
-    as they expose a ``pre()`` and/or ``post()`` methods.
+    as they expose ``pre()``, ``post()`` and/or ``wrap()`` methods.
+
+    Hooks not overridden by subclasses are not called at all.
     """
 
+    #: Names of the methods the middleware is to be run for
+    #: (``None`` for all of them); the others skip it entirely
+    applies_to = None
+
     def pre(self, request, method):
         """
         This method will be executed **before** the request is processed.
@@ -59,6 +65,26 @@ class ServerMiddlewareBase(object):
         """
         pass
 
+    def wrap(self, request, method):
+        """
+        This method will be executed right before the method is called,
+        once the ``pre()`` hooks of **all** the middleware have run
+        (so it can't skip any of them, unlike raising
+        :py:exc:`~smartrpyc.server.SetMethod`).
+
+        :param request:
+            a :py:class:`smartrpyc.server.Request` object
+        :param method:
+            the method about to be called (possibly already wrapped
+            by the middleware coming after this one)
+        :return:
+            a callable to be called instead, with the same arguments
+            (eg. timing or profiling the method), or ``None`` to leave
+            the method as it is. The ``post()`` hooks still get
+            the original method.
+        """
+        pass
+
 
 class IntrospectionMiddleware(object):
     """
@@ -66,6 +92,8 @@ class IntrospectionMiddleware(object):
     for introspecting the exposed methods.
     """
 
+    applies_to = frozenset(['dir', 'doc'])
+
     def pre(self, request, method):
         ## Note: this is experimental, method names may change!
         if request.method == 'dir':
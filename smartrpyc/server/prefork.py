@@ -0,0 +1,240 @@
+"""
+Pre-forked server, spreading requests across a pool of worker processes
+"""
+
+import collections
+import logging
+import multiprocessing
+import os
+import struct
+import time
+
+import zmq
+
+from smartrpyc.utils import get_random_ipc_socket, lazy_property
+from smartrpyc.utils.frames import split_envelope
+from .base import Server
+
+__all__ = ['PreforkServer']
+
+logger = logging.getLogger(__name__)
+
+WORKER_READY = b'\x01'
+
+## Time at which the broker received a request, sent to the worker
+## in a frame of its own, before the request
+ARRIVAL = struct.Struct('!d')
+
+## Settings of the server applying to the requests, passed on to the
+## servers running in the workers
+_WORKER_SETTINGS = (
+    'request_class', 'packer', 'zero_copy_threshold', 'protocol_version',
+    'serializers', 'compression_codecs', 'compression_threshold',
+    'max_decompressed_size', 'dedup_max_entries', 'dedup_ttl',
+    'dedup_max_bytes', 'max_clock_skew', 'record_timings',
+)
+
+
+def _worker_identity(pid):
+    return 'worker-{0}'.format(pid).encode('ascii')
+
+
+class PreforkServer(Server):
+    """
+    Server spreading the requests across a pool of pre-forked
+    worker processes, to make use of all the cores for CPU-bound methods.
+
+    The main process binds the public address with a ROUTER socket,
+    and acts as a load-balancing broker: each request is forwarded
+    (over ipc) to the first idle worker, and the reply routed back
+    to the client. Workers are supervised, and restarted if they die.
+    Requests are forwarded along with the time the broker read them,
+    which deadlines and the ``queue`` timing are counted from; requests
+    left queued in the socket while all the workers are busy are only
+    covered by ``max_clock_skew`` (see :py:attr:`.Request.deadline`).
+
+    Each worker runs its own instance of ``server_class``, sharing
+    the methods register and the middleware chain with this object
+    (as they were at the time of forking), as well as the settings
+    of the requests (eg. ``serializers``, ``dedup_max_entries``,
+    ``max_clock_skew``) changed on it from the :py:class:`.Server`
+    defaults. Timings (with ``record_timings``) are aggregated in the
+    ``phase_timings`` of each worker: those of this object stay empty.
+
+    .. note::
+        Workers are forked from the process calling :py:meth:`run`, so
+        methods and middleware must not hold any ZeroMQ socket created
+        before that point.
+
+    .. warning::
+        Streaming responses and uploads are not supported: requests
+        for the next items of a stream (or the next chunks of an upload)
+        may reach a worker other than the one that opened it.
+        For the same reason, retried requests are deduplicated only when
+        they reach the worker that processed the first attempt.
+    """
+
+    socket_type = zmq.ROUTER
+
+    #: Seconds between two checks for dead workers
+    supervise_interval = 1.0
+
+    def __init__(self, methods=None, processes=None, server_class=Server):
+        """
+        :param methods: see :py:class:`.Server`
+        :param processes:
+            number of worker processes to be started.
+            Defaults to the number of CPUs.
+        :param server_class:
+            the server class to be run inside the workers. Must
+            expose the same ``_handle_frames()`` method
+            as :py:class:`.Server`.
+        """
+        super(PreforkServer, self).__init__(methods)
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.server_class = server_class
+        self._workers = {}  # identity -> process
+        self._idle = collections.deque()  # identities of idle workers
+        self._last_check = 0
+        self._backend_address = get_random_ipc_socket()
+
+    @lazy_property
+    def _backend(self):
+        backend = self.socket.context.socket(zmq.ROUTER)
+        backend.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        backend.bind(self._backend_address)
+        return backend
+
+    @lazy_property
+    def _poller(self):
+        poller = zmq.Poller()
+        poller.register(self._backend, zmq.POLLIN)
+        return poller
+
+    def start_workers(self):
+        """Start the missing worker processes"""
+        self._backend  # Bind before the workers try to connect
+        for _ in xrange(self.processes - len(self._workers)):
+            self._start_worker()
+
+    def stop_workers(self):
+        """Terminate all the worker processes"""
+        for process in self._workers.itervalues():
+            process.terminate()
+        for process in self._workers.itervalues():
+            process.join()
+        self._workers.clear()
+        self._idle.clear()
+
+    def _start_worker(self):
+        process = multiprocessing.Process(target=self._worker_main)
+        process.daemon = True
+        process.start()
+        self._workers[_worker_identity(process.pid)] = process
+        logger.debug("Started worker process {0}".format(process.pid))
+
+    def supervise(self):
+        """Restart any worker process that died"""
+        for identity, process in self._workers.items():
+            if process.is_alive():
+                continue
+            logger.error("Worker {0} (pid {1}) died with exit code {2}, "
+                         "restarting".format(
+                             identity, process.pid, process.exitcode))
+            try:
+                self._idle.remove(identity)
+            except ValueError:
+                pass  # It was busy: its request is lost
+            del self._workers[identity]
+            self._start_worker()
+
+    def run(self):
+        """Start the workers and the broker loop"""
+        self.start_workers()
+        while True:
+            self.run_once(timeout=self.supervise_interval * 1000)
+
+    def run_once(self, timeout=None):
+        """
+        Wait for events and route messages between clients and workers.
+        Requests are read from clients only while there is at least
+        one idle worker, leaving the others queued in the socket.
+
+        :param timeout: poll timeout, in milliseconds
+        """
+        if not self._workers:
+            self.start_workers()
+
+        self._poller.register(self.socket, zmq.POLLIN if self._idle else 0)
+        socks = dict(self._poller.poll(timeout))
+
+        if socks.get(self._backend) == zmq.POLLIN:
+            envelope, body = split_envelope(
+                self._backend.recv_multipart(copy=False))
+            self._idle.append(envelope[0].bytes)
+            ## Replies carry the client envelope, READY messages don't
+            if len(body) > 1:
+                self.socket.send_multipart(body, copy=False)
+
+        if socks.get(self.socket) == zmq.POLLIN:
+            self._dispatch(self.socket.recv_multipart(copy=False))
+
+        if time.time() - self._last_check >= self.supervise_interval:
+            self._last_check = time.time()
+            self.supervise()
+
+    def _dispatch(self, frames):
+        """
+        Forward a request to the first idle worker still alive,
+        along with the time it was received at
+        """
+        ## Deadlines must count the time spent waiting for the worker
+        arrival = ARRIVAL.pack(time.time())
+        while self._idle:
+            try:
+                self._backend.send_multipart(
+                    [self._idle.popleft(), b'', arrival] + frames,
+                    copy=False)
+            except zmq.ZMQError, e:
+                if e.errno != zmq.EHOSTUNREACH:
+                    raise
+                ## The worker went away; supervise() will replace it
+            else:
+                return
+        logger.error("No worker available, dropping request")
+
+    def _worker_main(self):
+        """Main loop of the worker processes"""
+        server = self.server_class(self.methods)
+        server.middleware[:] = self.middleware[:]
+        for name in _WORKER_SETTINGS:
+            value = getattr(self, name)
+            if value != getattr(Server, name):
+                setattr(server, name, value)
+
+        ## Never touch the sockets inherited from the parent process
+        context = zmq.Context()
+        socket = context.socket(zmq.REQ)
+        socket.setsockopt(zmq.IDENTITY, _worker_identity(os.getpid()))
+        socket.connect(self._backend_address)
+        socket.send(WORKER_READY)
+
+        while True:
+            message = socket.recv_multipart(copy=False)
+            received_at, = ARRIVAL.unpack(message[0].bytes)
+            try:
+                envelope, frames = split_envelope(message[1:])
+            except ValueError:
+                ## Nowhere to reply to: just tell the broker we're idle
+                logger.warning("Dropping a malformed message")
+                socket.send(WORKER_READY)
+                continue
+            try:
+                reply = server._handle_frames(frames, received_at)
+            except Exception, e:
+                ## Report it to the client, instead of killing the worker
+                logger.exception('Exception while handling a message')
+                reply = server._error_reply(frames, e)
+            socket.send_multipart(envelope + reply, copy=False)
@@ -0,0 +1,121 @@
+"""
+Sampling profiler for the methods of the server
+"""
+
+import cProfile
+import pstats
+import random
+import StringIO
+import threading
+
+from .exceptions import DirectResponse
+from .middleware import ServerMiddlewareBase
+
+__all__ = ['ProfilerMiddleware']
+
+## Held while a call is being profiled: newer Pythons allow only one
+## profiler at a time in the whole process, whatever the thread
+_profiling = threading.Lock()
+
+
+class ProfilerMiddleware(ServerMiddlewareBase):
+    """
+    Profile (with :py:mod:`cProfile`) a fraction of the calls, picked
+    at random, and aggregate the statistics by method.
+
+    Statistics are served to clients by a reserved method,
+    ``profile(method=None, reset=False, sort='cumulative', limit=30,
+    rate=None)``, returning a dict by method name of the number of
+    calls profiled and the statistics report (as printed by
+    :py:mod:`pstats`), for the given method only if any. ``reset``
+    forgets the statistics once returned; ``rate`` changes
+    the ``sample_rate``.
+
+    .. note::
+        Profiled calls wrap the method once all the ``pre()`` hooks
+        have run (see :py:meth:`.ServerMiddlewareBase.wrap`), wherever
+        the middleware sits in the chain.
+        Only the calls themselves are profiled: for coroutine methods
+        (see :py:mod:`smartrpyc.server.aio`), this excludes
+        the coroutine body. One call at a time is profiled in the whole
+        process: calls sampled while another one is (or while another
+        profiler is active) just run unprofiled.
+    """
+
+    def __init__(self, sample_rate=0.01, method_name='profile'):
+        """
+        :param sample_rate: fraction of the calls to be profiled
+        :param method_name: name of the method returning the statistics
+        """
+        self.sample_rate = sample_rate
+        self.method_name = method_name
+        self._stats = {}  # method name -> [calls, pstats.Stats]
+        self._lock = threading.Lock()
+
+    def pre(self, request, method):
+        if request.method == self.method_name:
+            raise DirectResponse(self.dump(**request.kwargs))
+
+    def wrap(self, request, method):
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return None
+        return self._profiled(request.method, method)
+
+    def _profiled(self, name, method):
+        """Wrap a method, profiling its calls"""
+
+        def profiled(*args, **kwargs):
+            if not _profiling.acquire(False):
+                return method(*args, **kwargs)
+            try:
+                profile = cProfile.Profile()
+                try:
+                    profile.enable()
+                except ValueError:
+                    ## Another profiling tool is active
+                    return method(*args, **kwargs)
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    profile.disable()
+                    self._add(name, profile)
+            finally:
+                _profiling.release()
+
+        return profiled
+
+    def _add(self, name, profile):
+        with self._lock:
+            entry = self._stats.get(name)
+            if entry is None:
+                self._stats[name] = [1, pstats.Stats(profile)]
+            else:
+                entry[0] += 1
+                entry[1].add(profile)
+
+    def dump(self, method=None, reset=False, sort='cumulative', limit=30,
+             rate=None):
+        """The statistics report, by method (see above)"""
+        if rate is not None:
+            self.sample_rate = rate
+        with self._lock:
+            if method is not None:
+                names = [method] if method in self._stats else []
+            else:
+                names = list(self._stats)
+            result = {}
+            for name in names:
+                calls, stats = self._stats[name]
+                stream = StringIO.StringIO()
+                stats.stream = stream
+                stats.sort_stats(sort).print_stats(limit)
+                result[name] = {'calls': calls, 'stats': stream.getvalue()}
+            if reset:
+                for name in names:
+                    del self._stats[name]
+        return result
+
+    def reset(self):
+        """Forget all the statistics"""
+        with self._lock:
+            self._stats.clear()
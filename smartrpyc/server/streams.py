@@ -0,0 +1,265 @@
+"""
+Streaming of results produced by generator methods,
+and of arguments uploaded by clients
+"""
+
+import collections
+import logging
+import struct
+import tempfile
+import threading
+import time
+import uuid
+
+__all__ = ['StreamsTable', 'Upload', 'SpooledUpload']
+
+logger = logging.getLogger(__name__)
+
+
+class StreamsTable(object):
+    """
+    Thread-safe table of the streams open on a server, by stream id.
+
+    A stream is opened when a method returns a generator; the client
+    then pulls the items, a chunk at a time, until the generator
+    is exhausted. Streams abandoned by clients are closed once
+    they stay unused for ``timeout`` seconds.
+    """
+
+    def __init__(self, timeout=60.0):
+        self.timeout = timeout
+        self._streams = {}  # stream id -> [generator, last used]
+        self._lock = threading.Lock()
+        self._last_expire = time.time()
+
+    def __len__(self):
+        return len(self._streams)
+
+    def __contains__(self, stream_id):
+        return stream_id in self._streams
+
+    def open(self, generator, stream_id=None):
+        """Register a new stream, returning its id"""
+        if stream_id is None:
+            stream_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._streams[stream_id] = [generator, now]
+            expired = self._expire(now)
+        for generator in expired:
+            _close(generator)
+        return stream_id
+
+    def expire(self):
+        """
+        Close the streams unused for more than ``timeout`` seconds.
+        Done at most once per second: cheap enough to be called
+        at each request, as well as by idle servers now and then.
+        """
+        now = time.time()
+        if now - self._last_expire < 1:
+            return
+        with self._lock:
+            expired = self._expire(now)
+        for generator in expired:
+            _close(generator)
+
+    def get(self, stream_id):
+        """
+        Get the generator of a stream.
+
+        :raise KeyError: if the stream does not exist (anymore)
+        """
+        self.expire()
+        with self._lock:
+            try:
+                entry = self._streams[stream_id]
+            except KeyError:
+                raise KeyError('No such stream: {0}'.format(stream_id))
+            entry[1] = time.time()
+            return entry[0]
+
+    def pop(self, stream_id):
+        """Remove a stream from the table, returning its generator"""
+        with self._lock:
+            return self._streams.pop(stream_id)[0]
+
+    def close(self, stream_id):
+        """Close a stream (if still open), and its generator"""
+        with self._lock:
+            entry = self._streams.pop(stream_id, None)
+        if entry is not None:
+            _close(entry[0])
+
+    def _expire(self, now):
+        """Remove the expired streams (at most once per second)"""
+        if now - self._last_expire < 1:
+            return []
+        self._last_expire = now
+        expired = [stream_id for stream_id, (_, last_used)
+                   in self._streams.iteritems()
+                   if now - last_used > self.timeout]
+        if expired:
+            logger.info("Closing {0} abandoned streams".format(len(expired)))
+        return [self._streams.pop(stream_id)[0] for stream_id in expired]
+
+
+def _close(generator):
+    ## Async generators have no (synchronous) close(): just drop them
+    close = getattr(generator, 'close', None)
+    if close is not None:
+        try:
+            close()
+        except Exception:
+            logger.exception('Exception while closing a stream')
+
+
+class Upload(object):
+    """
+    Iterator over the chunks of an argument uploaded by the client,
+    passed to the called method in place of the argument itself.
+
+    Chunks are yielded while still arriving; at most ``max_chunks``
+    of them are kept waiting for the method: after that, :py:meth:`put`
+    blocks (or :py:meth:`offer` defers), delaying the acknowledgement
+    the client waits for before sending more.
+    """
+
+    def __init__(self, max_chunks=16):
+        self.max_chunks = max_chunks
+        self._chunks = collections.deque()
+        self._cond = threading.Condition()
+        self._ended = False
+        self._aborted = False
+        self._waiter = None  # Called once the method catches up
+
+    def put(self, chunk):
+        """Add a chunk, waiting for the method to catch up if needed"""
+        with self._cond:
+            while len(self._chunks) >= self.max_chunks and \
+                    not self._aborted:
+                self._cond.wait()
+            if not self._aborted:
+                self._chunks.append(chunk)
+                self._cond.notify_all()
+
+    def offer(self, chunks, end, waiter):
+        """
+        Add chunks (the last ones, if ``end``) without waiting for the
+        method to catch up. Return whether more chunks can be sent right
+        away; if not, ``waiter`` is called (from the thread of the method)
+        with ``True`` once they can, or with ``False`` once the upload
+        is closed (which the last chunks always wait for).
+        """
+        with self._cond:
+            if not self._aborted:
+                self._chunks.extend(chunks)
+                self._ended = self._ended or end
+                self._cond.notify_all()
+            if self._aborted or \
+                    (not end and len(self._chunks) < self.max_chunks):
+                return True
+            self._waiter = waiter
+            return False
+
+    def end(self):
+        """Mark the end of the upload"""
+        with self._cond:
+            self._ended = True
+            self._cond.notify_all()
+
+    def close(self):
+        """
+        Abort the upload: the method will get an :py:exc:`IOError`
+        when asking for more chunks.
+        """
+        with self._cond:
+            self._aborted = True
+            self._chunks.clear()
+            self._cond.notify_all()
+            waiter, self._waiter = self._waiter, None
+        if waiter is not None:
+            waiter(False)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        with self._cond:
+            while not (self._chunks or self._ended or self._aborted):
+                self._cond.wait()
+            if self._aborted:
+                raise IOError("Upload aborted")
+            if not self._chunks:
+                raise StopIteration
+            chunk = self._chunks.popleft()
+            self._cond.notify_all()
+            waiter = None
+            if self._waiter is not None and not self._ended and \
+                    len(self._chunks) < self.max_chunks:
+                waiter, self._waiter = self._waiter, None
+        if waiter is not None:
+            waiter(True)
+        return chunk
+
+
+class SpooledUpload(object):
+    """
+    :py:class:`Upload` for servers that cannot run the method while
+    receiving the chunks: they are spooled to a temporary file (kept
+    in memory up to ``max_size`` bytes), and the method is called
+    once the upload is complete.
+    """
+
+    def __init__(self, packer, max_size=8 << 20):
+        self._packer = packer
+        self._file = tempfile.SpooledTemporaryFile(max_size)
+
+    def put(self, chunk):
+        data = self._packer.packb(chunk)
+        self._file.write(struct.pack('!I', len(data)))
+        self._file.write(data)
+
+    def end(self):
+        self._file.seek(0)
+
+    def close(self):
+        self._file.close()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        header = self._file.read(4)
+        if not header:
+            raise StopIteration
+        size, = struct.unpack('!I', header)
+        return self._packer.unpackb(self._file.read(size))
+
+
+class UploadCall(object):
+    """A call waiting for (or running on) an upload"""
+
+    def __init__(self, request, upload, method=None):
+        self.request = request
+        self.upload = upload
+        self.method = method
+        self.response = None
+        self._done = threading.Event()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def set_response(self, response):
+        self.response = response
+        self._done.set()
+        ## The method will not ask for more chunks
+        self.upload.close()
+
+    def wait(self):
+        self._done.wait()
+        return self.response
+
+    def close(self):
+        self.upload.close()
@@ -0,0 +1,264 @@
+"""
+Concurrent server, dispatching requests to a pool of worker threads
+"""
+
+import logging
+import Queue
+import threading
+import time
+
+import zmq
+
+from smartrpyc.utils import lazy_property
+from smartrpyc.utils.frames import split_envelope
+from .base import Server, _IDLE_TIMEOUT
+from .streams import Upload
+
+__all__ = ['ThreadPoolServer']
+
+logger = logging.getLogger(__name__)
+
+## Returned instead of the response to requests answered later
+_REPLY_LATER = object()
+
+
+class ThreadPoolServer(Server):
+    """
+    Server processing requests concurrently, in a pool of worker threads.
+
+    Requests are received by the main loop on a ROUTER socket and queued
+    for the workers, that run them through the usual
+    :py:meth:`~.Server._process_request` machinery (so methods registers
+    and middleware work unchanged). Packed replies are handed back
+    to the main loop via an inproc socket, and routed to the peer
+    that sent the request.
+
+    Methods receiving an uploaded argument run in a separate pool of
+    ``upload_workers`` threads, consuming the chunks while they are still
+    arriving (further uploads wait for a thread to be free). Workers
+    never wait for these methods: chunks are acknowledged once the method
+    catches up with them, and the result sent back once it returns,
+    from its own thread.
+
+    .. warning::
+        Methods and middleware will be called from several threads
+        at once: make sure they are thread-safe.
+    """
+
+    socket_type = zmq.ROUTER
+
+    #: Number of uploaded chunks to be kept waiting for the method,
+    #: before making the client wait
+    upload_max_chunks = 16
+
+    #: Number of threads running the methods receiving uploads
+    upload_workers = 4
+
+    def __init__(self, methods=None, workers=4):
+        """
+        :param methods: see :py:class:`.Server`
+        :param workers: number of worker threads to be started
+        """
+        super(ThreadPoolServer, self).__init__(methods)
+        self.workers = workers
+        self._queue = Queue.Queue()
+        self._upload_queue = Queue.Queue()  # Upload calls to be run
+        self._threads = []
+        self._upload_threads = []
+        self._local = threading.local()  # The replies socket of workers
+        self._replies_address = 'inproc://smartrpyc-replies-{0:x}'.format(
+            id(self))
+
+    @lazy_property
+    def _replies(self):
+        """Socket on which workers send back the packed replies"""
+        replies = self.socket.context.socket(zmq.PULL)
+        replies.bind(self._replies_address)
+        return replies
+
+    @lazy_property
+    def _poller(self):
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self._replies, zmq.POLLIN)
+        return poller
+
+    def start_workers(self):
+        """Start the worker threads, if not already running"""
+        if self._threads:
+            return
+        self._replies  # The inproc socket must be bound before connecting
+        self.streams  # Shared by the workers: create them only once
+        self.uploads
+        for i in xrange(self.workers):
+            thread = threading.Thread(
+                target=self._worker_loop,
+                name='smartrpyc-worker-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        for i in xrange(self.upload_workers):
+            thread = threading.Thread(
+                target=self._upload_loop,
+                name='smartrpyc-upload-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._upload_threads.append(thread)
+
+    def stop_workers(self):
+        """Ask the worker threads to exit and wait for them"""
+        for _ in self._threads:
+            self._queue.put(None)
+        for _ in self._upload_threads:
+            self._upload_queue.put(None)
+        for thread in self._threads + self._upload_threads:
+            thread.join()
+        del self._threads[:]
+        del self._upload_threads[:]
+
+    def run(self):
+        """Start the workers and the server listening loop"""
+        self.start_workers()
+        while True:
+            self.run_once(_IDLE_TIMEOUT)
+
+    def run_once(self, timeout=None):
+        """
+        Wait for events on the sockets and dispatch them: incoming
+        requests are queued for the workers, finished replies are
+        sent back to clients.
+
+        :param timeout: poll timeout, in milliseconds
+        """
+        self.start_workers()
+        socks = dict(self._poller.poll(timeout))
+
+        if socks.get(self._replies) == zmq.POLLIN:
+            self._send_reply(
+                self.socket, self._replies.recv_multipart(copy=False))
+
+        if socks.get(self.socket) == zmq.POLLIN:
+            try:
+                envelope, frames = split_envelope(
+                    self.socket.recv_multipart(copy=False))
+            except ValueError:
+                ## Any peer can connect: don't let it stop the server
+                logger.warning("Dropping a malformed message")
+            else:
+                self._queue.put((envelope, frames, time.time()))
+
+        ## Methods of abandoned uploads are stuck waiting for chunks
+        self._expire_streams()
+
+    def _worker_loop(self):
+        replies = self._local.replies = self.socket.context.socket(zmq.PUSH)
+        replies.connect(self._replies_address)
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                envelope, frames, received_at = item
+                self._local.envelope = envelope
+                ## Retries of running requests get their reply later,
+                ## as well as chunks the upload method has to catch up with
+                reply = self._handle_frames(frames, received_at, envelope)
+                if reply is not None:
+                    replies.send_multipart(envelope + reply, copy=False)
+        finally:
+            replies.close()
+
+    def _reply_waiters(self, waiters, reply):
+        """Have the main loop send the reply to the attached retries"""
+        for envelope, request in waiters:
+            frames = reply if reply is not None \
+                else self._failed_reply(request)
+            self._local.replies.send_multipart(envelope + frames, copy=False)
+
+    def _upload_loop(self):
+        replies = self._local.replies = self.socket.context.socket(zmq.PUSH)
+        replies.connect(self._replies_address)
+        try:
+            while True:
+                pending = self._upload_queue.get()
+                if pending is None:
+                    break
+                self._run_upload_call(pending)
+        finally:
+            replies.close()
+
+    def _handle_request(self, request):
+        response = self._process_request(request)
+        if response is _REPLY_LATER:
+            return None
+        return self._pack_response(request, response)
+
+    def _reply_later(self, envelope, request, message):
+        """
+        Have the main loop send the reply to a request (or send it,
+        from the main loop itself, closing abandoned uploads)
+        """
+        reply = envelope + self._pack_response(request, message)
+        replies = getattr(self._local, 'replies', None)
+        if replies is None:
+            self._send_reply(self.socket, reply)
+        else:
+            replies.send_multipart(reply, copy=False)
+
+    def _new_upload(self):
+        return Upload(self.upload_max_chunks)
+
+    def _begin_upload_call(self, pending):
+        """Run the method as soon as possible, while the chunks arrive"""
+        self._upload_queue.put(pending)
+
+    def _run_upload_call(self, pending):
+        try:
+            response = self._run_call(pending.request, pending.method)
+        except Exception, e:
+            logger.exception('Exception while processing an upload')
+            response = self._exception_message(e)
+        pending.set_response(response)
+
+    def _receive_chunks(self, request):
+        """
+        Add the received chunks to an upload, without waiting for the
+        method: if it has to catch up first (or to return, after the last
+        chunk), the reply is sent later, from its thread.
+        """
+        try:
+            pending = self.uploads.get(request.upload)
+        except KeyError, e:
+            return self._exception_message(e)
+        envelope = self._local.envelope
+
+        def reply(more):
+            self._reply_later(envelope, request,
+                              self._chunks_reply(request, pending, more))
+
+        if not pending.upload.offer(
+                request.chunks, bool(request.get('end')), reply):
+            return _REPLY_LATER
+        return self._chunks_reply(request, pending, True)
+
+    def _chunks_reply(self, request, pending, more):
+        """
+        The reply to uploaded chunks: asking for more (if ``more``),
+        or the result of the call, once over
+        """
+        if more and not pending.done:
+            return {'u': request.upload}
+        self.uploads.close(request.upload)
+        if pending.done:
+            return pending.response
+        return self._exception_message(IOError("Upload aborted"))
+
+    def _handle_frames(self, frames, received_at=None, envelope=None):
+        ## The main loop must keep running: an undecodable message
+        ## is reported back to the client instead of killing the worker
+        try:
+            return super(ThreadPoolServer, self)._handle_frames(
+                frames, received_at, envelope)
+        except Exception, e:
+            logger.exception('Exception while handling a message')
+            return self._error_reply(frames, e)
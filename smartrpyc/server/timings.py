@@ -0,0 +1,49 @@
+"""
+Timings of the phases of request processing
+"""
+
+import threading
+
+__all__ = ['PhaseTimings']
+
+
+class PhaseTimings(object):
+    """
+    Aggregated timings of the phases requests go through (see
+    :py:meth:`.Request.mark`): number of requests, total and maximum
+    time, by phase.
+    """
+
+    def __init__(self):
+        self._phases = {}  # phase -> [count, total, max]
+        self._lock = threading.Lock()
+
+    def add(self, timings):
+        """Add a list of ``(phase, seconds)`` pairs"""
+        with self._lock:
+            for phase, seconds in timings:
+                entry = self._phases.get(phase)
+                if entry is None:
+                    self._phases[phase] = [1, seconds, seconds]
+                else:
+                    entry[0] += 1
+                    entry[1] += seconds
+                    if seconds > entry[2]:
+                        entry[2] = seconds
+
+    def snapshot(self):
+        """
+        The timings, as a dict by phase of dicts with the ``count``,
+        ``total``, ``mean`` and ``max`` keys
+        """
+        with self._lock:
+            return dict(
+                (phase, {'count': count, 'total': total,
+                         'mean': total / count, 'max': maximum})
+                for phase, (count, total, maximum)
+                in self._phases.iteritems())
+
+    def reset(self):
+        """Forget all the timings"""
+        with self._lock:
+            self._phases.clear()
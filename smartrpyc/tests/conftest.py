@@ -0,0 +1,11 @@
+"""
+Configuration for py.test
+"""
+
+import sys
+
+collect_ignore = []
+
+if sys.version_info < (3, 5):
+    ## Tests for the asyncio-based server/client need a recent Python
+    collect_ignore.append('functional/test_aio.py')
@@ -0,0 +1,406 @@
+"""
+Tests for the asyncio-based server and client
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+import zmq
+
+from smartrpyc.client import AsyncClient, Client, RemoteException, \
+    ResultCache
+from smartrpyc.server import AsyncServer, DirectResponse, MethodsRegister
+from smartrpyc.utils import get_random_ipc_socket
+from smartrpyc.tests import utils
+
+
+class AsyncRpcThread(threading.Thread):
+    """Thread running an AsyncServer in its own event loop"""
+
+    def __init__(self, methods, addresses, middleware=None,
+                 server_class=AsyncServer):
+        super(AsyncRpcThread, self).__init__()
+        self.daemon = True
+        self._methods = methods
+        self._addresses = addresses
+        self._middleware = middleware or []
+        self._server_class = server_class
+        self._ready = threading.Event()
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.rpc = self._server_class(self._methods)
+        self.rpc.middleware[:] = self._middleware
+        self.rpc.bind(self._addresses)
+        self._ready.set()
+        loop.run_until_complete(self.rpc.run())
+
+    def start(self):
+        super(AsyncRpcThread, self).start()
+        self._ready.wait()
+
+
+class AsyncMiddleware(object):
+    async def pre(self, request, method):
+        await asyncio.sleep(0)
+        if request.method == 'whoami':
+            raise DirectResponse(u'middleware')
+
+    async def post(self, request, method, response, exception):
+        await asyncio.sleep(0)
+        if request.method == 'shout':
+            return response.upper()
+
+
+class TestAsyncServer(object):
+
+    def get_methods(self):
+        methods = MethodsRegister()
+
+        @methods.register
+        async def slow_hello(request, name=u'world'):
+            await asyncio.sleep(.3)
+            return u"Hello, {0}!".format(name)
+
+        @methods.register
+        def hello(request, name=u'world'):
+            return u"Hello, {0}!".format(name)
+
+        @methods.register
+        async def shout(request, text):
+            return text
+
+        @methods.register
+        async def raise_value_error(request):
+            raise ValueError("Invalid value")
+
+        return methods
+
+    def test_with_client(self):
+        addr = get_random_ipc_socket()
+        AsyncRpcThread(self.get_methods(), addr).start()
+
+        client = Client(addr)
+        assert client.hello() == u'Hello, world!'
+        assert client.slow_hello(u'WORLD') == u'Hello, WORLD!'
+
+        with pytest.raises(RemoteException):
+            client.raise_value_error()
+
+        with pytest.raises(RemoteException):
+            client.no_such_method()
+
+    def test_concurrent_coroutines(self):
+        addr = get_random_ipc_socket()
+        AsyncRpcThread(self.get_methods(), addr).start()
+        results = {}
+
+        def call(i):
+            results[i] = Client(addr).slow_hello(u'client {0}'.format(i))
+
+        threads = [threading.Thread(target=call, args=(i,))
+                   for i in range(20)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert time.time() - start < 1.5
+        assert results == dict(
+            (i, u'Hello, client {0}!'.format(i)) for i in range(20))
+
+    def test_uploads(self):
+        addr = get_random_ipc_socket()
+        methods = self.get_methods()
+
+        @methods.register
+        async def join(request, items):
+            await asyncio.sleep(0)
+            return u''.join(items)
+
+        AsyncRpcThread(methods, addr,
+                       middleware=[AsyncMiddleware()]).start()
+        client = Client(addr)
+        assert client.join(iter([u'a', u'b', u'c'])) == u'abc'
+
+        ## Calls answered by the middleware get no chunk
+        read = []
+
+        def generate():
+            read.append(u'a')
+            yield u'a'
+
+        assert client.whoami(generate()) == u'middleware'
+        assert read == []
+
+        async def main():
+            client = AsyncClient(addr)
+            assert await client.join(iter([u'd', u'e'])) == u'de'
+            client.close()
+
+        asyncio.new_event_loop().run_until_complete(main())
+
+    def test_retried_requests(self):
+        addr = get_random_ipc_socket()
+        methods = self.get_methods()
+        calls = []
+
+        @methods.register
+        async def slow_counter(request):
+            calls.append(None)
+            await asyncio.sleep(.2)
+            return len(calls)
+
+        class DedupServer(AsyncServer):
+            dedup_max_entries = 1024
+
+        AsyncRpcThread(methods, addr, server_class=DedupServer).start()
+        request = {'i': 'retried', 'm': 'slow_counter'}
+        replies = []
+
+        def send():
+            replies.append(Client(addr)._exchange(dict(request))['r'])
+
+        threads = [threading.Thread(target=send) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        send()
+        assert replies == [1, 1, 1]
+        assert len(calls) == 1
+
+    def test_coroutine_middleware(self):
+        addr = get_random_ipc_socket()
+        AsyncRpcThread(self.get_methods(), addr,
+                       middleware=[AsyncMiddleware()]).start()
+
+        client = Client(addr)
+        assert client.whoami() == u'middleware'
+        assert client.shout(u'hello') == u'HELLO'
+        assert client.hello() == u'Hello, world!'
+
+    def test_malformed_message_is_dropped(self):
+        addr = get_random_ipc_socket()
+        AsyncRpcThread(self.get_methods(), addr).start()
+        assert Client(addr).hello() == u'Hello, world!'
+
+        socket = zmq.Context.instance().socket(zmq.DEALER)
+        socket.connect(addr)
+        socket.send(b'junk')  # No envelope delimiter
+        socket.close()
+
+        results = []
+        call = threading.Thread(
+            target=lambda: results.append(Client(addr).hello()))
+        call.daemon = True
+        call.start()
+        call.join(2)
+        assert results == [u'Hello, world!']
+
+    def test_timings(self):
+        addr = get_random_ipc_socket()
+        AsyncRpcThread(self.get_methods(), addr,
+                       middleware=[AsyncMiddleware()]).start()
+
+        client = Client(addr)
+        client.request_timings = True
+        assert client.slow_hello() == u'Hello, world!'
+        assert [phase for phase, _ in client.last_timings] == [
+            'queue', 'unpack', 'lookup', 'pre:AsyncMiddleware', 'method',
+            'post:AsyncMiddleware']
+        assert dict(client.last_timings)['method'] >= .3
+
+
+class FailingSocket(object):
+    """Socket failing to receive, once"""
+
+    def __init__(self, socket):
+        self._socket = socket
+        self.failed = False
+
+    def __getattr__(self, name):
+        return getattr(self._socket, name)
+
+    async def recv_multipart(self, *args, **kwargs):
+        if not self.failed:
+            self.failed = True
+            raise zmq.ZMQError(zmq.EFSM)
+        return await self._socket.recv_multipart(*args, **kwargs)
+
+
+class TestAsyncClient(object):
+
+    def get_methods(self):
+        methods = MethodsRegister()
+
+        @methods.register
+        async def slow_hello(request, name=u'world'):
+            await asyncio.sleep(.3)
+            return u"Hello, {0}!".format(name)
+
+        @methods.register
+        def hello(request, name=u'world'):
+            return u"Hello, {0}!".format(name)
+
+        @methods.register
+        def raise_value_error(request):
+            raise ValueError("Invalid value")
+
+        return methods
+
+    def run(self, coro):
+        return asyncio.new_event_loop().run_until_complete(coro)
+
+    def test_with_async_server(self):
+        addr = get_random_ipc_socket()
+        AsyncRpcThread(self.get_methods(), addr).start()
+
+        async def main():
+            client = AsyncClient(addr)
+            assert await client.hello() == u'Hello, world!'
+
+            with pytest.raises(RemoteException):
+                await client.raise_value_error()
+
+            start = time.time()
+            results = await asyncio.gather(*[
+                client.slow_hello(u'call {0}'.format(i))
+                for i in range(50)])
+            assert time.time() - start < 1.5
+            assert results == [u'Hello, call {0}!'.format(i)
+                               for i in range(50)]
+            client.close()
+
+        self.run(main())
+
+    def test_with_rep_server(self):
+        addr = get_random_ipc_socket()
+
+        async def main():
+            client = AsyncClient(addr)
+            results = await asyncio.gather(*[
+                client.hello(u'call {0}'.format(i)) for i in range(50)])
+            assert results == [u'Hello, call {0}!'.format(i)
+                               for i in range(50)]
+            client.close()
+
+        with utils.TestingServer(self.get_methods(), addr):
+            self.run(main())
+
+    def test_timeout(self):
+        addr = get_random_ipc_socket()
+        AsyncRpcThread(self.get_methods(), addr).start()
+
+        async def main():
+            client = AsyncClient(addr)
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(client.slow_hello(), .1)
+            assert not client._pending
+
+            ## The late reply must not confuse the next calls
+            await asyncio.sleep(.3)
+            assert await client.hello() == u'Hello, world!'
+            client.close()
+
+        self.run(main())
+
+    def test_reader_failure(self):
+        addr = get_random_ipc_socket()
+        AsyncRpcThread(self.get_methods(), addr).start()
+
+        async def main():
+            client = AsyncClient(addr)
+            client._socket = FailingSocket(client._socket)
+            with pytest.raises(zmq.ZMQError):
+                await asyncio.wait_for(client.hello(), 1)
+            assert not client._pending
+
+            ## The next calls read the replies again
+            assert await asyncio.wait_for(client.hello(), 1) == \
+                u'Hello, world!'
+            client.close()
+
+        self.run(main())
+
+    def test_batch(self):
+        addr = get_random_ipc_socket()
+        AsyncRpcThread(self.get_methods(), addr).start()
+
+        async def main():
+            client = AsyncClient(addr)
+            start = time.time()
+            async with client.batch() as batch:
+                results = [batch.slow_hello(u'call {0}'.format(i))
+                           for i in range(5)]
+                error = batch.raise_value_error()
+            assert time.time() - start < 1
+            assert [r.result() for r in results] == [
+                u'Hello, call {0}!'.format(i) for i in range(5)]
+            with pytest.raises(RemoteException):
+                error.result()
+            client.close()
+
+        self.run(main())
+
+    def test_streams(self):
+        addr = get_random_ipc_socket()
+        methods = self.get_methods()
+
+        @methods.register
+        async def async_count(request, n):
+            for i in range(n):
+                await asyncio.sleep(0)
+                yield i
+
+        @methods.register
+        def count(request, n):
+            yield from range(n)
+
+        AsyncRpcThread(methods, addr).start()
+
+        async def main():
+            client = AsyncClient(addr)
+            client.stream_credit = 7
+            assert [i async for i in await client.async_count(50)] == \
+                list(range(50))
+            assert [i async for i in await client.count(50)] == \
+                list(range(50))
+
+            async with await client.async_count(50) as stream:
+                assert await stream.__anext__() == 0
+            assert not stream._items
+            client.close()
+
+        self.run(main())
+
+        ## Sync clients can consume async generators too
+        assert list(Client(addr).async_count(20)) == list(range(20))
+
+    def test_result_cache(self):
+        addr = get_random_ipc_socket()
+        methods = self.get_methods()
+        calls = []
+
+        @methods.register
+        def version(request):
+            calls.append(None)
+            request.set_cache_hints(max_age=0, etag='v1')
+            return 1
+
+        AsyncRpcThread(methods, addr).start()
+
+        async def main():
+            client = AsyncClient(addr)
+            client.result_cache = ResultCache()
+            assert await client.version() == 1
+            assert await client.version() == 1  # Revalidated
+            assert client.result_cache.revalidated == 1
+            assert len(calls) == 2
+            client.close()
+
+        self.run(main())
@@ -0,0 +1,147 @@
+"""
+Tests for the responses cache middleware
+"""
+
+import time
+
+import pytest
+
+from smartrpyc.client import Client, RemoteException
+from smartrpyc.server import MethodsRegister, Request, \
+    ResponseCacheMiddleware, Server, cached
+from smartrpyc.utils import get_random_ipc_socket
+from smartrpyc.tests import utils
+
+
+class TestResponseCache(object):
+
+    def get_methods(self, calls):
+        methods = MethodsRegister()
+
+        @methods.register
+        @cached
+        def square(request, x):
+            calls.append(x)
+            return x * x
+
+        @methods.register
+        @cached(ttl=.1)
+        def short_lived(request):
+            calls.append(None)
+            return len(calls)
+
+        @methods.register
+        @cached
+        def describe(request, **kwargs):
+            calls.append(kwargs)
+            return sorted(kwargs)
+
+        @methods.register
+        @cached
+        def fail(request):
+            calls.append(None)
+            raise ValueError
+
+        @methods.register
+        def not_cached(request):
+            calls.append(None)
+            return len(calls)
+
+        return methods
+
+    def test_cache(self):
+        addr = get_random_ipc_socket()
+        calls = []
+        cache = ResponseCacheMiddleware(max_entries=3)
+        with utils.TestingServer(self.get_methods(calls), addr,
+                                 middleware=[cache]):
+            client = Client(addr)
+            assert client.square(3) == 9
+            assert client.square(3) == 9
+            assert client.square(4) == 16
+            assert calls == [3, 4]
+            assert cache.hits['square'] == 1
+            assert cache.misses['square'] == 2
+
+            ## Equal values of different types are different arguments
+            result = client.square(3.0)
+            assert result == 9 and isinstance(result, float)
+            assert client.square(True) is 1
+            assert calls == [3, 4, 3.0, True]
+            assert cache.invalidate('square', 3.0) == 1
+            assert cache.invalidate('square', True) == 1
+            del calls[2:]
+
+            assert client.describe(a=1, b=[1, 2], c={'x': 1, 'y': 2}) == \
+                [u'a', u'b', u'c']
+            assert client.describe(c={'y': 2, 'x': 1}, b=[1, 2], a=1) == \
+                [u'a', u'b', u'c']
+            assert len(calls) == 3
+
+            ## Least recently used entries get evicted
+            client.square(3)
+            client.square(5)
+            assert cache.stats()['entries'] == 3
+            client.square(4)
+            assert calls[-1] == 4  # The describe() entry was dropped
+
+            ## Explicit invalidation
+            assert cache.invalidate('square', 5) == 1
+            client.square(5)
+            assert calls[-1] == 5
+            assert cache.invalidate('square') == 3
+            client.short_lived()
+            assert cache.invalidate() == 1
+            assert cache.stats()['bytes'] == 0
+
+            ## Expiration
+            del calls[:]
+            assert client.short_lived() == client.short_lived() == 1
+            time.sleep(.15)
+            assert client.short_lived() == 2
+
+            ## Exceptions, and non-cached methods
+            for _ in xrange(2):
+                with pytest.raises(RemoteException):
+                    client.fail()
+            assert client.not_cached() != client.not_cached()
+            assert len(calls) == 6
+
+    def test_memory_budget(self):
+        cache = ResponseCacheMiddleware(max_bytes=250)
+        server = Server()
+
+        @cached
+        def method(request, size):
+            return b'x' * size
+
+        for i in xrange(5):
+            request = Request({'m': 'method', 'a': [100 + i]})
+            request.server = server
+            cache.pre(request, method)
+            cache.post(request, method, method(request, 100 + i), None)
+        assert cache.stats()['entries'] == 2
+        assert 0 < cache.stats()['bytes'] <= 250
+
+    def test_per_token(self):
+        cache = ResponseCacheMiddleware()
+        server = Server()
+
+        @cached(per_token=True)
+        def whoami(request):
+            return request.token
+
+        class TokenRequest(Request):
+            token = property(lambda self: self.raw.get('t'))
+
+        for token in ['alice', 'bob', 'alice']:
+            request = TokenRequest({'m': 'whoami', 't': token})
+            request.server = server
+            try:
+                cache.pre(request, whoami)
+            except Exception as e:
+                assert e.response == token
+            else:
+                cache.post(request, whoami, whoami(request), None)
+        assert cache.hits['whoami'] == 1
+        assert cache.misses['whoami'] == 2
@@ -0,0 +1,103 @@
+"""
+Tests for the client-side result cache
+"""
+
+import time
+
+from smartrpyc.client import Client, ResultCache
+from smartrpyc.contrib.public.client import PublicClient
+from smartrpyc.server import MethodsRegister
+from smartrpyc.utils import get_random_ipc_socket
+from smartrpyc.tests import utils
+
+
+class TestResultCache(object):
+
+    def get_methods(self, calls, version):
+        methods = MethodsRegister()
+
+        @methods.register
+        def get_config(request, name):
+            calls.append(name)
+            request.set_cache_hints(max_age=.1, etag=version[0])
+            return {u'name': name, u'version': version[0]}
+
+        @methods.register
+        def counter(request):
+            calls.append(None)
+            return len(calls)
+
+        @methods.register
+        def whoami(request):
+            request.set_cache_hints(max_age=10)
+            return request.get('t')
+
+        return methods
+
+    def _request(self, args):
+        return {'i': 1, 'm': 'method', 'a': args, 'k': {}, 'd': 1.0}
+
+    def test_cache(self):
+        addr = get_random_ipc_socket()
+        calls, version = [], [1]
+        with utils.TestingServer(self.get_methods(calls, version), addr):
+            client = Client(addr)
+            client.result_cache = cache = ResultCache()
+
+            ## Fresh results are reused without asking the server
+            first = client.get_config(u'a')
+            assert client.get_config(u'a') == first
+            assert client.get_config(u'b') != first
+            assert calls == [u'a', u'b']
+            assert cache.hits == 1
+
+            ## Stale results are revalidated
+            time.sleep(.15)
+            assert client.get_config(u'a') == first
+            assert calls == [u'a', u'b', u'a']
+            assert cache.revalidated == 1
+            assert client.get_config(u'a') == first  # Fresh again
+            assert len(calls) == 3
+
+            ## ..and replaced, when they changed
+            version[0] = 2
+            time.sleep(.15)
+            assert client.get_config(u'a')[u'version'] == 2
+            assert cache.revalidated == 1
+            assert client.get_config(u'a')[u'version'] == 2
+            assert len(calls) == 4
+
+            ## Only methods sending hints are cached
+            assert client.counter() != client.counter()
+            assert len(cache) == 2
+
+            cache.invalidate(u'get_config')
+            assert len(cache) == 0
+
+    def test_whole_request_in_key(self):
+        addr = get_random_ipc_socket()
+        with utils.TestingServer(self.get_methods([], [1]), addr):
+            client = PublicClient(addr)
+            client.result_cache = ResultCache()
+            client.set_token(u'alice')
+            assert client.whoami() == u'alice'
+            client.set_token(u'bob')
+            assert client.whoami() == u'bob'
+            client.set_token(u'alice')
+            assert client.whoami() == u'alice'
+            assert client.result_cache.hits == 1
+
+    def test_max_entries(self):
+        cache = ResultCache(max_entries=2)
+        for i in xrange(3):
+            key = cache.make_key(self._request([i]))
+            assert cache.get(key) is None
+            cache.update(key, None, {'r': i, 'h': {'max_age': 10}})
+        assert len(cache) == 2
+        assert cache.get(cache.make_key(self._request([0]))) is None
+        assert cache.get(cache.make_key(self._request([2]))).value == 2
+        assert cache.make_key(self._request([{}, [set()]])) is None
+
+        ## Keys changing at each call do not count
+        assert cache.make_key(dict(self._request([0]), i=2, d=.5)) == \
+            cache.make_key(self._request([0]))
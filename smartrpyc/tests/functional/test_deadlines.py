@@ -0,0 +1,114 @@
+"""
+Tests for the deadlines of requests
+"""
+
+import threading
+import time
+
+import pytest
+
+from smartrpyc.client import Client, RemoteException
+from smartrpyc.client.exceptions import DeadlineExceeded
+from smartrpyc.client.pirate import Lazy
+from smartrpyc.server import MethodsRegister, Server, \
+    ServerMiddlewareBase, ThreadPoolServer
+from smartrpyc.utils import get_random_ipc_socket
+from smartrpyc.tests import utils
+
+
+class CountingMiddleware(ServerMiddlewareBase):
+
+    def __init__(self):
+        self.calls = []
+
+    def pre(self, request, method):
+        self.calls.append(request.method)
+
+
+class TestDeadlines(object):
+
+    def get_methods(self, calls):
+        methods = MethodsRegister()
+
+        @methods.register
+        def slow(request, seconds):
+            time.sleep(seconds)
+
+        @methods.register
+        def remaining(request):
+            calls.append(request.deadline)
+            return request.remaining
+
+        return methods
+
+    def test_budget(self):
+        addr = get_random_ipc_socket()
+        calls = []
+        with utils.TestingServer(self.get_methods(calls), addr):
+            client = Client(addr)
+            assert client.remaining() is None
+
+            client.call_timeout = 5
+            assert 4 < client.remaining() <= 5
+
+            ## The closest of the timeout and the deadline wins
+            client.deadline = time.time() + 1
+            assert 0 < client.remaining() <= 1
+            assert abs(calls[-1] - client.deadline) < 0.1
+
+            client.deadline = time.time() - 1
+            with pytest.raises(DeadlineExceeded):
+                client.remaining()
+
+            ## Lazy clients give up after their timeout
+            client = Lazy(timeout=500, address=addr)
+            assert 0 < client.remaining() <= 0.5
+
+    def test_expired_skipped(self):
+        addr = get_random_ipc_socket()
+        calls = []
+        middleware = CountingMiddleware()
+        with utils.TestingServer(self.get_methods(calls), addr,
+                                 middleware=[middleware],
+                                 server_class=ThreadPoolServer,
+                                 server_kwargs={'workers': 1}):
+            client = Client(addr)
+            assert client.remaining() is None  # Negotiate the protocol
+            del calls[:]
+
+            ## Keep the only worker busy
+            thread = threading.Thread(target=Client(addr).slow, args=(.5,))
+            thread.start()
+            time.sleep(.1)
+
+            client.call_timeout = .1
+            with pytest.raises(RemoteException) as excinfo:
+                client.remaining()
+            assert excinfo.value.original_exc == 'DeadlineExceeded'
+            thread.join()
+
+            ## Neither the middleware nor the method ran
+            assert middleware.calls == ['remaining', 'slow']
+            assert calls == []
+
+            ## Retrying with a new deadline works
+            assert client.remaining() > 0
+
+    def test_lazy_retries_renew_deadline(self):
+        class TrustingServer(Server):
+            max_clock_skew = 0.0
+
+        addr = get_random_ipc_socket()
+        calls = []
+        methods = self.get_methods(calls)
+
+        @methods.register
+        def slow_once(request):
+            calls.append(None)
+            if len(calls) == 1:
+                time.sleep(.4)  # The retry is queued meanwhile
+            return len(calls)
+
+        with utils.TestingServer(methods, addr, server_class=TrustingServer):
+            client = Lazy(timeout=300, address=addr)
+            assert client.slow_once() == 2
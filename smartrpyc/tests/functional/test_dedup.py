@@ -0,0 +1,168 @@
+"""
+Tests for the deduplication of retried requests
+"""
+
+import threading
+import time
+
+from smartrpyc.client import Client
+from smartrpyc.server import DedupTable, MethodsRegister, Server, \
+    ThreadPoolServer
+from smartrpyc.server.dedup import PendingReply
+from smartrpyc.utils import get_random_ipc_socket
+from smartrpyc.tests import utils
+
+
+class DedupServer(Server):
+    dedup_max_entries = 1024
+
+
+class DedupThreadPoolServer(ThreadPoolServer):
+    dedup_max_entries = 1024
+
+
+class TestDedup(object):
+
+    def get_methods(self, calls):
+        methods = MethodsRegister()
+
+        @methods.register
+        def slow_counter(request, seconds=0):
+            calls.append(None)
+            time.sleep(seconds)
+            return len(calls)
+
+        return methods
+
+    def _request(self, request_id, seconds=0):
+        return {'i': request_id, 'm': 'slow_counter', 'a': [seconds]}
+
+    def test_retry_gets_previous_reply(self):
+        addr = get_random_ipc_socket()
+        calls = []
+        with utils.TestingServer(self.get_methods(calls), addr,
+                                 server_class=DedupServer):
+            ## Retries come from a new socket, as the Lazy pirate does
+            first = Client(addr)._exchange(self._request('r1'))
+            retry = Client(addr)._exchange(self._request('r1'))
+            assert first['r'] == retry['r'] == 1
+            assert retry['i'] == 'r1'
+            assert Client(addr)._exchange(self._request('r2'))['r'] == 2
+            assert len(calls) == 2
+
+    def test_retry_attaches_to_running_request(self):
+        addr = get_random_ipc_socket()
+        calls = []
+        replies = []
+
+        def send():
+            replies.append(Client(addr)._exchange(self._request('r1', .2)))
+
+        with utils.TestingServer(self.get_methods(calls), addr,
+                                 server_class=DedupThreadPoolServer):
+            threads = [threading.Thread(target=send) for _ in xrange(3)]
+            for thread in threads:
+                thread.start()
+                time.sleep(.02)
+            for thread in threads:
+                thread.join()
+            assert [reply['r'] for reply in replies] == [1, 1, 1]
+            assert len(calls) == 1
+
+    def test_retries_do_not_tie_up_workers(self):
+        addr = get_random_ipc_socket()
+        calls = []
+        replies = []
+
+        def send():
+            replies.append(Client(addr)._exchange(self._request('r1', .5)))
+
+        with utils.TestingServer(self.get_methods(calls), addr,
+                                 server_class=DedupThreadPoolServer,
+                                 server_kwargs={'workers': 2}):
+            threads = [threading.Thread(target=send) for _ in xrange(4)]
+            for thread in threads:
+                thread.start()
+                time.sleep(.02)
+
+            ## One worker runs the request, the other is still free
+            start = time.time()
+            assert Client(addr)._exchange(self._request('r2'))['r'] == 2
+            assert time.time() - start < .3
+
+            for thread in threads:
+                thread.join()
+            assert len(replies) == 4
+            assert len(set(reply['r'] for reply in replies)) == 1
+            assert len(calls) == 2
+
+    def test_retry_must_match(self):
+        addr = get_random_ipc_socket()
+        calls = []
+        methods = self.get_methods(calls)
+
+        @methods.register
+        def secret(request):
+            return u'secret'
+
+        with utils.TestingServer(methods, addr, server_class=DedupServer):
+            Client(addr)._exchange({'i': 'r1', 'm': 'secret', 't': 'alice'})
+            ## Same id, but not the same request: run, not replayed
+            reply = Client(addr)._exchange(self._request('r1'))
+            assert reply['r'] == 1
+            reply = Client(addr)._exchange(dict(self._request('r1'), t='bob'))
+            assert reply['r'] == 2
+            reply = Client(addr)._exchange(self._request('r1', 0.0))
+            assert reply['r'] == 3
+
+            ## Volatile keys, as the deadline, may change across retries
+            retry = dict(self._request('r1'), d=1000, D=time.time() + 1)
+            assert Client(addr)._exchange(retry)['r'] == 1
+            assert len(calls) == 3
+
+    def test_disabled_by_default(self):
+        addr = get_random_ipc_socket()
+        calls = []
+        with utils.TestingServer(self.get_methods(calls), addr):
+            for _ in xrange(2):
+                Client(addr)._exchange(self._request('r1'))
+            assert len(calls) == 2
+
+
+class TestDedupTable(object):
+
+    def test_expiration(self):
+        table = DedupTable(max_entries=2, ttl=0)
+        assert table.begin('a', 'pending-a') is None
+        assert table.begin('a', 'retry-a') == 'pending-a'  # Running
+        table.finish('a')
+        assert table.begin('a', 'retry-a') is None  # Expired
+        assert table.begin('b', 'pending-b') is None
+        assert table.begin('c', 'pending-c') is None
+        assert 'a' not in table
+        assert len(table) == 2
+
+        table.discard('b')
+        assert table.begin('b', 'retry-b') is None
+
+    def test_max_bytes(self):
+        table = DedupTable(max_entries=10, ttl=60, max_bytes=100)
+        for request_id in 'abc':
+            table.begin(request_id, None)
+            table.finish(request_id, 40)
+        assert 'a' not in table  # Dropped to make room
+        assert 'b' in table and 'c' in table
+        assert table.size == 80
+
+        ## Too large to be kept at all
+        table.begin('d', None)
+        table.finish('d', 101)
+        assert 'd' not in table
+        assert table.size == 80
+
+    def test_waiters(self):
+        pending = PendingReply()
+        assert pending.add_waiter('retry')
+        assert pending.set(['reply']) == ['retry']
+        assert not pending.add_waiter('late retry')  # Reply it directly
+        assert pending.wait(0) == ['reply']
@@ -0,0 +1,107 @@
+"""
+Tests for large binary values, sent in their own frames
+"""
+
+import pytest
+
+from smartrpyc.client import Client
+from smartrpyc.server import MethodsRegister, Server, ThreadPoolServer
+from smartrpyc.utils import get_random_ipc_socket
+from smartrpyc.utils.serialization import NumpySerializer
+from smartrpyc.tests import utils
+
+
+class SmallFramesServer(Server):
+    zero_copy_threshold = 1000
+
+
+class SmallFramesThreadPoolServer(ThreadPoolServer):
+    zero_copy_threshold = 1000
+
+
+class TestZeroCopyFrames(object):
+
+    def get_methods(self):
+        methods = MethodsRegister()
+
+        @methods.register
+        def describe(request, data):
+            return [type(data).__name__, len(data)]
+
+        @methods.register
+        def reverse(request, data):
+            return data.tobytes()[::-1]
+
+        @methods.register
+        def blob(request, size):
+            return b'x' * size
+
+        return methods
+
+    def _run_tests(self, addr):
+        client = Client(addr)
+        client.zero_copy_threshold = 1000
+        blob = b'0123456789' * 1000
+
+        assert client.describe(blob) == [u'memoryview', 10000]
+        assert client.describe(b'small')[0] != u'memoryview'
+
+        result = client.reverse(blob)
+        assert isinstance(result, memoryview)
+        assert result.tobytes() == blob[::-1]
+
+        ## Clients not asking for it get single-frame replies
+        client.zero_copy_threshold = None
+        result = client.blob(10000)
+        assert not isinstance(result, memoryview)
+        assert len(result) == 10000
+
+    def test_server(self):
+        addr = get_random_ipc_socket()
+        with utils.TestingServer(self.get_methods(), addr,
+                                 server_class=SmallFramesServer):
+            self._run_tests(addr)
+
+    def test_thread_pool_server(self):
+        addr = get_random_ipc_socket()
+        with utils.TestingServer(self.get_methods(), addr,
+                                 server_class=SmallFramesThreadPoolServer):
+            self._run_tests(addr)
+
+
+class NumpyServer(SmallFramesServer):
+    packer = NumpySerializer
+
+
+class NumpyClient(Client):
+    packer = NumpySerializer
+    zero_copy_threshold = 1000
+
+
+class TestNumpyArrays(object):
+
+    def get_methods(self):
+        methods = MethodsRegister()
+
+        @methods.register
+        def transpose(request, array):
+            return [array.flags.owndata, array.T]
+
+        return methods
+
+    def test_arrays(self):
+        numpy = pytest.importorskip('numpy')
+        addr = get_random_ipc_socket()
+        with utils.TestingServer(self.get_methods(), addr,
+                                 server_class=NumpyServer):
+            client = NumpyClient(addr)
+
+            array = numpy.arange(10000, dtype='<f8').reshape(100, 100)
+            owndata, result = client.transpose(array)
+            assert not owndata  # A view on the received frame
+            assert numpy.array_equal(result, array.T)
+            assert not result.flags.owndata
+
+            small = numpy.arange(6).reshape(2, 3)
+            owndata, result = client.transpose(small)
+            assert numpy.array_equal(result, small.T)
@@ -1,11 +1,17 @@
+import time
+
 import pytest
-from smartrpyc.server import MethodsRegister
+from smartrpyc.server import MethodsRegister, Server
 from smartrpyc.client import pirate
 from smartrpyc.client import exceptions
 from smartrpyc.utils import get_random_ipc_socket
 from smartrpyc.tests import utils
 
 
+class DedupServer(Server):
+    dedup_max_entries = 1024
+
+
 class TestLazyClient(object):
 
     def get_methods(self):
@@ -36,3 +42,61 @@ class TestLazyClient(object):
 
         with pytest.raises(exceptions.ServerUnavailable):
             c.hello()
+
+    def test_client_usable_after_failure(self):
+        addr = get_random_ipc_socket()
+        c = pirate.Lazy(retries=2, timeout=50, address=addr)
+        with pytest.raises(exceptions.ServerUnavailable):
+            c.hello()
+
+        with utils.TestingServer(self.get_methods(), addr):
+            assert 'world' == c.hello()
+
+    def test_failover(self):
+        dead, live = get_random_ipc_socket(), get_random_ipc_socket()
+        with utils.TestingServer(self.get_methods(), live):
+            c = pirate.Lazy(timeout=100, address=[dead, live])
+            assert 'world' == c.hello()
+            assert 'world' == c.hello()
+            assert [e.failures for e in c.endpoints] == [1, 0]
+            assert c.endpoints[0].retry_at > 0
+            assert c.endpoints[1].latency is not None
+
+    def test_retry_not_run_twice(self):
+        addr = get_random_ipc_socket()
+        calls = []
+        methods = self.get_methods()
+
+        @methods.register
+        def slow(request):
+            calls.append(None)
+            time.sleep(.3)
+            return len(calls)
+
+        with utils.TestingServer(methods, addr,
+                                 server_class=DedupServer):
+            c = pirate.Lazy(timeout=200, address=addr)
+            assert c.slow() == 1
+            assert len(calls) == 1
+
+
+class TestEndpointSelection(object):
+
+    def test_choose_endpoint(self):
+        c = pirate.Lazy(address=['inproc://a', 'inproc://b', 'inproc://c'])
+        a, b, cc = c.endpoints
+        a.succeeded(.5, c.latency_alpha)
+        b.succeeded(.1, c.latency_alpha)
+        cc.succeeded(.3, c.latency_alpha)
+        assert c._choose_endpoint() is b
+
+        ## Failing endpoints are avoided, with exponential backoff
+        now = time.time()
+        b.failed(now, 1, 10)
+        b.failed(now, 1, 10)
+        assert b.retry_at == now + 2
+        assert c._choose_endpoint() is cc
+
+        for endpoint in c.endpoints:
+            endpoint.failed(now, 1, 10)
+        assert c._choose_endpoint() is a  # The first to come back
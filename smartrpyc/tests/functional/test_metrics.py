@@ -0,0 +1,49 @@
+"""
+Tests for the metrics middleware
+"""
+
+import pytest
+
+from smartrpyc.client import Client, RemoteException
+from smartrpyc.server import MethodsRegister, MetricsMiddleware
+from smartrpyc.utils import get_random_ipc_socket
+from smartrpyc.tests import utils
+
+
+class TestMetrics(object):
+
+    def get_methods(self):
+        methods = MethodsRegister()
+
+        @methods.register
+        def hello(request, name=u'world'):
+            return u'Hello, {0}!'.format(name)
+
+        @methods.register
+        def fail(request):
+            raise ValueError("Failed")
+
+        return methods
+
+    def test_metrics(self):
+        addr = get_random_ipc_socket()
+        middleware = MetricsMiddleware(measure_responses=True)
+        with utils.TestingServer(self.get_methods(), addr,
+                                 middleware=[middleware]):
+            client = Client(addr)
+            for _ in range(3):
+                client.hello()
+            with pytest.raises(RemoteException):
+                client.fail()
+
+            metrics = client.metrics()
+            assert set(metrics) == set(['hello', 'fail'])
+            assert metrics['hello']['calls'] == 3
+            assert metrics['hello']['latency']['count'] == 3
+            assert metrics['hello']['response_size']['count'] == 3
+            assert metrics['fail']['errors'] == {'ValueError': 1}
+
+            text = client.metrics_text()
+            assert 'smartrpyc_calls_total{method="hello"} 3\n' in text
+            assert 'smartrpyc_response_bytes_count{method="hello"} 3\n' \
+                in text
@@ -0,0 +1,109 @@
+"""
+Tests for the client sockets pool
+"""
+
+import threading
+import time
+
+import pytest
+
+from smartrpyc.client import ClientPool, RemoteException
+from smartrpyc.client.exceptions import PoolExhausted, ServerUnavailable
+from smartrpyc.server import MethodsRegister, ThreadPoolServer
+from smartrpyc.utils import get_random_ipc_socket
+from smartrpyc.tests import utils
+
+
+class TestClientPool(object):
+
+    def get_methods(self):
+        methods = MethodsRegister()
+
+        @methods.register
+        def hello(request, name=u'world'):
+            return u"Hello, {0}!".format(name)
+
+        @methods.register
+        def sleep(request, seconds):
+            time.sleep(seconds)
+
+        @methods.register
+        def raise_value_error(request):
+            raise ValueError
+
+        return methods
+
+    def get_server(self, addr):
+        return utils.TestingServer(
+            self.get_methods(), addr, server_class=ThreadPoolServer)
+
+    def test_sockets_are_reused(self):
+        addr = get_random_ipc_socket()
+        pool = ClientPool()
+        with self.get_server(addr):
+            client = pool.client(addr)
+            assert client.hello() == u'Hello, world!'
+            socket = pool._idle[addr][-1][0]
+            assert client.hello(u'man') == u'Hello, man!'
+            assert pool._idle[addr][-1][0] is socket
+            assert pool._count[addr] == 1
+
+            ## Remote exceptions do not spoil the socket
+            with pytest.raises(RemoteException):
+                client.raise_value_error()
+            assert pool._idle[addr][-1][0] is socket
+
+    def test_shared_between_threads(self):
+        addr = get_random_ipc_socket()
+        pool = ClientPool(max_sockets=3)
+        with self.get_server(addr):
+            client = pool.client(addr)
+            results = {}
+
+            def call(i):
+                for j in xrange(5):
+                    results[i, j] = client.hello(u'{0}-{1}'.format(i, j))
+
+            threads = [threading.Thread(target=call, args=(i,))
+                       for i in xrange(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            assert results == dict(
+                ((i, j), u'Hello, {0}-{1}!'.format(i, j))
+                for i in xrange(10) for j in xrange(5))
+            assert 0 < pool._count[addr] <= 3
+            assert len(pool._idle[addr]) == pool._count[addr]
+
+    def test_pool_exhausted(self):
+        addr = get_random_ipc_socket()
+        pool = ClientPool(max_sockets=1)
+        socket = pool.checkout(addr)
+        with pytest.raises(PoolExhausted):
+            pool.checkout(addr, timeout=.1)
+        pool.checkin(addr, socket)
+        assert pool.checkout(addr, timeout=.1) is socket
+
+    def test_idle_sockets_are_evicted(self):
+        addr = get_random_ipc_socket()
+        pool = ClientPool(max_idle=.05)
+        socket1 = pool.checkout(addr)
+        socket2 = pool.checkout(addr)
+        pool.checkin(addr, socket1)
+        time.sleep(.1)
+        pool.checkin(addr, socket2)
+        assert socket1.closed
+        assert not socket2.closed
+        assert pool._count[addr] == 1
+
+    def test_timeout_discards_socket(self):
+        addr = get_random_ipc_socket()
+        pool = ClientPool()
+        with self.get_server(addr):
+            client = pool.client(addr, timeout=100)
+            with pytest.raises(ServerUnavailable):
+                client.sleep(.5)
+            assert pool._count[addr] == 0
+            assert client.hello() == u'Hello, world!'
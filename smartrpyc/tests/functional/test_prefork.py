@@ -0,0 +1,137 @@
+"""
+Tests for the pre-forked server
+"""
+
+import os
+import threading
+import time
+
+import zmq
+
+import pytest
+
+from smartrpyc.client import Client, RemoteException
+from smartrpyc.server import MethodsRegister, PreforkServer
+from smartrpyc.utils import get_random_ipc_socket
+from smartrpyc.utils.serialization import MsgPackSerializer
+from smartrpyc.tests import utils
+
+
+class SyncedServer(PreforkServer):
+    max_clock_skew = 0.01
+
+
+class DedupServer(PreforkServer):
+    dedup_max_entries = 1024
+
+
+class TestPreforkServer(object):
+
+    def get_methods(self):
+        methods = MethodsRegister()
+
+        @methods.register
+        def getpid(request, seconds=0):
+            time.sleep(seconds)
+            return os.getpid()
+
+        @methods.register
+        def die(request):
+            os._exit(1)
+
+        calls = []
+
+        @methods.register
+        def counter(request):
+            calls.append(None)
+            return len(calls)
+
+        return methods
+
+    def get_server(self, addr, processes=2, prefork_class=PreforkServer,
+                   **kwargs):
+        kwargs['processes'] = processes
+        return utils.TestingServer(
+            self.get_methods(), addr, server_class=prefork_class,
+            server_kwargs=kwargs)
+
+    def test_requests_spread_across_workers(self):
+        addr = get_random_ipc_socket()
+        with self.get_server(addr, processes=3):
+            pids = []
+
+            def call():
+                pids.append(Client(addr).getpid(.3))
+
+            threads = [threading.Thread(target=call) for _ in xrange(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            assert len(set(pids)) == 3
+            assert os.getpid() not in pids
+
+    def test_dead_worker_is_restarted(self):
+        addr = get_random_ipc_socket()
+        with self.get_server(addr, processes=1) as proc:
+            pid = Client(addr).getpid()
+
+            ## The client socket is left waiting for a reply forever
+            Client(addr)._do_request('die', (), {})
+
+            time.sleep(proc.rpc.supervise_interval * 2)
+            new_pid = Client(addr).getpid()
+            assert new_pid != pid
+
+    def test_bad_messages_keep_the_worker(self):
+        addr = get_random_ipc_socket()
+        with self.get_server(addr, processes=1):
+            pid = Client(addr).getpid()
+
+            ## Neither a message without envelope delimiter, nor one
+            ## that cannot be unpacked, kill the worker
+            socket = zmq.Context.instance().socket(zmq.DEALER)
+            socket.connect(addr)
+            socket.send(b'junk')
+            socket.send_multipart([b'', b'\xc1'])
+            assert socket.poll(2000)
+            reply = MsgPackSerializer.unpackb(socket.recv_multipart()[1])
+            assert 'e' in reply
+            socket.close()
+
+            assert Client(addr).getpid() == pid
+
+    def test_arrival_time(self):
+        addr = get_random_ipc_socket()
+        with self.get_server(addr, processes=1):
+            ## The time to reach the worker is timed, as it is known
+            client = Client(addr)
+            client.request_timings = True
+            client.getpid()
+            assert client.last_timings[0][0] == 'queue'
+
+    def test_absolute_deadline(self):
+        addr = get_random_ipc_socket()
+        with self.get_server(addr, processes=1, prefork_class=SyncedServer):
+            Client(addr).getpid()
+
+            ## Keep the only worker busy: the call waits in the broker
+            thread = threading.Thread(target=Client(addr).getpid, args=(.5,))
+            thread.start()
+            time.sleep(.1)
+
+            client = Client(addr)
+            client.call_timeout = .2
+            with pytest.raises(RemoteException) as excinfo:
+                client.getpid()
+            assert excinfo.value.original_exc == 'DeadlineExceeded'
+            thread.join()
+
+    def test_settings_reach_workers(self):
+        addr = get_random_ipc_socket()
+        with self.get_server(addr, processes=1, prefork_class=DedupServer):
+            request = {'i': 'retried', 'm': 'counter'}
+            assert Client(addr)._exchange(dict(request))['r'] == 1
+            assert Client(addr)._exchange(dict(request))['r'] == 1
+            assert Client(addr).counter() == 2
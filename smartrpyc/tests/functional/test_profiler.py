@@ -0,0 +1,84 @@
+"""
+Tests for the profiler middleware
+"""
+
+import pytest
+
+from smartrpyc.client import Client, RemoteException
+from smartrpyc.server import MethodsRegister, ProfilerMiddleware, \
+    ServerMiddlewareBase
+from smartrpyc.server import profiler
+from smartrpyc.utils import get_random_ipc_socket
+from smartrpyc.tests import utils
+
+
+def fibonacci(n):
+    return n if n < 2 else fibonacci(n - 1) + fibonacci(n - 2)
+
+
+class DenyCompute(ServerMiddlewareBase):
+    def pre(self, request, method):
+        if request.method == 'compute':
+            raise ValueError("Access denied")
+
+
+class TestProfiler(object):
+
+    def get_methods(self):
+        methods = MethodsRegister()
+
+        @methods.register
+        def compute(request, n):
+            return fibonacci(n)
+
+        @methods.register
+        def hello(request):
+            return u'Hello, world!'
+
+        return methods
+
+    def test_profiler(self):
+        addr = get_random_ipc_socket()
+        middleware = ProfilerMiddleware(sample_rate=0)
+        with utils.TestingServer(self.get_methods(), addr,
+                                 middleware=[middleware]):
+            client = Client(addr)
+            assert client.compute(10) == 55
+            assert client.profile() == {}
+
+            client.profile(rate=1)
+            assert client.compute(10) == 55
+            assert client.compute(5) == 5
+            assert client.hello() == u'Hello, world!'
+
+            stats = client.profile(method='compute', reset=True)
+            assert list(stats) == ['compute']
+            assert stats['compute']['calls'] == 2
+            assert 'fibonacci' in stats['compute']['stats']
+
+            ## Only the statistics of 'compute' were forgotten
+            assert list(client.profile()) == ['hello']
+            middleware.reset()
+            assert client.profile() == {}
+
+    def test_middleware_after_profiler(self):
+        addr = get_random_ipc_socket()
+        middleware = ProfilerMiddleware(sample_rate=1)
+        with utils.TestingServer(self.get_methods(), addr,
+                                 middleware=[middleware, DenyCompute()]):
+            client = Client(addr)
+            ## Profiled calls still go through the middleware after it
+            with pytest.raises(RemoteException):
+                client.compute(10)
+            assert client.hello() == u'Hello, world!'
+            assert list(client.profile()) == ['hello']
+
+    def test_one_profile_at_a_time(self):
+        middleware = ProfilerMiddleware(sample_rate=1)
+        profiled = middleware._profiled('compute', fibonacci)
+        ## Another call is being profiled: just run this one
+        with profiler._profiling:
+            assert profiled(10) == 55
+        assert middleware.dump() == {}
+        assert profiled(10) == 55
+        assert middleware.dump()['compute']['calls'] == 1
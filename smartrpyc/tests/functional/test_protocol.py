@@ -0,0 +1,163 @@
+"""
+Tests for the negotiation of the compact protocol
+"""
+
+import pytest
+
+from smartrpyc.client import Client, RemoteException
+from smartrpyc.server import MethodsRegister, Server
+from smartrpyc.utils.protocol import MethodsTable
+from smartrpyc.utils import get_random_ipc_socket
+from smartrpyc.tests import utils
+
+
+class V1Server(Server):
+    protocol_version = 1
+
+
+class UncompressedServer(Server):
+    compression_codecs = []
+
+
+class CountingServer(Server):
+    """Server counting the messages it receives"""
+
+    def __init__(self, methods=None):
+        super(CountingServer, self).__init__(methods)
+        self.received = 0
+
+    def _handle_frames(self, frames, received_at=None, envelope=None):
+        self.received += 1
+        return super(CountingServer, self)._handle_frames(
+            frames, received_at, envelope)
+
+
+class TestProtocolNegotiation(object):
+
+    def get_methods(self):
+        methods = MethodsRegister()
+
+        @methods.register
+        def hello(request, name=u'world'):
+            return u'Hello, {0}!'.format(name)
+
+        @methods.register
+        def protocol(request):
+            return request.protocol
+
+        @methods.register
+        def echo(request, value):
+            return value
+
+        @methods.register
+        def reply_codec(request):
+            return request.get('z')
+
+        @methods.register
+        def fail(request):
+            raise ValueError("Failed")
+
+        return methods
+
+    def _run_tests(self, client):
+        assert client.hello() == u'Hello, world!'
+        assert client.hello(name=u'v2') == u'Hello, v2!'
+        assert client.echo(b'x' * (2 << 20)).tobytes() == b'x' * (2 << 20)
+        with pytest.raises(RemoteException):
+            client.fail()
+        with pytest.raises(RemoteException):
+            client.no_such_method()
+        with client.batch() as batch:
+            result = batch.hello(u'batch')
+        assert result.result() == u'Hello, batch!'
+
+    def test_negotiated(self):
+        addr = get_random_ipc_socket()
+        with utils.TestingServer(self.get_methods(), addr) as proc:
+            client = Client(addr)
+            self._run_tests(client)
+            assert isinstance(client._protocol, MethodsTable)
+            assert client.protocol() == 2
+
+            ## Servers with the same methods accept the table
+            table_id = client._protocol.id
+            proc.rpc.methods_tables.clear()
+            assert client.hello() == u'Hello, world!'
+            assert client._protocol.id == table_id
+
+            ## ..those with others make clients negotiate again
+            proc.rpc.methods_tables.clear()
+            proc.rpc.methods.register(lambda request: None, name='added')
+            assert client.hello() == u'Hello, world!'
+            assert client._protocol.id != table_id
+
+    def test_not_supported(self):
+        addr = get_random_ipc_socket()
+        with utils.TestingServer(self.get_methods(), addr,
+                                 server_class=V1Server):
+            client = Client(addr)
+            self._run_tests(client)
+            assert client._protocol is False
+            assert client.protocol() == 1
+
+    def test_no_extra_roundtrip(self):
+        addr = get_random_ipc_socket()
+        with utils.TestingServer(self.get_methods(), addr,
+                                 server_class=CountingServer) as proc:
+            ## Negotiated along with the first call
+            client = Client(addr)
+            assert client.protocol() == 1
+            assert client.protocol() == 2
+            assert proc.rpc.received == 2
+
+            ## Nothing to negotiate
+            client = Client(addr)
+            client.protocol_version = 1
+            assert client.protocol() == 1
+            assert client._protocol is False
+            assert proc.rpc.received == 3
+
+    def test_disabled_on_client(self):
+        addr = get_random_ipc_socket()
+        with utils.TestingServer(self.get_methods(), addr):
+            client = Client(addr)
+            client.protocol_version = 1
+            self._run_tests(client)
+            assert client.protocol() == 1
+
+
+class TestCompression(TestProtocolNegotiation):
+
+    def _run_compressed(self, client):
+        client.compression = 'zlib'
+        client.compression_threshold = 1024
+        self._run_tests(client)
+        text = u'compressible ' * 10000
+        assert client.echo(text) == text
+        assert client.echo([text, {u'x': text}]) == [text, {u'x': text}]
+
+    def test_negotiated(self):
+        addr = get_random_ipc_socket()
+        with utils.TestingServer(self.get_methods(), addr):
+            client = Client(addr)
+            self._run_compressed(client)
+            assert client._codec.name == 'zlib'
+            assert client.reply_codec() == client._codec.id
+
+    def test_v1(self):
+        addr = get_random_ipc_socket()
+        with utils.TestingServer(self.get_methods(), addr,
+                                 server_class=V1Server):
+            client = Client(addr)
+            self._run_compressed(client)
+            assert client._protocol is False
+            assert client._codec.name == 'zlib'
+
+    def test_not_supported(self):
+        addr = get_random_ipc_socket()
+        with utils.TestingServer(self.get_methods(), addr,
+                                 server_class=UncompressedServer):
+            client = Client(addr)
+            self._run_compressed(client)
+            assert client._codec is None
+            assert client.reply_codec() is None
@@ -0,0 +1,74 @@
+"""
+Tests for servers accepting several serializers
+"""
+
+import pytest
+
+from smartrpyc.client import Client, RemoteException
+from smartrpyc.server import MethodsRegister, Server
+from smartrpyc.utils import get_random_ipc_socket
+from smartrpyc.utils.serialization import CustomMsgPackSerializer, \
+    MsgPackSerializer, NumpySerializer, PickleSerializer
+from smartrpyc.tests import utils
+
+
+class MixedServer(Server):
+    serializers = [CustomMsgPackSerializer, PickleSerializer]
+
+
+class TestSerializers(object):
+
+    def get_methods(self):
+        methods = MethodsRegister()
+
+        @methods.register
+        def serializer(request):
+            return request.packer.__name__
+
+        @methods.register
+        def echo(request, value):
+            return value
+
+        @methods.register
+        def fail(request):
+            raise ValueError("Failed")
+
+        return methods
+
+    def _client(self, addr, packer, **kwargs):
+        client = Client(addr)
+        client.packer = packer
+        for key, value in kwargs.items():
+            setattr(client, key, value)
+        return client
+
+    def test_mixed_clients(self):
+        addr = get_random_ipc_socket()
+        with utils.TestingServer(self.get_methods(), addr,
+                                 server_class=MixedServer):
+            for packer in [MsgPackSerializer, CustomMsgPackSerializer,
+                           PickleSerializer]:
+                client = self._client(addr, packer)
+                assert client.serializer() == packer.__name__
+                assert client.echo([u'text', 1]) == [u'text', 1]
+                with pytest.raises(RemoteException):
+                    client.fail()
+
+            ## Blobs keep their type with serializers supporting them
+            client = self._client(addr, CustomMsgPackSerializer)
+            assert client.echo(b'\x00\x01') == b'\x00\x01'
+
+            ## ..also when compressed
+            client = self._client(addr, PickleSerializer,
+                                  compression='zlib', compression_threshold=0)
+            text = u'compressible ' * 1000
+            assert client.echo(text) == text
+
+    def test_unsupported(self):
+        addr = get_random_ipc_socket()
+        with utils.TestingServer(self.get_methods(), addr,
+                                 server_class=MixedServer):
+            client = self._client(addr, NumpySerializer)
+            with pytest.raises(RemoteException) as excinfo:
+                client.echo(1)
+            assert excinfo.value.original_exc == 'UnsupportedSerializer'
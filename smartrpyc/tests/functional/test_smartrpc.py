@@ -202,3 +202,70 @@ class TestSmartrpcFunctionality(object):
                 client.no_such_method()
 
             client.method1()  # The server must still be alive here..
+
+    def test_batch_call(self):
+        addr = get_random_ipc_socket()
+        with utils.TestingServer(methods=self.get_methods(), addresses=addr):
+            context = zmq.Context()
+            socket = context.socket(zmq.REQ)
+            socket.connect(addr)
+            socket.send(msgpack.packb({
+                'i': 'batch-id',
+                'b': [
+                    {'m': 'method1'},
+                    {'m': 'method2', 'a': ['WORLD']},
+                    {'m': 'raise_value_error'},
+                    {'m': 'method3', 'k': {'name': 'MAN'}},
+                ],
+            }, encoding='utf-8'))
+            response = msgpack.unpackb(socket.recv(), encoding='utf-8')
+            assert response == {
+                'i': 'batch-id',
+                'r': [
+                    {'r': 'Hello, world!'},
+                    {'r': 'Hello, WORLD!'},
+                    {'e': 'ValueError', 'e_msg': ''},
+                    {'r': 'Hello, MAN!'},
+                ],
+            }
+
+    def test_batch_with_client(self):
+        addr = get_random_ipc_socket()
+        with utils.TestingServer(methods=self.get_methods(), addresses=addr):
+            client = Client(addr)
+
+            with client.batch() as batch:
+                result1 = batch.method1()
+                result2 = batch.method2(u'Ẅøřłđ')
+                error = batch.raise_value_error()
+                result3 = batch.method3(greeting='Hi')
+
+            assert result1.result() == u'Hello, world!'
+            assert result2.result() == u'Hello, Ẅøřłđ!'
+            with pytest.raises(RemoteException):
+                error.result()
+            assert result3.result() == u'Hi, world!'
+
+            batch = client.batch()
+            batch.get_list()
+            batch.no_such_method()
+            results = batch.execute()
+            assert results[0] == ['this', 'is', 'a', 'list']
+            assert isinstance(results[1], RemoteException)
+            assert batch.execute() == []
+
+    def test_batch_middleware_per_call(self):
+        calls = []
+
+        class RecordingMiddleware(object):
+            def pre(self, request, method):
+                calls.append(request.method)
+
+        addr = get_random_ipc_socket()
+        with utils.TestingServer(methods=self.get_methods(), addresses=addr,
+                                 middleware=[RecordingMiddleware()]):
+            batch = Client(addr).batch()
+            batch.method1()
+            batch.method2(u'man')
+            batch.execute()
+            assert calls == ['method1', 'method2']
@@ -0,0 +1,125 @@
+"""
+Tests for streaming responses
+"""
+
+import pytest
+
+from smartrpyc.client import Client, RemoteException, Stream
+from smartrpyc.server import MethodsRegister, Server, ThreadPoolServer
+from smartrpyc.utils import get_random_ipc_socket
+from smartrpyc.tests import utils
+
+
+class TestStreams(object):
+
+    def get_methods(self, produced):
+        methods = MethodsRegister()
+
+        @methods.register
+        def count(request, n):
+            for i in xrange(n):
+                produced.append(i)
+                yield i
+
+        @methods.register
+        def fail_after(request, n):
+            for i in xrange(n):
+                yield i
+            raise ValueError("Enough")
+
+        @methods.register
+        def streams_count(request):
+            return len(request.server.streams)
+
+        return methods
+
+    def _run_tests(self, addr, produced):
+        client = Client(addr)
+        client.stream_credit = 10
+
+        stream = client.count(100)
+        assert isinstance(stream, Stream)
+        assert list(stream) == range(100)
+        assert client.streams_count() == 0
+
+        ## Items are produced only when asked for
+        del produced[:]
+        stream = client.count(100)
+        assert len(produced) == Server.stream_credit
+        for _ in xrange(Server.stream_credit + 1):
+            next(stream)
+        assert len(produced) == Server.stream_credit + 10
+
+        ## Closing the stream frees the generator on the server
+        assert client.streams_count() == 1
+        stream.close()
+        assert client.streams_count() == 0
+
+        with client.count(100) as stream:
+            next(stream)
+        assert client.streams_count() == 0
+
+        ## Errors are raised after the items yielded before them
+        stream = client.fail_after(30)
+        assert [next(stream) for _ in xrange(30)] == range(30)
+        with pytest.raises(RemoteException):
+            next(stream)
+        with pytest.raises(StopIteration):
+            next(stream)
+        assert client.streams_count() == 0
+
+        assert list(client.count(0)) == []
+
+        with client.batch() as batch:
+            result = batch.count(3)
+        assert list(result.result()) == [0, 1, 2]
+
+    def test_server(self):
+        addr = get_random_ipc_socket()
+        produced = []
+        with utils.TestingServer(self.get_methods(produced), addr):
+            self._run_tests(addr, produced)
+
+    def test_thread_pool_server(self):
+        addr = get_random_ipc_socket()
+        produced = []
+        with utils.TestingServer(self.get_methods(produced), addr,
+                                 server_class=ThreadPoolServer):
+            self._run_tests(addr, produced)
+
+    def test_unknown_stream(self):
+        addr = get_random_ipc_socket()
+        with utils.TestingServer(self.get_methods([]), addr):
+            client = Client(addr)
+            with pytest.raises(RemoteException):
+                list(Stream(client, {'s': 'nonexistent', 'c': []}))
+
+
+class TestStreamsTable(object):
+
+    def test_abandoned_streams_expire(self):
+        from smartrpyc.server import StreamsTable
+
+        closed = []
+
+        def generator():
+            try:
+                yield 1
+            finally:
+                closed.append(True)
+
+        table = StreamsTable(timeout=0)
+        stream_id = table.open(generator())
+        next(table.get(stream_id))
+        table._last_expire = 0
+        table.open(iter([]))
+        assert stream_id not in table
+        assert closed == [True]
+
+        ## Pulling other streams expires them too
+        stream_id = table.open(generator())
+        next(table.get(stream_id))
+        table._last_expire = 0
+        with pytest.raises(KeyError):
+            table.get(stream_id)
+        assert closed == [True, True]
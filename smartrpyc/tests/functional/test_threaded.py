@@ -0,0 +1,107 @@
+"""
+Tests for the thread-pool server
+"""
+
+import threading
+import time
+
+import pytest
+import zmq
+
+from smartrpyc.client import Client, RemoteException
+from smartrpyc.server import MethodsRegister, ThreadPoolServer
+from smartrpyc.utils import get_random_ipc_socket
+from smartrpyc.tests import utils
+
+
+class TestThreadPoolServer(object):
+
+    def get_methods(self):
+        methods = MethodsRegister()
+
+        @methods.register
+        def hello(request, name=u'world'):
+            return u"Hello, {0}!".format(name)
+
+        @methods.register
+        def sleep(request, seconds):
+            time.sleep(seconds)
+            return seconds
+
+        @methods.register
+        def raise_value_error(request):
+            raise ValueError
+
+        return methods
+
+    def get_server(self, addr, workers=4):
+        return utils.TestingServer(
+            self.get_methods(), addr, server_class=ThreadPoolServer,
+            server_kwargs={'workers': workers})
+
+    def test_with_client(self):
+        addr = get_random_ipc_socket()
+        with self.get_server(addr):
+            client = Client(addr)
+            assert client.hello() == u'Hello, world!'
+            assert client.hello(u'WORLD') == u'Hello, WORLD!'
+            assert client.hello(name=u'man') == u'Hello, man!'
+
+            with pytest.raises(RemoteException):
+                client.raise_value_error()
+
+            with pytest.raises(RemoteException):
+                client.no_such_method()
+
+            assert client.hello() == u'Hello, world!'
+
+    def test_slow_method_does_not_block(self):
+        addr = get_random_ipc_socket()
+        with self.get_server(addr, workers=2):
+            results = []
+            slow_call = threading.Thread(
+                target=lambda: results.append(Client(addr).sleep(.5)))
+            slow_call.start()
+            time.sleep(.1)
+
+            start = time.time()
+            assert Client(addr).hello() == u'Hello, world!'
+            assert time.time() - start < .4
+
+            slow_call.join()
+            assert results == [.5]
+
+    def test_replies_are_routed(self):
+        addr = get_random_ipc_socket()
+        with self.get_server(addr, workers=3):
+            results = {}
+
+            def call(i):
+                results[i] = Client(addr).hello(u'client {0}'.format(i))
+
+            threads = [threading.Thread(target=call, args=(i,))
+                       for i in xrange(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            assert results == dict(
+                (i, u'Hello, client {0}!'.format(i)) for i in xrange(10))
+
+    def test_malformed_message_is_dropped(self):
+        addr = get_random_ipc_socket()
+        with self.get_server(addr):
+            assert Client(addr).hello() == u'Hello, world!'
+            socket = zmq.Context.instance().socket(zmq.DEALER)
+            socket.connect(addr)
+            socket.send(b'junk')  # No envelope delimiter
+            socket.close()
+
+            results = []
+            call = threading.Thread(
+                target=lambda: results.append(Client(addr).hello()))
+            call.daemon = True
+            call.start()
+            call.join(2)
+            assert results == [u'Hello, world!']
@@ -0,0 +1,85 @@
+"""
+Tests for the timings of the phases of requests
+"""
+
+import time
+
+from smartrpyc.client import Client
+from smartrpyc.server import MethodsRegister, Server, ServerMiddlewareBase, \
+    ThreadPoolServer
+from smartrpyc.utils import get_random_ipc_socket
+from smartrpyc.tests import utils
+
+
+class SlowMiddleware(ServerMiddlewareBase):
+
+    def pre(self, request, method):
+        time.sleep(0.05)
+
+    def post(self, request, method, response, exception):
+        pass
+
+
+class RecordingServer(Server):
+    record_timings = True
+
+
+class TestTimings(object):
+
+    def get_methods(self):
+        methods = MethodsRegister()
+
+        @methods.register
+        def sleep(request, seconds):
+            time.sleep(seconds)
+
+        return methods
+
+    def _check_timings(self, client, first_phase):
+        client.request_timings = True
+        client.sleep(0.1)
+        phases = [phase for phase, _ in client.last_timings]
+        assert phases == [
+            first_phase, 'unpack', 'lookup', 'pre:SlowMiddleware', 'method',
+            'post:SlowMiddleware']
+        timings = dict(client.last_timings)
+        assert timings['pre:SlowMiddleware'] >= 0.05
+        assert timings['method'] >= 0.1
+        assert timings['unpack'] < 0.05
+
+    def test_requested(self):
+        addr = get_random_ipc_socket()
+        with utils.TestingServer(self.get_methods(), addr,
+                                 middleware=[SlowMiddleware()]) as proc:
+            client = Client(addr)
+            client.sleep(0)
+            assert client.last_timings is None
+            self._check_timings(client, 'queue')
+            ## Not aggregated, unless asked for
+            assert proc.rpc.phase_timings.snapshot() == {}
+
+    def test_thread_pool(self):
+        addr = get_random_ipc_socket()
+        with utils.TestingServer(self.get_methods(), addr,
+                                 middleware=[SlowMiddleware()],
+                                 server_class=ThreadPoolServer):
+            self._check_timings(Client(addr), 'queue')
+
+    def test_recorded(self):
+        addr = get_random_ipc_socket()
+        with utils.TestingServer(self.get_methods(), addr,
+                                 middleware=[SlowMiddleware()],
+                                 server_class=RecordingServer) as proc:
+            client = Client(addr)
+            for _ in range(3):
+                client.sleep(0)
+            assert client.last_timings is None
+            client.sleep(0)  # The timings of the previous send are recorded
+
+            timings = proc.rpc.phase_timings.snapshot()
+            assert timings['method']['count'] == 4
+            assert timings['pack']['count'] == 4
+            assert timings['send']['count'] >= 3
+            assert timings['pre:SlowMiddleware']['mean'] >= 0.05
+            proc.rpc.phase_timings.reset()
+            assert proc.rpc.phase_timings.snapshot() == {}
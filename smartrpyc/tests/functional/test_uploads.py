@@ -0,0 +1,186 @@
+"""
+Tests for streaming uploads
+"""
+
+import io
+import threading
+import time
+
+import pytest
+
+from smartrpyc.client import Client, RemoteException
+from smartrpyc.server import MethodsRegister, Server, \
+    ServerMiddlewareBase, ThreadPoolServer
+from smartrpyc.utils import get_random_ipc_socket
+from smartrpyc.tests import utils
+
+
+class DenyMeasure(ServerMiddlewareBase):
+    def pre(self, request, method):
+        if request.method == 'measure':
+            raise ValueError("Denied")
+
+
+class TestUploads(object):
+
+    def get_methods(self, received):
+        methods = MethodsRegister()
+
+        @methods.register
+        def measure(request, data):
+            sizes = []
+            for chunk in data:
+                received.append(chunk)
+                sizes.append(len(chunk))
+            return [len(sizes), sum(sizes)]
+
+        @methods.register
+        def join(request, prefix, items=(), sep=u''):
+            return prefix + sep.join(items)
+
+        @methods.register
+        def first(request, items):
+            return next(items)
+
+        @methods.register
+        def reject(request, items):
+            raise ValueError("Not interested")
+
+        @methods.register
+        def slow_count(request, items):
+            count = 0
+            for _ in items:
+                time.sleep(.2)
+                count += 1
+            return count
+
+        return methods
+
+    def _run_tests(self, addr):
+        client = Client(addr)
+        client.upload_chunk_size = 1000
+
+        assert client.measure(io.BytesIO(b'x' * 100500)) == [101, 100500]
+        assert client.measure(iter([])) == [0, 0]
+        assert client.join(u'>', items=iter([u'a', u'b', u'c']),
+                           sep=u'-') == u'>a-b-c'
+        assert client.join(u'>', (u'item{0}'.format(i)
+                                  for i in xrange(3))) == \
+            u'>item0item1item2'
+
+        ## The whole upload is not needed
+        assert client.first(iter([u'a', u'b', u'c'])) == u'a'
+        with pytest.raises(RemoteException):
+            client.reject(iter([u'a', u'b', u'c']))
+
+        ## Normal calls keep working
+        assert client.join(u'>', [u'a', u'b']) == u'>ab'
+
+        with pytest.raises(ValueError):
+            client.join(iter([u'a']), iter([u'b']))
+
+    def test_spooled(self):
+        addr = get_random_ipc_socket()
+        with utils.TestingServer(self.get_methods([]), addr):
+            self._run_tests(addr)
+
+    def test_thread_pool_server(self):
+        addr = get_random_ipc_socket()
+        with utils.TestingServer(self.get_methods([]), addr,
+                                 server_class=ThreadPoolServer):
+            self._run_tests(addr)
+
+    def test_consumed_while_arriving(self):
+        addr = get_random_ipc_socket()
+        received = []
+
+        def generate():
+            for i in xrange(5):
+                ## The method gets the chunks sent so far (all but
+                ## the last one, held back to mark the end of upload)
+                deadline = time.time() + 2
+                while len(received) < i - 1 and time.time() < deadline:
+                    time.sleep(.01)
+                assert len(received) >= i - 1
+                yield u'chunk{0}'.format(i)
+
+        with utils.TestingServer(self.get_methods(received), addr,
+                                 server_class=ThreadPoolServer):
+            assert Client(addr).measure(generate()) == [5, 30]
+
+    def test_uploads_do_not_tie_up_workers(self):
+        class SmallServer(ThreadPoolServer):
+            upload_max_chunks = 1
+            upload_workers = 1  # The second upload waits for the first
+
+        addr = get_random_ipc_socket()
+        results = []
+
+        def upload():
+            results.append(Client(addr).slow_count(iter([u'x'] * 4)))
+
+        with utils.TestingServer(self.get_methods([]), addr,
+                                 server_class=SmallServer,
+                                 server_kwargs={'workers': 2}):
+            threads = [threading.Thread(target=upload) for _ in xrange(2)]
+            for thread in threads:
+                thread.start()
+            time.sleep(.5)  # The first upload is over, but not its method
+
+            start = time.time()
+            assert Client(addr).join(u'>', [u'a']) == u'>a'
+            assert time.time() - start < .2
+
+            for thread in threads:
+                thread.join()
+            assert results == [4, 4]
+
+    def test_abandoned_uploads_expire(self):
+        class ExpiringServer(ThreadPoolServer):
+            stream_timeout = .1
+
+        addr = get_random_ipc_socket()
+        methods = self.get_methods([])
+        aborted = []
+
+        @methods.register
+        def consume(request, items):
+            try:
+                list(items)
+            except IOError:
+                aborted.append(True)
+
+        def generate():
+            yield u'chunk'
+            raise RuntimeError("Gave up")
+
+        with utils.TestingServer(methods, addr,
+                                 server_class=ExpiringServer) as proc:
+            with pytest.raises(RuntimeError):
+                Client(addr).consume(generate())
+            assert len(proc.rpc.uploads) == 1
+
+            ## Even with no requests coming, the method is let go
+            deadline = time.time() + 3
+            while not aborted and time.time() < deadline:
+                time.sleep(.05)
+            assert aborted == [True]
+            assert len(proc.rpc.uploads) == 0
+
+    @pytest.mark.parametrize('server_class', [Server, ThreadPoolServer])
+    def test_rejected_before_upload(self, server_class):
+        addr = get_random_ipc_socket()
+        read = []
+
+        def generate():
+            for i in xrange(3):
+                read.append(i)
+                yield u'chunk{0}'.format(i)
+
+        with utils.TestingServer(self.get_methods([]), addr,
+                                 middleware=[DenyMeasure()],
+                                 server_class=server_class) as proc:
+            with pytest.raises(RemoteException):
+                Client(addr).measure(generate())
+            assert read == []
+            assert len(proc.rpc.uploads) == 0
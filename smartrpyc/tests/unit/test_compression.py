@@ -0,0 +1,83 @@
+"""
+Tests for the compression of messages
+"""
+
+import pytest
+
+from smartrpyc.server import Server
+from smartrpyc.utils.compression import Codec, CompressionError, \
+    compress_frame, decompress_frames, get_codec, list_codecs, \
+    register_codec
+from smartrpyc.utils.frames import pack_frames, unpack_frames
+from smartrpyc.utils.serialization import MsgPackSerializer
+
+
+class TestCompression(object):
+
+    def test_codecs(self):
+        assert 'zlib' in list_codecs()
+        assert get_codec('zlib') is get_codec(1)
+        assert get_codec('no-such-codec') is None
+        with pytest.raises(ValueError):
+            Codec('too-high', 16, None, None)
+        with pytest.raises(ValueError):
+            register_codec(Codec('other', 1, None, None))
+
+    def test_roundtrip(self):
+        codec = get_codec('zlib')
+        frame = b'\x81\xa1r' + b'x' * 1000
+        compressed = compress_frame(frame, codec)
+        assert len(compressed) < len(frame)
+        frames = decompress_frames([compressed, b'buffer'])
+        assert frames == [frame, b'buffer']
+
+    def test_not_compressed(self):
+        codec = get_codec('zlib')
+        ## Below the threshold
+        frame = b'x' * 1000
+        assert compress_frame(frame, codec, threshold=1000) is frame
+        ## Not made smaller
+        frame = b'\x81\xa1r\x01'
+        assert compress_frame(frame, codec) is frame
+        assert decompress_frames([frame]) == [frame]
+
+    def test_unknown_codec(self):
+        with pytest.raises(CompressionError):
+            decompress_frames([b'\x10\x0fdata'])
+
+    def test_accept(self):
+        frame = compress_frame(b'x' * 1000, get_codec('zlib'))
+        assert decompress_frames([frame], lambda name: name == 'zlib') == \
+            [b'x' * 1000]
+        with pytest.raises(CompressionError):
+            decompress_frames([frame], lambda name: False)
+
+    @pytest.mark.parametrize('name', list_codecs())
+    def test_max_size(self, name):
+        frame = compress_frame(b'x' * 1000, get_codec(name))
+        assert decompress_frames([frame], max_size=1000) == [b'x' * 1000]
+        with pytest.raises(CompressionError):
+            decompress_frames([frame], max_size=999)
+
+    def test_refused_by_server(self):
+        server = Server()
+        server.methods.register(lambda request, text: text, name='echo')
+        frames = pack_frames(MsgPackSerializer, {
+            'i': 1, 'm': 'echo', 'a': [u'x' * 100000]})
+        frames[0] = compress_frame(frames[0], get_codec('zlib'))
+
+        def call():
+            reply = unpack_frames(
+                MsgPackSerializer, server._handle_frames(list(frames)))
+            return reply.get('e'), reply.get('r')
+
+        assert call() == (None, u'x' * 100000)
+
+        ## Decompression bomb
+        server.max_decompressed_size = 10000
+        assert call() == ('CompressionError', None)
+
+        ## Codec not accepted
+        server.max_decompressed_size = 1 << 20
+        server.compression_codecs = []
+        assert call() == ('CompressionError', None)
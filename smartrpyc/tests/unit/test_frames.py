@@ -0,0 +1,48 @@
+"""
+Tests for multipart messages
+"""
+
+import pytest
+
+from smartrpyc.utils.frames import pack_frames, split_envelope, \
+    unpack_frames
+from smartrpyc.utils.serialization import MsgPackSerializer, PickleSerializer
+
+
+class TestFrames(object):
+    def test_large_buffers_get_their_frame(self):
+        blob = b'x' * 1000
+        message = {'m': 'upload', 'a': [blob, u'small'],
+                   'k': {'data': bytearray(blob), 'name': u'file'}}
+        frames = pack_frames(MsgPackSerializer, message, threshold=100)
+        assert len(frames) == 3
+        assert frames[1] is blob
+        assert len(frames[0]) < 100
+
+        ## The original message is untouched
+        assert message['a'][0] is blob
+
+        unpacked = unpack_frames(MsgPackSerializer, frames)
+        assert isinstance(unpacked['a'][0], memoryview)
+        assert unpacked['a'][0].tobytes() == blob
+        assert unpacked['a'][1] == u'small'
+        assert unpacked['k']['data'].tobytes() == blob
+        assert unpacked['k']['name'] == u'file'
+
+    def test_result(self):
+        frames = pack_frames(MsgPackSerializer, {'r': b'x' * 1000}, 100)
+        assert len(frames) == 2
+        assert unpack_frames(MsgPackSerializer, frames)['r'].tobytes() == \
+            b'x' * 1000
+
+    def test_disabled(self):
+        message = {'r': b'x' * 1000}
+        assert len(pack_frames(MsgPackSerializer, message)) == 1
+        ## Serializers without extension types support
+        assert len(pack_frames(PickleSerializer, message, 100)) == 1
+
+    def test_split_envelope(self):
+        assert split_envelope([b'id', b'', b'msg', b'blob']) == \
+            ([b'id', b''], [b'msg', b'blob'])
+        with pytest.raises(ValueError):
+            split_envelope([b'id', b'msg'])
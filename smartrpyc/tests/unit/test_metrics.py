@@ -0,0 +1,57 @@
+"""
+Tests for the metrics middleware
+"""
+
+from smartrpyc.server import Histogram, MetricsMiddleware, Request
+
+
+class TestHistogram(object):
+
+    def test_buckets(self):
+        histogram = Histogram(1, 4)
+        assert histogram.bounds == [1, 2, 4, 8]
+        for value in [0.5, 1, 1.5, 2, 3, 8, 9, 1000]:
+            histogram.observe(value)
+        assert histogram.counts == [2, 2, 1, 1, 2]
+        assert histogram.count == 8
+        assert histogram.snapshot()['buckets'][-1] == [None, 2]
+
+
+class TestMetricsMiddleware(object):
+
+    def _call(self, middleware, name, exception=None):
+        request = Request({'i': 1, 'm': name})
+        request.received_at = 0
+        request.size = 100
+        middleware.post(request, None, None, exception)
+
+    def test_snapshot(self):
+        middleware = MetricsMiddleware()
+        self._call(middleware, 'hello')
+        self._call(middleware, 'hello', ValueError())
+        snapshot = middleware.snapshot()
+        assert snapshot['hello']['calls'] == 2
+        assert snapshot['hello']['errors'] == {'ValueError': 1}
+        assert snapshot['hello']['request_size']['count'] == 2
+        middleware.reset()
+        assert middleware.snapshot() == {}
+
+    def test_max_methods(self):
+        middleware = MetricsMiddleware()
+        middleware.max_methods = 2
+        for name in ['a', 'b', 'c', 'd']:
+            self._call(middleware, name)
+        snapshot = middleware.snapshot()
+        assert sorted(snapshot) == ['<other>', 'a', 'b']
+        assert snapshot['<other>']['calls'] == 2
+
+    def test_prometheus_text(self):
+        middleware = MetricsMiddleware()
+        self._call(middleware, u'h\xe9llo"', KeyError())
+        text = middleware.prometheus_text()
+        assert u'smartrpyc_calls_total{method="h\xe9llo\\""} 1\n' in text
+        assert u'smartrpyc_errors_total{exception="KeyError",' \
+            u'method="h\xe9llo\\""} 1\n' in text
+        assert u'smartrpyc_latency_seconds_bucket{le="+Inf",' \
+            u'method="h\xe9llo\\""} 1\n' in text
+        assert u'smartrpyc_response_bytes' not in text
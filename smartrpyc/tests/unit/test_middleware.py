@@ -0,0 +1,111 @@
+"""
+Tests for the compiled middleware chains
+"""
+
+from smartrpyc.client import Client
+from smartrpyc.server import Request, Server, ServerMiddlewareBase
+from smartrpyc.utils.middleware import MiddlewareChain
+
+
+class Recorder(ServerMiddlewareBase):
+    def __init__(self, name, calls, applies_to=None):
+        self.name = name
+        self.calls = calls
+        self.applies_to = applies_to
+
+    def pre(self, request, method):
+        self.calls.append(('pre', self.name))
+
+    def post(self, request, method, response, exception):
+        self.calls.append(('post', self.name))
+
+
+class PreOnly(ServerMiddlewareBase):
+    def pre(self, request, method):
+        pass
+
+
+class Wrapper(ServerMiddlewareBase):
+    def __init__(self, name, calls):
+        self.name = name
+        self.calls = calls
+
+    def wrap(self, request, method):
+        def wrapper(*args, **kwargs):
+            self.calls.append(('wrap', self.name))
+            return method(*args, **kwargs)
+        return wrapper
+
+    def post(self, request, method, response, exception):
+        self.calls.append(('post', method.__name__))
+
+
+class TestMiddlewareChain(object):
+
+    def test_hooks_order(self):
+        calls = []
+        chain = MiddlewareChain([Recorder('a', calls), Recorder('b', calls)])
+        for hook in chain.pre_hooks():
+            hook(None, None)
+        for hook in chain.post_hooks():
+            hook(None, None, None, None)
+        assert calls == [('pre', 'a'), ('pre', 'b'),
+                         ('post', 'b'), ('post', 'a')]
+
+    def test_inherited_hooks_skipped(self):
+        middleware = PreOnly()
+        chain = MiddlewareChain([middleware], ServerMiddlewareBase)
+        assert chain.pre_hooks() == (middleware.pre,)
+        assert chain.post_hooks() == ()
+        assert MiddlewareChain([middleware]).post_hooks() != ()
+
+    def test_applies_to(self):
+        everywhere = Recorder('a', [])
+        only_hello = Recorder('b', [], applies_to=('hello',))
+        chain = MiddlewareChain([everywhere, only_hello])
+        assert len(chain.pre_hooks('hello')) == 2
+        assert chain.pre_hooks('goodbye') == (everywhere.pre,)
+        assert chain.post_hooks('goodbye') == (everywhere.post,)
+
+    def test_recompiled_on_change(self):
+        first, second = PreOnly(), PreOnly()
+        chain = MiddlewareChain([first])
+        assert chain.pre_hooks('hello') == (first.pre,)
+
+        chain.append(second)
+        assert chain.pre_hooks('hello') == (first.pre, second.pre)
+        chain[:] = [second]
+        assert chain.pre_hooks() == (second.pre,)
+        del chain[0]
+        assert chain.pre_hooks('hello') == ()
+        chain += [first]
+        assert chain.pre_hooks() == (first.pre,)
+
+    def test_wrap_hooks(self):
+        calls = []
+        server = Server()
+        server.middleware = [Wrapper('a', calls), PreOnly(),
+                             Wrapper('b', calls)]
+        assert server.middleware.pre_hooks() == (server.middleware[1].pre,)
+
+        def hello(request):
+            calls.append(('method', 'hello'))
+            return u'Hello, world!'
+
+        server.methods.register(hello)
+        request = Request({'i': 1, 'm': 'hello'})
+        message = server._process_request(request)
+        assert message == {'r': u'Hello, world!'}
+        ## The first middleware wraps all the others; POST hooks
+        ## still get the original method
+        assert calls == [('wrap', 'a'), ('wrap', 'b'), ('method', 'hello'),
+                         ('post', 'hello'), ('post', 'hello')]
+
+    def test_assigned_lists_converted(self):
+        middleware = PreOnly()
+        server, client = Server(), Client()
+        server.middleware = [middleware]
+        client.middleware = []
+        assert isinstance(server.middleware, MiddlewareChain)
+        assert isinstance(client.middleware, MiddlewareChain)
+        assert server.middleware.pre_hooks() == (middleware.pre,)
@@ -0,0 +1,62 @@
+"""
+Tests for the compact wire protocol
+"""
+
+import pytest
+
+from smartrpyc.utils.frames import pack_frames
+from smartrpyc.utils.protocol import MethodsTable, ProtocolMismatch, \
+    decode_reply, decode_request, encode_reply, encode_request, is_v2
+from smartrpyc.utils.serialization import MsgPackSerializer
+
+
+class TestProtocol(object):
+    table = MethodsTable([u'goodbye', u'hello'])
+
+    def test_request(self):
+        request = {'i': 1 << 62, 'm': 'hello', 'a': [u'world'],
+                   'k': {u'polite': True}, 'f': 1, 't': u'token'}
+        frames = encode_request(MsgPackSerializer, request, self.table)
+        assert is_v2(frames)
+        assert len(frames[0]) < len(pack_frames(MsgPackSerializer, request)[0])
+
+        decoded = decode_request(
+            MsgPackSerializer, frames, {self.table.id: self.table}.get)
+        assert decoded == dict(request, m=u'hello')
+
+        ## Trailing empty items are left out
+        frames = encode_request(
+            MsgPackSerializer, {'i': 2, 'm': 'goodbye', 'a': []}, self.table)
+        assert decode_request(
+            MsgPackSerializer, frames, {self.table.id: self.table}.get) == \
+            {'i': 2, 'm': u'goodbye', 'a': []}
+
+    def test_not_encodable(self):
+        for request in [{'i': 1, 'm': 'unknown'},
+                        {'i': 'some-uuid', 'm': 'hello'},
+                        {'i': 1, 'b': [{'m': 'hello'}]}]:
+            assert encode_request(
+                MsgPackSerializer, request, self.table) is None
+        for response in [{'i': 1, 'r': 1, 'h': {'max_age': 1}},
+                         {'i': 1, 's': u'stream', 'c': []}]:
+            assert encode_reply(MsgPackSerializer, response) is None
+
+    def test_unknown_table(self):
+        frames = encode_request(
+            MsgPackSerializer, {'i': 3, 'm': 'hello'}, self.table)
+        with pytest.raises(ProtocolMismatch) as excinfo:
+            decode_request(MsgPackSerializer, frames, {}.get)
+        assert excinfo.value.request_id == 3
+
+    def test_reply(self):
+        for response in [{'i': 5, 'r': [1, 2, 3]},
+                         {'i': 5, 'e': u'ValueError', 'e_msg': u'Invalid'}]:
+            frames = encode_reply(MsgPackSerializer, response)
+            assert is_v2(frames)
+            assert decode_reply(MsgPackSerializer, frames) == response
+
+    def test_large_buffers(self):
+        blob = b'x' * 1000
+        frames = encode_reply(MsgPackSerializer, {'i': 5, 'r': blob}, 100)
+        assert len(frames) == 2
+        assert decode_reply(MsgPackSerializer, frames)['r'].tobytes() == blob
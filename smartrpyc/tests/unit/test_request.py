@@ -0,0 +1,102 @@
+"""
+Tests for the server-side Request objects
+"""
+
+import time
+
+from smartrpyc.contrib.public.server import PublicRequest
+from smartrpyc.server import Request, Server
+from smartrpyc.utils.protocol import PROTOCOL_METHOD, encode_request
+from smartrpyc.utils.serialization import MsgPackSerializer
+
+
+class TestRequest(object):
+
+    def test_slots(self):
+        request = Request({'i': 1, 'm': 'hello'})
+        assert not hasattr(request, '__dict__')
+        assert request.server is None
+        assert request.protocol == 1
+        assert request.reply_meta is None
+        assert request.context == {}
+        assert Request({'i': 2, 'm': 'hello'}).context is not request.context
+
+    def test_arguments_decoded_lazily(self):
+        decoded = []
+
+        def arguments():
+            decoded.append(True)
+            return {'a': [1, 2], 'k': {u'x': 3}}
+
+        request = Request({'i': 1, 'm': 'hello', 't': u'token'}, arguments)
+        assert request.id == 1
+        assert request.method == 'hello'
+        assert request.get('t') == u'token'
+        assert request.stream is None
+        assert request.batch is None
+        assert decoded == []
+
+        assert request.args == [1, 2]
+        assert request.kwargs == {u'x': 3}
+        assert request.raw['a'] == [1, 2]
+        assert decoded == [True]
+
+    def test_compact_requests(self):
+        server = Server()
+        server.methods.register(lambda request, text: text, name='echo')
+        table = server._current_methods_table()
+        frames = encode_request(MsgPackSerializer, {
+            'i': 1, 'm': 'echo', 'a': [u'x' * 1000], 't': u'token',
+        }, table)
+
+        server.request_class = PublicRequest
+        request = server._unpack_request(frames)
+        assert request.protocol == 2
+        assert request.token == u'token'
+        assert request._arguments is not None  # Not decoded yet
+        assert request.args == [u'x' * 1000]
+
+    def test_handlers(self):
+        server = Server()
+        handler = lambda raw: server._request_handler(Request(raw))
+        assert handler({'i': 1, 'm': 'hello'}) is None
+        assert handler({'i': 1, 'm': 'hello', 'ua': [0, 'x']}) == \
+            server._start_upload
+        assert handler({'i': 1, 'm': PROTOCOL_METHOD}) == server._negotiate
+        assert handler({'i': 1, 's': 'x', 'n': 10}) == server._pull_stream
+        assert handler({'i': 1, 'u': 'x', 'c': []}) == server._receive_chunks
+        assert handler({'i': 1, 'b': []}) == server._process_batch
+
+    def test_timings(self):
+        request = Request({'i': 1, 'm': 'hello'})
+        request.mark('unpack')  # Not recorded
+        assert request.timings is None
+
+        request.start_timings()
+        request.mark('lookup')
+        request.mark('method')
+        assert [phase for phase, _ in request.timings] == ['lookup', 'method']
+        assert all(seconds >= 0 for _, seconds in request.timings)
+
+    def test_deadline(self):
+        request = Request({'i': 1, 'm': 'hello'})
+        request.received_at = time.time()
+        assert request.deadline is None
+        assert request.remaining is None
+
+        request = Request({'i': 1, 'm': 'hello', 'd': 2.0})
+        request.received_at = time.time() - 1
+        assert request.deadline == request.received_at + 2
+        assert 0 < request.remaining <= 1
+
+    def test_absolute_deadline(self):
+        ## Sent 1.5 seconds before being received
+        now = time.time()
+        request = Request({'i': 1, 'm': 'hello', 'd': 2.0, 'D': now + .5})
+        request.received_at = now
+        request.server = Server()
+        assert request.deadline == now + 2  # Clocks not trusted
+
+        request.server.max_clock_skew = .1
+        assert request.deadline == now + .6
+        assert request.remaining <= .6
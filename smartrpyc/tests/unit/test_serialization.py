@@ -3,6 +3,10 @@
 Tests for serialization
 """
 
+import struct
+
+import pytest
+
 
 class TestSerialization(object):
     def _run_serialization_tests(self, packer, support_bytes=True):
@@ -59,6 +63,18 @@ class TestSerialization(object):
         from smartrpyc.utils.serialization import CustomMsgPackSerializer
         self._run_serialization_tests(CustomMsgPackSerializer)
 
+    def test_serialization_msgpack_prefixed(self):
+        from smartrpyc.utils.serialization import PrefixedMsgPackSerializer
+        self._run_serialization_tests(PrefixedMsgPackSerializer)
+
+    def test_msgpack_custom_nested(self):
+        from smartrpyc.utils.serialization import CustomMsgPackSerializer
+        value = {u'text': [u'text', b'blob']}
+        for _ in range(100):
+            value = {u'deep': [value, b'blob'], b'blob': u'text'}
+        assert CustomMsgPackSerializer.unpackb(
+            CustomMsgPackSerializer.packb(value)) == value
+
     def test_serialization_json(self):
         from smartrpyc.utils.serialization import JsonSerializer
         self._run_serialization_tests(JsonSerializer, support_bytes=False)
@@ -66,3 +82,83 @@ class TestSerialization(object):
     def test_serialization_pickle(self):
         from smartrpyc.utils.serialization import PickleSerializer
         self._run_serialization_tests(PickleSerializer)
+
+    def test_serialization_numpy(self):
+        from smartrpyc.utils.serialization import NumpySerializer
+        self._run_serialization_tests(NumpySerializer, support_bytes=False)
+
+    def test_numpy_arrays(self):
+        numpy = pytest.importorskip('numpy')
+        from smartrpyc.utils.serialization import NumpySerializer
+
+        array = numpy.arange(24, dtype='<f4').reshape(2, 3, 4)
+        for value in [array, array.T, array[:, ::2, 1:],
+                      numpy.zeros((0, 3)), numpy.array(u'text')]:
+            new_value = NumpySerializer.unpackb(
+                NumpySerializer.packb({'value': value}))['value']
+            assert numpy.array_equal(new_value, value)
+            assert new_value.dtype == value.dtype
+
+        ## Scalars are converted to the matching Python type
+        assert NumpySerializer.unpackb(
+            NumpySerializer.packb(array.sum(dtype='int64'))) == 276
+
+        with pytest.raises(TypeError):
+            NumpySerializer.packb(numpy.array([object()]))
+
+    @pytest.mark.parametrize('header', [
+        ['|O', [2], [8]],  # Pointers
+        ['[("a", "|O")]', [1], [8]],
+        ['|V8', [2], [8]],  # Fine, but not enough data
+        ['<f8', [2], [-8]],
+        ['<f8', [3, 2], [0, 1 << 40]],
+        ['<f8', [2], []],
+        ['no-such-dtype', [2], [8]],
+        'junk',
+    ])
+    def test_hostile_arrays(self, header):
+        pytest.importorskip('numpy')
+        import msgpack
+        from smartrpyc.utils.serialization import NDARRAY_EXT_TYPE, \
+            NumpySerializer
+        header = msgpack.packb(header)
+        data = struct.pack('!I', len(header)) + header + b'\x00' * 8
+        packed = msgpack.packb(msgpack.ExtType(NDARRAY_EXT_TYPE, data))
+        with pytest.raises(ValueError):
+            NumpySerializer.unpackb(packed)
+        with pytest.raises(ValueError):
+            NumpySerializer.from_frame(header, b'\x00' * 8)
+
+
+class TestSerializerTags(object):
+
+    def test_registry(self):
+        from smartrpyc.utils.serialization import MsgPackSerializer, \
+            PickleSerializer, get_serializer, get_serializer_id, \
+            register_serializer
+        assert get_serializer(get_serializer_id(PickleSerializer)) is \
+            PickleSerializer
+        assert get_serializer(200) is None
+        with pytest.raises(ValueError):
+            register_serializer(PickleSerializer, 256)
+        with pytest.raises(ValueError):
+            register_serializer(PickleSerializer,
+                                get_serializer_id(MsgPackSerializer))
+
+    def test_tags(self):
+        from smartrpyc.utils.serialization import MsgPackSerializer, \
+            PickleSerializer, get_serializer_id, tag_frames, untag_frames
+
+        ## The default serializer is not tagged
+        frames = [MsgPackSerializer.packb({'i': 1})]
+        assert tag_frames(list(frames), MsgPackSerializer) == frames
+        assert untag_frames(frames) == (None, frames)
+
+        frames = [PickleSerializer.packb({'i': 1}), b'buffer']
+        tagged = tag_frames(list(frames), PickleSerializer)
+        assert tagged[0] != frames[0]
+        assert untag_frames(tagged) == \
+            (get_serializer_id(PickleSerializer), frames)
+
+        ## Nor are unregistered ones
+        assert tag_frames(list(frames), object) == frames
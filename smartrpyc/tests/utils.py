@@ -10,14 +10,17 @@ from smartrpyc import server
 class ExampleRpcProcess(threading.Thread):
     """Process running a SmartRPyC server"""
 
-    def __init__(self, methods, addresses=None, middleware=None):
+    def __init__(self, methods, addresses=None, middleware=None,
+                 server_class=server.Server, server_kwargs=None):
         super(ExampleRpcProcess, self).__init__()
         self._methods = methods
         self._addresses = addresses
         self._middleware = middleware
+        self._server_class = server_class
+        self._server_kwargs = server_kwargs or {}
 
     def run(self):
-        self.rpc = server.Server(self._methods)
+        self.rpc = self._server_class(self._methods, **self._server_kwargs)
         if self._middleware is not None:
             self.rpc.middleware[:] = self._middleware[:]
 
@@ -28,14 +31,19 @@ class ExampleRpcProcess(threading.Thread):
 class TestingServer(object):
     """Context manager to provide a server"""
 
-    def __init__(self, methods, addresses, middleware=None):
+    def __init__(self, methods, addresses, middleware=None,
+                 server_class=server.Server, server_kwargs=None):
         self.methods = methods
         self.addresses = addresses
         self.middleware = middleware
+        self.server_class = server_class
+        self.server_kwargs = server_kwargs
 
     def __enter__(self):
         self.rpc_process = ExampleRpcProcess(
-            self.methods, self.addresses, middleware=self.middleware)
+            self.methods, self.addresses, middleware=self.middleware,
+            server_class=self.server_class,
+            server_kwargs=self.server_kwargs)
         self.rpc_process.daemon = True
         self.rpc_process.start()
         return self.rpc_process
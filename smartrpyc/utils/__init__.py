@@ -23,6 +23,28 @@ def lazy_property(fn):
     return property(fget=getter, fset=setter, fdel=deleter, doc=fn.__doc__)
 
 
+def canonical(value):
+    """
+    Convert a value to a hashable one, equal for equal values
+    (eg. dicts with the same items, but different ordering).
+    Used to build cache keys out of call arguments.
+
+    Values of different types are never equal, even if Python says
+    they are (eg. ``1``, ``1.0`` and ``True``): methods may well
+    tell them apart.
+
+    :raise TypeError: if the value contains unhashable objects
+    """
+    if isinstance(value, dict):
+        return (dict, tuple(sorted(
+            (canonical(k), canonical(v)) for k, v in value.iteritems())))
+    if isinstance(value, (list, tuple)):
+        return tuple(canonical(v) for v in value)
+    hash(value)
+    kind = type(value)
+    return (int if kind is long else kind, value)
+
+
 def get_random_ipc_socket():
     with tempfile.NamedTemporaryFile(delete=False, suffix='.sock') as s:
         os.unlink(s.name)
@@ -0,0 +1,159 @@
+"""
+Compression of messages
+
+Messages larger than a threshold are compressed (the first frame only:
+the one with the packed message), and marked by a leading flag byte
+plus the id of the codec. Other messages are sent as they are; packed
+messages never start with the flag byte, so the two can be told apart.
+
+Codecs are negotiated: clients send the names of those they support
+when negotiating the protocol, and the server replies with the ones it
+supports too. Clients then mark their requests with the codec they
+accept for the replies. Servers refuse messages compressed with codecs
+they don't accept, or decompressing to more than a maximum size.
+"""
+
+import struct
+import zlib
+
+try:
+    import lzma
+except ImportError:  # Python 2
+    lzma = None
+
+from .frames import _frame_bytes
+
+__all__ = ['Codec', 'CompressionError', 'register_codec', 'get_codec',
+           'list_codecs', 'compress_frame', 'decompress_frames']
+
+COMPRESSED_MARKER = b'\x10'
+
+## marker, codec id
+HEADER = struct.Struct('!cB')
+
+_codecs = {}  # name -> Codec
+_codecs_by_id = {}  # id -> Codec
+
+
+class CompressionError(ValueError):
+    """
+    Raised for compressed messages that can't be accepted: unknown
+    (or refused) codec, or too large once decompressed
+    """
+
+
+class Codec(object):
+    """
+    A compression codec
+
+    :param name: name used to negotiate the codec
+    :param codec_id: id marking the messages (1 to 15)
+    :param compress: function compressing a ``bytes`` object
+    :param decompress:
+        function decompressing a ``bytes`` object, called as
+        ``decompress(data, max_size)``: it must raise
+        :py:exc:`CompressionError` rather than return more than
+        ``max_size`` bytes (``None`` for no limit)
+    """
+
+    def __init__(self, name, codec_id, compress, decompress):
+        if not 0 < codec_id < 16:
+            raise ValueError("Codec ids must be between 1 and 15")
+        self.name = name
+        self.id = codec_id
+        self.compress = compress
+        self.decompress = decompress
+
+    def __repr__(self):
+        return '<Codec {0} ({1})>'.format(self.name, self.id)
+
+
+def register_codec(codec):
+    """Make a :py:class:`Codec` available to clients and servers"""
+    other = _codecs_by_id.get(codec.id)
+    if other is not None and other.name != codec.name:
+        raise ValueError("Codec id {0} already used by {1}".format(
+            codec.id, other.name))
+    _codecs[codec.name] = codec
+    _codecs_by_id[codec.id] = codec
+
+
+def get_codec(name_or_id):
+    """Get a registered codec, by name or id (``None`` if missing)"""
+    if isinstance(name_or_id, (int, long)):
+        return _codecs_by_id.get(name_or_id)
+    return _codecs.get(name_or_id)
+
+
+def list_codecs():
+    """Names of the registered codecs"""
+    return sorted(_codecs)
+
+
+def compress_frame(frame, codec, threshold=0):
+    """
+    Compress a packed message, if larger than ``threshold`` bytes
+    (and if compressing it actually makes it smaller)
+    """
+    data = _frame_bytes(frame)
+    if len(data) <= threshold:
+        return frame
+    compressed = codec.compress(data)
+    if len(compressed) + HEADER.size >= len(data):
+        return frame
+    return HEADER.pack(COMPRESSED_MARKER, codec.id) + compressed
+
+
+def decompress_frames(frames, accept=None, max_size=None):
+    """
+    Decompress the first frame of a message, if compressed
+
+    :param accept:
+        function telling whether a codec (name) is accepted,
+        if not all the registered ones are
+    :param max_size: maximum size of the decompressed frame, in bytes
+    :raise CompressionError:
+        if the codec is unknown or not accepted, or the frame
+        decompresses to more than ``max_size`` bytes
+    """
+    data = _frame_bytes(frames[0])
+    if data[:1] != COMPRESSED_MARKER:
+        return frames
+    _, codec_id = HEADER.unpack_from(data)
+    codec = _codecs_by_id.get(codec_id)
+    if codec is None:
+        raise CompressionError(
+            "Unknown compression codec: {0}".format(codec_id))
+    if accept is not None and not accept(codec.name):
+        raise CompressionError(
+            "Compression codec not accepted: {0}".format(codec.name))
+    return [codec.decompress(data[HEADER.size:], max_size)] + \
+        list(frames[1:])
+
+
+def _check_size(data, max_size):
+    if len(data) > max_size:
+        raise CompressionError(
+            "Message larger than {0} bytes once decompressed".format(
+                max_size))
+    return data
+
+
+def _zlib_decompress(data, max_size=None):
+    if max_size is None:
+        return zlib.decompress(data)
+    ## Stop as soon as the output gets too large
+    return _check_size(
+        zlib.decompressobj().decompress(data, max_size + 1), max_size)
+
+
+def _lzma_decompress(data, max_size=None):
+    if max_size is None:
+        return lzma.decompress(data)
+    return _check_size(
+        lzma.LZMADecompressor().decompress(data, max_size + 1), max_size)
+
+
+register_codec(Codec('zlib', 1, zlib.compress, _zlib_decompress))
+if lzma is not None:
+    register_codec(Codec('lzma', 2, lzma.compress, _lzma_decompress))
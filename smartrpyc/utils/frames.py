@@ -0,0 +1,161 @@
+"""
+Multipart messages utilities
+
+Large binary values (arguments and results) are not packed along with
+the rest of the message, but sent as separate ZeroMQ frames, without
+copying them; the packed message contains a reference to the frame
+(a msgpack extension type) in their place.
+
+On the receiving side, they are handed over as ``memoryview`` objects
+pointing to the received frame, again without copying them.
+
+.. note::
+    Only the top-level values are considered (ie. positional arguments,
+    keyword arguments values and the result itself), to avoid walking
+    the whole message.
+"""
+
+import struct
+
+import msgpack
+
+__all__ = ['FRAME_EXT_TYPE', 'pack_frames', 'unpack_frames',
+           'extract_frames', 'resolve_frames', 'split_envelope']
+
+#: msgpack extension type code used for references to frames
+FRAME_EXT_TYPE = 1
+
+BUFFER_TYPES = (bytes, bytearray, memoryview)
+try:
+    BUFFER_TYPES += (buffer,)
+except NameError:  # Python 3
+    pass
+
+
+def _buffer_size(value):
+    if isinstance(value, memoryview):
+        return len(value) * value.itemsize
+    return len(value)
+
+
+def pack_frames(packer, message, threshold=None):
+    """
+    Pack a message into a list of frames
+
+    :param packer:
+        the serializer to be used. Buffers are moved to their own
+        frames only if it supports msgpack extension types (ie. it has
+        a true ``ext_types`` attribute). Serializers may also send other
+        objects in their own frame, by providing a ``to_frame(value)``
+        method returning a ``(header, buffer)`` tuple (or ``None``),
+        and the matching ``from_frame(header, frame)`` method.
+    :param message: the message dict to be packed
+    :param threshold:
+        size (in bytes) above which a buffer is sent in its own frame.
+        ``None`` disables the feature.
+    """
+    message, buffers = extract_frames(packer, message, threshold)
+    return [packer.packb(message)] + buffers
+
+
+def extract_frames(packer, message, threshold=None):
+    """
+    Like :py:func:`pack_frames`, but return the message (with frame
+    references in place of the large values) and the list of buffers
+    to be sent in their own frames, leaving the packing to the caller.
+    """
+    buffers = []
+    if threshold is not None and getattr(packer, 'ext_types', False):
+        to_frame = getattr(packer, 'to_frame', None)
+
+        def extract(value):
+            split = to_frame(value) if to_frame is not None else None
+            if split is not None:
+                header, data = split
+            elif isinstance(value, BUFFER_TYPES):
+                header, data = b'', value
+            else:
+                return value
+            if _buffer_size(data) < threshold:
+                return value
+            buffers.append(data)
+            return msgpack.ExtType(
+                FRAME_EXT_TYPE, struct.pack('!I', len(buffers)) + header)
+
+        message = _map_values(message, extract)
+
+    return message, buffers
+
+
+def unpack_frames(packer, frames):
+    """
+    Unpack a message from a list of frames (either ``bytes``
+    or :py:class:`zmq.Frame` objects), replacing frame references
+    with memoryviews pointing to the frames (or with the objects
+    rebuilt by the serializer ``from_frame()`` method).
+    """
+    message = packer.unpackb(_frame_bytes(frames[0]))
+    return resolve_frames(packer, message, frames)
+
+
+def resolve_frames(packer, message, frames):
+    """
+    Replace the frame references in an unpacked message
+    (see :py:func:`unpack_frames`)
+    """
+    if len(frames) > 1 and isinstance(message, dict):
+
+        def resolve(value):
+            if isinstance(value, msgpack.ExtType) and \
+                    value.code == FRAME_EXT_TYPE:
+                index, = struct.unpack('!I', value.data[:4])
+                header = value.data[4:]
+                if header:
+                    return packer.from_frame(header, frames[index])
+                return _frame_buffer(frames[index])
+            return value
+
+        message = _map_values(message, resolve)
+
+    return message
+
+
+def _map_values(message, func):
+    """
+    Apply ``func`` to the (top-level) arguments and result of a message,
+    returning a (shallow) copy of it.
+    """
+    message = dict(message)
+    if message.get('a'):
+        message['a'] = [func(value) for value in message['a']]
+    if message.get('k'):
+        message['k'] = dict(
+            (key, func(value)) for key, value in message['k'].iteritems())
+    if 'r' in message:
+        message['r'] = func(message['r'])
+    return message
+
+
+def _frame_bytes(frame):
+    return getattr(frame, 'bytes', frame)
+
+
+def _frame_buffer(frame):
+    if hasattr(frame, 'buffer'):
+        return frame.buffer
+    return memoryview(frame)
+
+
+def split_envelope(frames):
+    """
+    Split a multipart message received on a ROUTER (or DEALER) socket
+    into the routing envelope (peer identities plus the empty delimiter
+    frame) and the message frames.
+
+    REQ sockets add the delimiter automatically; DEALER clients
+    must send it explicitly, as the first frame of each message.
+    """
+    for idx, frame in enumerate(frames):
+        if not len(frame):
+            return frames[:idx + 1], frames[idx + 1:]
+    raise ValueError("Missing envelope delimiter")
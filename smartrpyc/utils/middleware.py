@@ -0,0 +1,129 @@
+"""
+Middleware chains, compiled into flat lists of hooks
+"""
+
+__all__ = ['MiddlewareChain']
+
+## Past this many distinct method names, hooks are filtered on each
+## call instead of being cached (names come from the clients)
+MAX_CACHED_METHODS = 1024
+
+
+def _get_hook(middleware, name, base):
+    """
+    Return the bound ``name`` hook of a middleware, or ``None``
+    if missing (or just inherited, as a no-op, from ``base``)
+    """
+    hook = getattr(middleware, name, None)
+    if hook is None or base is None:
+        return hook
+    default = getattr(base, name, None)
+    default = getattr(default, '__func__', default)  # Unbound method
+    if getattr(hook, '__func__', hook) is default:
+        return None
+    return hook
+
+
+class MiddlewareChain(list):
+    """
+    List of middleware, keeping the lists of their ``pre()``, ``post()``
+    and ``wrap()`` hooks (the latter two in reverse order) ready to be
+    called.
+
+    The hooks are collected again after each change to the list
+    (but not after changes to the middleware objects themselves).
+
+    Middleware may have an ``applies_to`` attribute, listing the names
+    of the methods it is to be run for; when filtering hooks by method,
+    it is skipped for all the others.
+    """
+
+    def __init__(self, iterable=(), base=None):
+        """
+        :param base:
+            base class of the middleware: hooks not overriding its
+            (no-op) ones are skipped
+        """
+        super(MiddlewareChain, self).__init__(iterable)
+        self._base = base
+        self._changed()
+
+    def _changed(self):
+        self._hooks = None
+        self._by_method = {}
+
+    def _compile(self, method):
+        pre, post, wrap = [], [], []
+        for mw in self:
+            applies_to = getattr(mw, 'applies_to', None)
+            if method is not None and applies_to is not None and \
+                    method not in applies_to:
+                continue
+            hook = _get_hook(mw, 'pre', self._base)
+            if hook is not None:
+                pre.append(hook)
+            hook = _get_hook(mw, 'post', self._base)
+            if hook is not None:
+                post.insert(0, hook)
+            hook = _get_hook(mw, 'wrap', self._base)
+            if hook is not None:
+                wrap.insert(0, hook)
+        return tuple(pre), tuple(post), tuple(wrap)
+
+    def hooks(self, method=None):
+        """
+        Return the ``pre()``, ``post()`` and ``wrap()`` hooks to be
+        called, for the given method (name) or, if ``None``, unfiltered.
+        """
+        if method is None:
+            if self._hooks is None:
+                self._hooks = self._compile(None)
+            return self._hooks
+        try:
+            return self._by_method[method]
+        except KeyError:
+            hooks = self._compile(method)
+            if len(self._by_method) < MAX_CACHED_METHODS:
+                self._by_method[method] = hooks
+            return hooks
+        except TypeError:  # Unhashable name, from a broken request
+            return self._compile(method)
+
+    def pre_hooks(self, method=None):
+        try:  # Called for each request: skip hooks() once compiled
+            return self._by_method[method][0]
+        except (KeyError, TypeError):
+            return self.hooks(method)[0]
+
+    def post_hooks(self, method=None):
+        try:
+            return self._by_method[method][1]
+        except (KeyError, TypeError):
+            return self.hooks(method)[1]
+
+    def wrap_hooks(self, method=None):
+        try:
+            return self._by_method[method][2]
+        except (KeyError, TypeError):
+            return self.hooks(method)[2]
+
+
+## Any change to the list invalidates the compiled hooks
+
+def _changing(name):
+    original = getattr(list, name)
+
+    def wrapper(self, *args, **kwargs):
+        result = original(self, *args, **kwargs)
+        self._changed()
+        return result
+    wrapper.__name__ = name
+    return wrapper
+
+
+for _name in ('append', 'extend', 'insert', 'remove', 'pop', 'sort',
+              'reverse', '__setitem__', '__delitem__', '__iadd__',
+              '__imul__', '__setslice__', '__delslice__'):
+    if hasattr(list, _name):
+        setattr(MiddlewareChain, _name, _changing(_name))
+del _name
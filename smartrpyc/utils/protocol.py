@@ -0,0 +1,200 @@
+"""
+Compact wire protocol (version 2)
+
+Version 1 messages are packed maps, with short keys (``'i'`` for the
+request id, ``'m'`` for the method name, and so on). Version 2 ones
+start with a binary header, followed by the packed body:
+
+* calls: marker, flags, request id (a 64-bit integer), methods table id
+  and method index; the body is the ``[args, kwargs]`` list (without
+  trailing empty items), preceded by the length-prefixed ``extra`` map
+  holding any other key of the request, if any. This way, servers
+  can decode everything but the arguments, and leave them for later
+  (see :py:func:`decode_request_header`);
+* replies: marker, flags and request id; the body is the result,
+  or the ``[exception type, message]`` pair.
+
+Method names are replaced by their index in a table sent by the server
+when the client negotiates the protocol: along with its first call
+(sent with version 1, with the ``'p'`` key holding the versions and
+options supported by the client), the server reply carrying the result
+of the negotiation in its own ``'p'`` key.
+
+Only calls (and their plain replies) get the compact encoding: other
+messages (batches, streams, replies with cache hints...) keep using
+version 1, and the two are freely mixed on the same connection.
+Version 1 messages never start with the version 2 marker byte.
+"""
+
+import struct
+import zlib
+
+from .frames import _frame_bytes, extract_frames, resolve_frames
+
+__all__ = ['PROTOCOL_METHOD', 'ProtocolMismatch', 'MethodsTable',
+           'encode_request', 'decode_request', 'decode_request_header',
+           'encode_reply', 'decode_reply']
+
+#: Name of the pseudo-method to negotiate the protocol with an explicit
+#: call (clients may also do it along with their first call instead);
+#: not a valid identifier, so it can't clash with real methods
+PROTOCOL_METHOD = 'smartrpyc.protocol'
+
+V2_MARKER = b'\x02'
+
+## marker, flags, request id, methods table id, method index
+REQUEST_HEADER = struct.Struct('!cBQIH')
+
+## marker, flags, request id
+REPLY_HEADER = struct.Struct('!cBQ')
+
+FLAG_MULTIPART = 0x01  # Requests: the client accepts multipart replies
+FLAG_EXTRA = 0x02  # Requests: the body starts with the extra keys
+CODEC_SHIFT = 4  # Requests: high nibble for the codec accepted for replies
+FLAG_EXCEPTION = 0x01  # Replies: the body is an exception
+
+MAX_REQUEST_ID = (1 << 64) - 1
+
+## Keys encoded in the request header or body
+REQUEST_KEYS = frozenset(['i', 'm', 'a', 'k', 'f', 'z'])
+
+EXTRA_LENGTH = struct.Struct('!I')
+
+
+class ProtocolMismatch(Exception):
+    """
+    Raised for calls referring to a methods table unknown to
+    the server (eg. after failing over to another server)
+    """
+
+    def __init__(self, message, request_id=None):
+        super(ProtocolMismatch, self).__init__(message)
+        self.request_id = request_id
+
+
+class MethodsTable(object):
+    """Mapping between the method names and their indexes"""
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        self.id = zlib.crc32(
+            u'\n'.join(self.names).encode('utf-8')) & 0xffffffff
+
+    def __len__(self):
+        return len(self.names)
+
+
+def is_v2(frames):
+    """Tell whether a message uses the compact protocol"""
+    return _frame_bytes(frames[0])[:1] == V2_MARKER
+
+
+def encode_request(packer, request, table, threshold=None):
+    """
+    Pack a request as a list of frames, with the compact encoding
+    if possible (else return ``None``).
+
+    :param table: the :py:class:`MethodsTable` negotiated with the server
+    """
+    request_id = request.get('i')
+    index = table.index.get(request.get('m'))
+    if index is None or not isinstance(request_id, (int, long)) or \
+            not 0 <= request_id <= MAX_REQUEST_ID:
+        return None
+    message, buffers = extract_frames(packer, request, threshold)
+    flags = FLAG_MULTIPART if message.get('f') else 0
+    flags |= (message.get('z') or 0) << CODEC_SHIFT
+    body = [message.get('a') or [], message.get('k') or {}]
+    if not body[1]:
+        body.pop()
+    body = packer.packb(body)
+    extra = dict((key, value) for key, value in message.iteritems()
+                 if key not in REQUEST_KEYS)
+    if extra:
+        flags |= FLAG_EXTRA
+        extra = packer.packb(extra)
+        body = EXTRA_LENGTH.pack(len(extra)) + extra + body
+    header = REQUEST_HEADER.pack(
+        V2_MARKER, flags, request_id, table.id, index)
+    return [header + body] + buffers
+
+
+def decode_request(packer, frames, get_table):
+    """
+    Unpack a compact request into the equivalent version 1 message.
+
+    :param get_table:
+        function returning the :py:class:`MethodsTable` with
+        a given id (or ``None``)
+    :raise ProtocolMismatch: if the methods table is unknown
+    """
+    message, arguments = decode_request_header(packer, frames, get_table)
+    message.update(arguments())
+    return message
+
+
+def decode_request_header(packer, frames, get_table):
+    """
+    Like :py:func:`decode_request`, but leaving out the arguments:
+    return the message without them, and a function returning
+    the dict of the ``'a'`` and ``'k'`` keys.
+    """
+    data = _frame_bytes(frames[0])
+    _, flags, request_id, table_id, index = \
+        REQUEST_HEADER.unpack_from(data)
+    table = get_table(table_id)
+    if table is None or index >= len(table):
+        raise ProtocolMismatch(
+            "Unknown methods table: negotiate the protocol again",
+            request_id)
+    message = {'i': request_id, 'm': table.names[index]}
+    if flags & FLAG_MULTIPART:
+        message['f'] = 1
+    if flags >> CODEC_SHIFT:
+        message['z'] = flags >> CODEC_SHIFT
+    offset = REQUEST_HEADER.size
+    if flags & FLAG_EXTRA:
+        length, = EXTRA_LENGTH.unpack_from(data, offset)
+        offset += EXTRA_LENGTH.size
+        message.update(packer.unpackb(data[offset:offset + length]))
+        offset += length
+
+    def arguments():
+        body = packer.unpackb(data[offset:])
+        decoded = {'a': body[0]}
+        if len(body) > 1:
+            decoded['k'] = body[1]
+        return resolve_frames(packer, decoded, frames)
+
+    return message, arguments
+
+
+def encode_reply(packer, response, threshold=None):
+    """
+    Pack a reply as a list of frames, with the compact encoding
+    if possible (else return ``None``).
+    """
+    keys = set(response)
+    keys.discard('i')
+    request_id = response.get('i')
+    if not isinstance(request_id, (int, long)):
+        return None
+    if keys == set(['r']):
+        message, buffers = extract_frames(packer, response, threshold)
+        header = REPLY_HEADER.pack(V2_MARKER, 0, request_id)
+        return [header + packer.packb(message['r'])] + buffers
+    if keys == set(['e', 'e_msg']):
+        header = REPLY_HEADER.pack(V2_MARKER, FLAG_EXCEPTION, request_id)
+        return [header + packer.packb([response['e'], response['e_msg']])]
+    return None
+
+
+def decode_reply(packer, frames):
+    """Unpack a compact reply into the equivalent version 1 message"""
+    data = _frame_bytes(frames[0])
+    _, flags, request_id = REPLY_HEADER.unpack_from(data)
+    body = packer.unpackb(data[REPLY_HEADER.size:])
+    if flags & FLAG_EXCEPTION:
+        return {'i': request_id, 'e': body[0], 'e_msg': body[1]}
+    return resolve_frames(packer, {'i': request_id, 'r': body}, frames)
@@ -1,18 +1,59 @@
 """
 Serialization utilities
+
+Serializers are registered with an id (see :py:func:`register_serializer`),
+used to tag the messages packed with anything but the default
+:py:class:`MsgPackSerializer`: a leading marker byte, plus the id.
+Servers can then accept several serializers at once, and reply
+with the one each client used. Untagged messages are packed with
+the receiver's default serializer (its ``packer``), as before.
 """
 import json
 import pickle
+import struct
 
 import msgpack
 from msgpack.fallback import Unicode
 
+from .frames import _frame_bytes
+
+try:
+    import numpy
+except ImportError:  # Optional, only needed by NumpySerializer
+    numpy = None
+
+
+__all__ = ['MsgPackSerializer', 'CustomMsgPackSerializer',
+           'PrefixedMsgPackSerializer', 'JsonSerializer', 'PickleSerializer',
+           'NumpySerializer', 'UnsupportedSerializer',
+           'register_serializer', 'get_serializer', 'get_serializer_id',
+           'tag_frames', 'untag_frames']
+
+#: msgpack extension type code used for NumPy arrays
+NDARRAY_EXT_TYPE = 2
+
+SERIALIZER_MARKER = b'\x11'
+
+## marker, serializer id
+SERIALIZER_HEADER = struct.Struct('!cB')
+
+_serializers = {}  # id -> serializer
+_serializer_ids = {}  # serializer -> id
+
 
-__all__ = ['MsgPackSerializer', 'CustomMsgPackSerializer', 'JsonSerializer',
-           'PickleSerializer']
+class UnsupportedSerializer(ValueError):
+    """Raised for messages tagged with a serializer not accepted"""
+
+    def __init__(self, message, serializer_id=None):
+        super(UnsupportedSerializer, self).__init__(message)
+        self.serializer_id = serializer_id
 
 
 class MsgPackSerializer(object):
+    ## Extension types are passed through: large buffers can be moved
+    ## to their own frames (see :py:mod:`smartrpyc.utils.frames`)
+    ext_types = True
+
     @staticmethod
     def packb(o):
         return msgpack.packb(o, encoding='utf-8')
@@ -22,11 +63,34 @@ class MsgPackSerializer(object):
         return msgpack.unpackb(packed, encoding='utf-8')
 
 
-class CustomMsgPackSerializer(object):
+class CustomMsgPackSerializer(MsgPackSerializer):
     """
     Custom msgpack serializer, allowing to differentiate between
-    strings and blobs. It's way more inefficient thant the MsgPackSerializer,
-    however, since it has to use the fallback Python-only version..
+    strings and blobs: they are packed as the msgpack ``str`` and
+    ``bin`` types, and unpacked as ``unicode`` and ``bytes`` (on
+    Python 2, ``str`` objects are blobs). Everything is done by the
+    msgpack extension, as fast as :py:class:`MsgPackSerializer`.
+
+    .. note::
+        Like with :py:class:`MsgPackSerializer`, large blobs passed as
+        arguments or returned as results may be received as
+        ``memoryview`` objects (see :py:mod:`smartrpyc.utils.frames`).
+    """
+
+    @staticmethod
+    def packb(o):
+        return msgpack.packb(o, encoding='utf-8', use_bin_type=True)
+
+    @staticmethod
+    def unpackb(packed):
+        return msgpack.unpackb(packed, encoding='utf-8')
+
+
+class PrefixedMsgPackSerializer(object):
+    """
+    The former :py:class:`CustomMsgPackSerializer`, prefixing strings
+    with ``b"u"`` and blobs with ``b"b"``: slow, since it walks the
+    whole objects in Python. Only kept to talk with older peers.
     """
     @staticmethod
     def packb(o):
@@ -69,6 +133,109 @@ def _unpack_strings(o):
         return o
 
 
+class NumpySerializer(MsgPackSerializer):
+    """
+    msgpack serializer supporting NumPy arrays (and scalars).
+
+    Arrays are encoded as an extension type, made of a header
+    (dtype, shape and strides) followed by the raw data, and decoded
+    as arrays pointing to the received data. Large arrays passed as
+    arguments or returned as results are sent in their own frame
+    (see :py:mod:`smartrpyc.utils.frames`), and never copied
+    on the receiving side.
+
+    .. note::
+        Decoded arrays are read-only. Non-contiguous arrays are copied
+        into contiguous ones before being sent; arrays of Python objects
+        and structured arrays are not supported, and are refused
+        (as are arrays larger than their data) when received.
+    """
+
+    @staticmethod
+    def packb(o):
+        return msgpack.packb(o, encoding='utf-8', default=_encode_numpy)
+
+    @staticmethod
+    def unpackb(packed):
+        return msgpack.unpackb(
+            packed, encoding='utf-8', ext_hook=_decode_numpy)
+
+    @staticmethod
+    def to_frame(value):
+        if numpy is not None and isinstance(value, numpy.ndarray):
+            return _split_array(value)
+
+    @staticmethod
+    def from_frame(header, frame):
+        return _join_array(header, frame)
+
+
+def _split_array(array):
+    """Split an array into its (packed) header and raw data"""
+    if array.dtype.hasobject or array.dtype.fields is not None:
+        raise TypeError(
+            "Unsupported array dtype: {0}".format(array.dtype))
+    if not (array.flags.c_contiguous or array.flags.f_contiguous):
+        array = numpy.ascontiguousarray(array)
+    header = msgpack.packb([array.dtype.str, array.shape, array.strides])
+    ## A view on the data, in memory order
+    return header, array.ravel(order='A').view(numpy.uint8)
+
+
+def _join_array(header, data, offset=0):
+    """
+    Build an array from its header and a buffer holding its data
+
+    :raise ValueError:
+        if the header (coming from the peer) is invalid, asks for
+        an unsupported dtype, or describes more data than the buffer has
+    """
+    if numpy is None:
+        raise TypeError("NumPy is needed to decode arrays")
+    try:
+        dtype, shape, strides = msgpack.unpackb(header, encoding='utf-8')
+        dtype = numpy.dtype(str(dtype))
+        shape, strides = tuple(shape), tuple(strides)
+    except Exception:
+        raise ValueError("Invalid array header")
+    ## Arrays of pointers (or made of them) must never come from outside
+    if dtype.hasobject or dtype.fields is not None or \
+            dtype.subdtype is not None:
+        raise ValueError("Unsupported array dtype: {0}".format(dtype))
+    if len(shape) != len(strides) or not all(
+            isinstance(n, (int, long)) and n >= 0 for n in shape + strides):
+        raise ValueError("Invalid array shape or strides")
+    ## Bytes spanned by the array: the last item starts at the sum
+    ## of the largest offsets along each dimension
+    extent = 0
+    if all(shape):
+        extent = dtype.itemsize + sum(
+            (n - 1) * stride for n, stride in zip(shape, strides))
+    if extent > len(data) - offset:
+        raise ValueError("Array larger than its data")
+    return numpy.ndarray(
+        shape, dtype, buffer=data, offset=offset, strides=strides)
+
+
+def _encode_numpy(o):
+    if numpy is not None:
+        if isinstance(o, numpy.ndarray):
+            header, data = _split_array(o)
+            return msgpack.ExtType(
+                NDARRAY_EXT_TYPE,
+                struct.pack('!I', len(header)) + header + data.tobytes())
+        if isinstance(o, numpy.generic):
+            return o.item()
+    raise TypeError("Cannot serialize {0!r}".format(o))
+
+
+def _decode_numpy(code, data):
+    if code == NDARRAY_EXT_TYPE:
+        size, = struct.unpack('!I', data[:4])
+        return _join_array(data[4:4 + size], data, offset=4 + size)
+    return msgpack.ExtType(code, data)
+
+
 class JsonSerializer(object):
     """
     .. warning::
@@ -98,3 +265,61 @@ class PickleSerializer(object):
     @staticmethod
     def unpackb(packed):
         return pickle.loads(packed)
+
+
+def register_serializer(serializer, serializer_id):
+    """
+    Register a serializer, so that messages packed with it can be
+    tagged with its id (from 1 to 255; the same on both sides!)
+    """
+    if not 0 < serializer_id < 256:
+        raise ValueError("Serializer ids must be between 1 and 255")
+    other = _serializers.get(serializer_id)
+    if other is not None and other is not serializer:
+        raise ValueError("Serializer id {0} already used by {1}".format(
+            serializer_id, other.__name__))
+    _serializers[serializer_id] = serializer
+    _serializer_ids[serializer] = serializer_id
+
+
+def get_serializer(serializer_id):
+    """Get a registered serializer by id (``None`` if missing)"""
+    return _serializers.get(serializer_id)
+
+
+def get_serializer_id(serializer):
+    """Get the id of a registered serializer (``None`` if missing)"""
+    return _serializer_ids.get(serializer)
+
+
+def tag_frames(frames, serializer):
+    """
+    Tag a message with the id of the serializer it was packed with,
+    unless it's the default one (or it is not registered)
+    """
+    serializer_id = _serializer_ids.get(serializer)
+    if serializer is not MsgPackSerializer and serializer_id is not None:
+        frames[0] = SERIALIZER_HEADER.pack(SERIALIZER_MARKER, serializer_id) \
+            + _frame_bytes(frames[0])
+    return frames
+
+
+def untag_frames(frames):
+    """
+    Split the serializer tag from a message: return the serializer id
+    (``None`` for untagged messages) and the frames without the tag
+    """
+    data = _frame_bytes(frames[0])
+    if data[:1] != SERIALIZER_MARKER:
+        return None, frames
+    _, serializer_id = SERIALIZER_HEADER.unpack_from(data)
+    return serializer_id, \
+        [data[SERIALIZER_HEADER.size:]] + list(frames[1:])
+
+
+register_serializer(MsgPackSerializer, 1)
+register_serializer(PrefixedMsgPackSerializer, 2)
+register_serializer(JsonSerializer, 3)
+register_serializer(PickleSerializer, 4)
+register_serializer(NumpySerializer, 5)
+register_serializer(CustomMsgPackSerializer, 6)
@@ -0,0 +1,332 @@
+"""
+End-to-end RPC benchmarks
+
+Starts servers and drives them with clients (one per thread), sweeping
+the transport, the payload size and shape, the number of concurrent
+clients and the number of middleware objects on the server. Each call
+sends a payload to an ``echo`` method, which sends it back.
+
+Results (throughput and latency percentiles, for each combination)
+are written as JSON; two result files can be compared, to spot
+regressions::
+
+    python tools/benchmark.py run --sizes 100,10000,1000000 -o new.json
+    python tools/benchmark.py compare old.json new.json
+
+.. note::
+    Every combination gets a new server, running in a child process
+    (so that it doesn't compete with the clients for the GIL) that is
+    stopped as soon as the combination is done. Transports are thus
+    limited to those reaching other processes.
+"""
+
+from __future__ import print_function
+
+import argparse
+import itertools
+import json
+import math
+import multiprocessing
+import platform
+import sys
+import threading
+import time
+import timeit
+
+import msgpack
+import zmq
+
+from smartrpyc.client import Client
+from smartrpyc.server import MethodsRegister, Server, ThreadPoolServer
+from smartrpyc.server.middleware import ServerMiddlewareBase
+from smartrpyc.utils import get_random_ipc_socket
+from smartrpyc.utils.serialization import MsgPackSerializer
+
+TRANSPORTS = ['ipc', 'tcp']
+SHAPES = ['flat', 'nested', 'blob']
+PERCENTILES = [('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('p999', 0.999)]
+
+## Keys identifying a combination, in the result files
+CASE_KEYS = ['transport', 'size', 'shape', 'concurrency', 'middleware',
+             'workers']
+
+clock = timeit.default_timer
+
+
+class NoopMiddleware(ServerMiddlewareBase):
+    """Middleware doing nothing, but still called for every request"""
+
+    def pre(self, request, method):
+        pass
+
+    def post(self, request, method, response, exception):
+        pass
+
+
+def echo(request, payload):
+    return payload
+
+
+def make_payload(shape, size):
+    """Build a payload of the given shape, about ``size`` bytes packed"""
+    if shape == 'blob':
+        return {u'name': u'blob', u'data': b'\x00' * size}
+    ## Items are about 32 bytes each, once packed
+    leaves = max(1, size // 32)
+    if shape == 'flat':
+        return dict((u'key{0:08d}'.format(i), u'v' * 16)
+                    for i in xrange(leaves))
+    if shape == 'nested':
+        return _make_tree(leaves)
+    raise ValueError("Unknown payload shape: {0}".format(shape))
+
+
+def _make_tree(leaves, fanout=4):
+    if leaves <= fanout:
+        return [u'v' * 28] * leaves
+    return dict((u'node{0}'.format(i), _make_tree(leaves // fanout, fanout))
+                for i in xrange(fanout))
+
+
+def start_server(transport, middleware, workers):
+    """
+    Start a server in a child process: return the process
+    (see :py:func:`stop_server`) and the server address
+    """
+    if transport not in TRANSPORTS:
+        raise ValueError("Unknown transport: {0}".format(transport))
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(
+        target=_serve, args=(transport, middleware, workers, sender),
+        name='benchmark-server')
+    process.daemon = True
+    process.start()
+    sender.close()
+    try:
+        address = receiver.recv()
+    except EOFError:
+        process.join()
+        raise RuntimeError("The benchmark server failed to start")
+    finally:
+        receiver.close()
+    return process, address
+
+
+def stop_server(process):
+    """Stop a server started with :py:func:`start_server`"""
+    process.terminate()
+    process.join()
+
+
+def _serve(transport, middleware, workers, sender):
+    """Run a server (in the child process), sending back its address"""
+    methods = MethodsRegister()
+    methods.register(echo)
+    if workers:
+        server = ThreadPoolServer(methods, workers=workers)
+    else:
+        server = Server(methods)
+    server.middleware = [NoopMiddleware() for _ in xrange(middleware)]
+
+    if transport == 'ipc':
+        address = get_random_ipc_socket()
+        server.bind(address)
+    else:
+        port = server.socket.bind_to_random_port('tcp://127.0.0.1')
+        address = 'tcp://127.0.0.1:{0}'.format(port)
+    sender.send(address)
+    sender.close()
+    server.run()
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return None
+    rank = int(math.ceil(fraction * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def run_case(case, duration, min_calls):
+    """Run a combination, returning its results"""
+    process, address = start_server(
+        case['transport'], case['middleware'], case['workers'])
+    try:
+        return _drive(case, address, duration, min_calls)
+    finally:
+        stop_server(process)
+
+
+def _drive(case, address, duration, min_calls):
+    """Call the server from the clients of a combination"""
+    payload = make_payload(case['shape'], case['size'])
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    start = threading.Event()
+
+    def client_loop():
+        client = Client(address)
+        client.echo(payload)  # Warm up (and negotiate the protocol)
+        own_latencies = []
+        own_errors = 0
+        start.wait()
+        stop_at = clock() + duration
+        while clock() < stop_at or len(own_latencies) < min_calls:
+            begin = clock()
+            try:
+                client.echo(payload)
+            except Exception:
+                own_errors += 1
+            own_latencies.append(clock() - begin)
+        with lock:
+            latencies.extend(own_latencies)
+            errors[0] += own_errors
+
+    threads = [threading.Thread(target=client_loop)
+               for _ in xrange(case['concurrency'])]
+    for thread in threads:
+        thread.start()
+    began = clock()
+    start.set()
+    for thread in threads:
+        thread.join()
+    elapsed = clock() - began
+
+    latencies.sort()
+    result = dict(case)
+    result.update({
+        'packed_size': len(MsgPackSerializer.packb(payload)),
+        'calls': len(latencies),
+        'errors': errors[0],
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed,
+        'latency': dict((name, percentile(latencies, fraction))
+                        for name, fraction in PERCENTILES),
+    })
+    result['latency']['mean'] = sum(latencies) / len(latencies)
+    return result
+
+
+def _int_list(value):
+    return [int(float(item)) for item in value.split(',')]
+
+
+def _str_list(value):
+    return value.split(',')
+
+
+def command_run(args):
+    cases = [dict(zip(CASE_KEYS, values)) for values in itertools.product(
+        args.transports, args.sizes, args.shapes, args.concurrency,
+        args.middleware, args.workers)]
+    results = []
+    for i, case in enumerate(cases):
+        result = run_case(case, args.duration, args.min_calls)
+        results.append(result)
+        print('[{0}/{1}] {2}: {3:.1f} calls/s, p99 {4:.3f} ms'.format(
+            i + 1, len(cases), _case_name(case), result['throughput'],
+            result['latency']['p99'] * 1000), file=sys.stderr)
+
+    report = {
+        'meta': {
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'pyzmq': zmq.__version__,
+            'libzmq': zmq.zmq_version(),
+            'msgpack': '.'.join(str(part) for part in msgpack.version),
+            'duration': args.duration,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    return 0
+
+
+def _case_name(case):
+    return ' '.join('{0}={1}'.format(key, case[key]) for key in CASE_KEYS)
+
+
+def _change(old, new):
+    if not old:
+        return 0.0
+    return (new - old) / float(old)
+
+
+def command_compare(args):
+    with open(args.old) as fp:
+        old = json.load(fp)
+    with open(args.new) as fp:
+        new = json.load(fp)
+    old_results = dict((tuple(result[key] for key in CASE_KEYS), result)
+                       for result in old['results'])
+
+    regressions = 0
+    for result in new['results']:
+        key = tuple(result[k] for k in CASE_KEYS)
+        previous = old_results.get(key)
+        if previous is None:
+            print('{0}: new'.format(_case_name(result)))
+            continue
+        throughput = _change(previous['throughput'], result['throughput'])
+        p99 = _change(previous['latency']['p99'], result['latency']['p99'])
+        regressed = throughput < -args.tolerance or p99 > args.tolerance
+        regressions += regressed
+        print('{0}: throughput {1:.1f} -> {2:.1f} ({3:+.1%}), '
+              'p99 {4:.3f} -> {5:.3f} ms ({6:+.1%}){7}'.format(
+                  _case_name(result), previous['throughput'],
+                  result['throughput'], throughput,
+                  previous['latency']['p99'] * 1000,
+                  result['latency']['p99'] * 1000, p99,
+                  '  REGRESSION' if regressed else ''))
+
+    print('{0} regression(s)'.format(regressions))
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    subparsers = parser.add_subparsers()
+
+    run = subparsers.add_parser('run', help='run the benchmarks')
+    run.set_defaults(func=command_run)
+    run.add_argument('--transports', type=_str_list, default=TRANSPORTS,
+                     help='comma-separated (default: all)')
+    run.add_argument('--sizes', type=_int_list, default=[100, 10000, 1000000],
+                     help='payload sizes in bytes, comma-separated '
+                          '(up to 1e8)')
+    run.add_argument('--shapes', type=_str_list, default=SHAPES,
+                     help='comma-separated (default: all)')
+    run.add_argument('--concurrency', type=_int_list, default=[1, 4],
+                     help='numbers of concurrent clients')
+    run.add_argument('--middleware', type=_int_list, default=[0, 8],
+                     help='numbers of middleware objects on the server')
+    run.add_argument('--workers', type=_int_list, default=[0],
+                     help='numbers of server worker threads '
+                          '(0 for a single-threaded server)')
+    run.add_argument('--duration', type=float, default=2.0,
+                     help='seconds for each combination')
+    run.add_argument('--min-calls', type=int, default=5,
+                     help='calls by each client, at least')
+    run.add_argument('-o', '--output', help='JSON file (default: stdout)')
+
+    compare = subparsers.add_parser(
+        'compare', help='compare two result files')
+    compare.set_defaults(func=command_compare)
+    compare.add_argument('old')
+    compare.add_argument('new')
+    compare.add_argument('--tolerance', type=float, default=0.1,
+                         help='relative change reported as a regression')
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,11 +6,11 @@
 import timeit
 
 from smartrpyc.utils.serialization import CustomMsgPackSerializer, \
-    MsgPackSerializer, JsonSerializer, PickleSerializer
+    MsgPackSerializer, JsonSerializer, PickleSerializer, \
+    PrefixedMsgPackSerializer
 
-
-def run_test(packer):
-    packer.unpackb(packer.packb({
+PAYLOADS = {
+    'flat': {
         'string': "This is a strijng",
         'unicode': u"This is a unicode",
         'None': None,
@@ -19,32 +19,45 @@ def run_test(packer):
         'List': ['str', u'unicode', 10, 10.5, None, True, False],
         'int': 1000,
         'float': 3.141592,
-    }))
+    },
+    'wide': dict((u'key{0}'.format(i), [u'text', 'blob', i, i / 2.0])
+                 for i in range(1000)),
+    'deep': reduce(lambda value, _: {u'nested': [value, u'text', 'blob']},
+                   range(100), {}),
+}
+
+
+def run_test(packer, payload):
+    packer.unpackb(packer.packb(PAYLOADS[payload]))
+
+
+def run_msgpack(payload):
+    run_test(MsgPackSerializer, payload)
 
 
-def run_msgpack():
-    run_test(MsgPackSerializer)
+def run_msgpack_custom(payload):
+    run_test(CustomMsgPackSerializer, payload)
 
 
-def run_msgpack_custom():
-    run_test(CustomMsgPackSerializer)
+def run_msgpack_prefixed(payload):
+    run_test(PrefixedMsgPackSerializer, payload)
 
 
-def run_json():
-    run_test(JsonSerializer)
+def run_json(payload):
+    run_test(JsonSerializer, payload)
 
 
-def run_pickle():
-    run_test(PickleSerializer)
+def run_pickle(payload):
+    run_test(PickleSerializer, payload)
 
 
 if __name__ == '__main__':
-    times = {}
-    funcs = ['msgpack', 'msgpack_custom', 'json', 'pickle']
-    for func_name in funcs:
-        times[func_name] = timeit.timeit(
-            stmt='run_{}()'.format(func_name),
-            setup='from __main__ import run_{}'.format(func_name),
-            number=10000)
-    for func_name in funcs:
-        print '{}: {}'.format(func_name, times[func_name])
+    funcs = ['msgpack', 'msgpack_custom', 'msgpack_prefixed', 'json',
+             'pickle']
+    for payload, number in [('flat', 10000), ('wide', 100), ('deep', 1000)]:
+        print '{} payload ({} runs):'.format(payload, number)
+        for func_name in funcs:
+            print '    {}: {}'.format(func_name, timeit.timeit(
+                stmt='run_{}({!r})'.format(func_name, payload),
+                setup='from __main__ import run_{}'.format(func_name),
+                number=number))